@@ -62,6 +62,7 @@ class CCTV_Agent:
             self.log.warn = self.log.warning = nolog
             self.log.error = self.log.exception = nolog
 
+    timer = property(fget=lambda self: self.__onvif.timer, doc='探索(SSDP、WS-Discovery)與 ONVIF 呼叫的耗時與失敗次數, 請參閱 CallTimer')
     ipcams: List[Dict] = property(fget=lambda self: self.__devs, doc='''已探索到的 IP Cam 清單, 
     傳回''')
 
@@ -230,8 +231,11 @@ class CCTV_Agent:
         self.log.info(f'Get Device information from \x1B[93m{url}\x1B[39m')
         try:
             req = request.Request(url)
-            with request.urlopen(req) as res:
-                buf = res.read()
+
+            def fetch():
+                with request.urlopen(req) as res:
+                    return res.read()
+            buf = self.timer.call('SsdpDeviceInfo', fetch)
             xml = str(buf, 'iso-8859-1')
             d = xml2Dict(xml)
             return True, d['root']['device']
@@ -0,0 +1,459 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os, json, time, socket, base64, struct, threading, platform, tempfile, argparse, logging
+import multiprocessing as mp
+import numpy as np
+import cv2
+from .captureHub import hub
+from .rtspProxy import RtspProxy, HttpMJpegPusher, FRAME_HEADER, PROTOCOL_BINARY, PROTOCOL_TILES, \
+    _OPCODE_TEXT, _OPCODE_BINARY, _OPCODE_CLOSE, _OPCODE_PING, _OPCODE_PONG
+
+__all__ = ['standInVideo', 'run']
+# 終端回報已顯示頁框的最短間隔(秒), 與 rtspProxy.js 的 SHOWN_INTERVAL 相同
+SHOWN_INTERVAL = 0.25
+
+
+def standInVideo(path, resolution=(1280, 720), fps=25, seconds=30):
+    '''以 numpy 產生測試影片(MJPG AVI), 作為替代攝影機
+
+    每張頁框的內容皆不同(水平捲動的色塊與頁框序號), 不會被場景變動偵測視為靜止畫面;
+    影片長度須涵蓋整個量測時間, 讀到檔尾時擷取中心會視為斷線而重新連線
+    傳入:
+        path       : str - 輸出檔名
+        resolution : tuple - (width, height)
+        fps        : float - 頁框速率
+        seconds    : float - 影片長度
+    傳回:
+        str - 輸出檔名
+    '''
+    w, h = resolution
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+    if not writer.isOpened():
+        raise OSError(f'unable to write {path}')
+    x = np.linspace(0, 255, w, dtype=np.float32)
+    y = np.linspace(0, 255, h, dtype=np.float32)[:, None]
+    base = np.dstack([np.broadcast_to(x, (h, w)), np.broadcast_to(y, (h, w)),
+                      np.broadcast_to((x + y) / 2, (h, w))]).astype(np.uint8)
+    try:
+        for i in range(int(fps * seconds)):
+            frame = np.roll(base, i * 8, axis=1)
+            cv2.putText(frame, f'{i:06d}', (w // 20, h // 2), cv2.FONT_HERSHEY_SIMPLEX, h / 240, (255, 255, 255), 2)
+            writer.write(frame)
+    finally:
+        writer.release()
+    return path
+
+
+class _Viewer(threading.Thread):
+    '''模擬的觀看端, 記錄每張頁框的收到時間、大小與(可取得時)擷取至收到的延遲'''
+    def __init__(self, kind, host, camera, size):
+        super(_Viewer, self).__init__(daemon=True)
+        self.kind = kind
+        self.host = host
+        self.camera = camera
+        self.size = size
+        self.arrivals = []
+        self.sizes = []
+        self.latencies = []
+        self.error = ''
+        self.evt_exit = threading.Event()
+
+    def run(self):
+        try:
+            self.receive()
+        except Exception as ex:
+            if not self.evt_exit.isSet():
+                self.error = f'{type(ex).__name__}: {ex}'
+
+    def received(self, size, captured=None):
+        now = time.time()
+        self.arrivals.append(now)
+        self.sizes.append(size)
+        self.latencies.append(now - captured if captured else None)
+
+    def stop(self):
+        self.evt_exit.set()
+
+    def result(self, since, until):
+        '''量測區間 [since, until) 內的統計資料'''
+        index = [i for i, t in enumerate(self.arrivals) if since <= t < until]
+        seconds = until - since
+        frames = len(index)
+        lat = [self.latencies[i] for i in index if self.latencies[i] is not None]
+        result = {
+            'kind': self.kind, 'camera': self.camera, 'resolution': '%dx%d' % tuple(self.size),
+            'frames': frames, 'fps': frames / seconds if seconds > 0 else 0.0,
+            'bytes': sum(self.sizes[i] for i in index), 'error': self.error,
+        }
+        if lat:
+            p50, p95, p99 = (float(v) * 1000 for v in np.percentile(lat, (50, 95, 99)))
+            result['latency'] = {'p50': p50, 'p95': p95, 'p99': p99, 'max': max(lat) * 1000}
+        return result
+
+
+class _WsViewer(_Viewer):
+    '''WebSocket 觀看端(v2 或 v4 二進位協定), 與 rtspProxy.js 相同每 250 毫秒回報一次已顯示的頁框'''
+    def __init__(self, host, camera, size, url, protocol=PROTOCOL_BINARY):
+        super(_WsViewer, self).__init__('ws', host, camera, size)
+        self.url = url
+        self.protocol = protocol
+
+    def receive(self):
+        sock = socket.create_connection(self.host, timeout=10)
+        self.__sock = sock
+        self.__rfile = sock.makefile('rb')
+        key = base64.b64encode(os.urandom(16)).decode()
+        sock.sendall((f'GET / HTTP/1.1\r\nHost: {self.host[0]}:{self.host[1]}\r\nUpgrade: websocket\r\n'
+                      f'Connection: Upgrade\r\nSec-WebSocket-Key: {key}\r\nSec-WebSocket-Version: 13\r\n\r\n').encode())
+        status = self.__rfile.readline()
+        if b' 101 ' not in status:
+            raise ConnectionError(f'handshake failed: {status!r}')
+        while self.__rfile.readline() not in (b'\r\n', b'\n', b''): pass
+        self.__send(json.dumps({'act': 'open', 'url': self.url, 'resolution': list(self.size), 'protocol': self.protocol}))
+        shown = 0.0
+        try:
+            while not self.evt_exit.isSet():
+                opcode, data = self.__recv()
+                if opcode == _OPCODE_BINARY and len(data) >= FRAME_HEADER.size:
+                    start = time.time()
+                    version, flags, camera, seq, ts = FRAME_HEADER.unpack_from(data)
+                    self.received(len(data), ts)
+                    if start - shown >= SHOWN_INTERVAL:
+                        shown = start
+                        self.__send(json.dumps({'act': 'shown', 'seq': seq, 'paint': (time.time() - start) * 1000}))
+                elif opcode == _OPCODE_PING:
+                    self.__send(data, _OPCODE_PONG)
+                elif opcode == _OPCODE_CLOSE:
+                    break
+        finally:
+            sock.close()
+
+    def __read(self, n):
+        data = self.__rfile.read(n)
+        if len(data) < n: raise ConnectionError('connection closed')
+        return data
+
+    def __recv(self):
+        '''讀取一則訊息(伺服器不分段傳送)'''
+        b1, b2 = self.__read(2)
+        length = b2 & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self.__read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.__read(8))[0]
+        mask = self.__read(4) if b2 & 0x80 else None
+        data = self.__read(length)
+        if mask: data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+        return b1 & 0x0F, data
+
+    def __send(self, data, opcode=_OPCODE_TEXT):
+        '''送出一則(已遮罩的)訊息'''
+        if isinstance(data, str): data = data.encode('utf-8')
+        mask = os.urandom(4)
+        n = len(data)
+        header = bytes([0x80 | opcode])
+        if n < 126:
+            header += bytes([0x80 | n])
+        elif n < 65536:
+            header += bytes([0x80 | 126]) + struct.pack('!H', n)
+        else:
+            header += bytes([0x80 | 127]) + struct.pack('!Q', n)
+        self.__sock.sendall(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(data)))
+
+    def stop(self):
+        super(_WsViewer, self).stop()
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+
+class _MJpegViewer(_Viewer):
+    '''M-Jpeg 觀看端(GET /live/<id>), 串流中無擷取時間, 延遲以伺服器端的統計為準'''
+    def __init__(self, host, camera, size):
+        super(_MJpegViewer, self).__init__('mjpeg', host, camera, size)
+
+    def receive(self):
+        sock = socket.create_connection(self.host, timeout=10)
+        self.__sock = sock
+        query = '?size=%dx%d' % tuple(self.size) if self.size[0] and self.size[1] else ''
+        sock.sendall(f'GET /live/{self.camera}{query} HTTP/1.1\r\nHost: {self.host[0]}:{self.host[1]}\r\n\r\n'.encode())
+        rfile = sock.makefile('rb')
+        status = rfile.readline()
+        if b' 200 ' not in status:
+            raise ConnectionError(f'request failed: {status!r}')
+        length = 0
+        try:
+            while not self.evt_exit.isSet():
+                line = rfile.readline()
+                if not line: break
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+                elif line == b'\r\n' and length:
+                    jpg = rfile.read(length)
+                    if len(jpg) < length: break
+                    self.received(length)
+                    length = 0
+        finally:
+            sock.close()
+
+    def stop(self):
+        super(_MJpegViewer, self).stop()
+        try:
+            self.__sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+
+def _runViewers(specs, warmup, duration, queue):
+    '''於子程序中執行所有觀看端, 使觀看端的 CPU 用量不計入伺服器
+    傳入:
+        specs : list(dict) - 格式為 {'kind', 'host', 'camera', 'size', 'url', 'protocol'}
+        queue : multiprocessing.Queue - 傳回 list(dict), 請參閱 _Viewer.result()
+    '''
+    viewers = []
+    for sp in specs:
+        if sp['kind'] == 'ws':
+            viewers.append(_WsViewer(tuple(sp['host']), sp['camera'], sp['size'], sp['url'], sp['protocol']))
+        else:
+            viewers.append(_MJpegViewer(tuple(sp['host']), sp['camera'], sp['size']))
+    started = time.time()
+    for v in viewers: v.start()
+    since = started + warmup
+    time.sleep(max(0.0, since + duration - time.time()))
+    for v in viewers: v.stop()
+    for v in viewers: v.join(timeout=2)
+    queue.put([v.result(since, since + duration) for v in viewers])
+
+
+class _Sampler(threading.Thread):
+    '''定時取樣伺服器程序(含編碼子程序)的 CPU 使用率與記憶體用量(RSS)'''
+    def __init__(self, interval=1.0):
+        super(_Sampler, self).__init__(daemon=True)
+        self.interval = interval
+        self.samples = []
+        self.__evt_exit = threading.Event()
+
+    @staticmethod
+    def _processes():
+        pids = [os.getpid()] + [p.pid for p in mp.active_children()]
+        return [p for p in pids if os.path.exists(f'/proc/{p}/stat')]
+
+    @staticmethod
+    def _cpuSeconds(pid):
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    @staticmethod
+    def _rss(pid):
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+    def run(self):
+        last, cpu = time.time(), {}
+        while not self.__evt_exit.wait(self.interval):
+            now, used, rss = time.time(), 0.0, 0
+            for pid in self._processes():
+                try:
+                    seconds = self._cpuSeconds(pid)
+                    used += seconds - cpu.get(pid, seconds)
+                    cpu[pid] = seconds
+                    rss += self._rss(pid)
+                except (OSError, IndexError, ValueError):
+                    continue
+            self.samples.append({'time': now, 'cpu': used / (now - last) * 100, 'rss': rss})
+            last = now
+
+    def stop(self):
+        self.__evt_exit.set()
+
+    def result(self, since, until):
+        '''量測區間內的 CPU 使用率(%, 單核為 100)與 RSS(MB)'''
+        samples = [s for s in self.samples if since <= s['time'] <= until] or self.samples[-1:]
+        if not samples: return {}
+        cpu = [s['cpu'] for s in samples]
+        rss = [s['rss'] / 1048576 for s in samples]
+        return {'cpu': sum(cpu) / len(cpu), 'cpuPeak': max(cpu), 'rss': rss[-1], 'rssPeak': max(rss), 'samples': len(samples)}
+
+
+def _parseSize(text):
+    w, h = (int(v) for v in text.lower().split('x'))
+    return (w, h)
+
+
+def _summary(viewers):
+    '''依觀看端類型與解析度彙總'''
+    groups = {}
+    for v in viewers:
+        groups.setdefault(f"{v['kind']} {v['resolution']}", []).append(v)
+    result = {}
+    for key, rows in sorted(groups.items()):
+        fps = [r['fps'] for r in rows]
+        lat = [r['latency']['p95'] for r in rows if 'latency' in r]
+        result[key] = {
+            'viewers': len(rows), 'errors': len([r for r in rows if r['error']]),
+            'fps': sum(fps) / len(fps), 'fpsMin': min(fps), 'bytes': sum(r['bytes'] for r in rows),
+            'p95': max(lat) if lat else None,
+        }
+    return result
+
+
+def run(cameras=1, ws=4, mjpeg=2, sizes=((640, 480), ), protocol=PROTOCOL_BINARY, duration=20.0, warmup=3.0,
+        source=None, resolution=(1280, 720), fps=25, workers=0, output=None, log=None):
+    '''執行負載量測: 啟動 RtspProxy 與 M-Jpeg 服務, 以子程序中的模擬觀看端連線並統計
+
+    傳入:
+        cameras    : int - 攝影機數量, 各自獨立擷取(同一來源以不同檔名或網址區分)
+        ws         : int - WebSocket 觀看端數量
+        mjpeg      : int - M-Jpeg 觀看端數量
+        sizes      : list(tuple) - 觀看端要求的解析度, 依序輪流分配, (0, 0) 表示原始解析度
+        protocol   : int - WebSocket 觀看端的傳輸協定, PROTOCOL_BINARY 或 PROTOCOL_TILES
+        duration   : float - 量測秒數(不含暖機)
+        warmup     : float - 暖機秒數, 期間的頁框不列入統計
+        source     : str - 替代攝影機的串流網址或影片檔, None 表示以 standInVideo() 產生
+        resolution : tuple - 產生測試影片的解析度
+        fps        : float - 產生測試影片的頁框速率
+        workers    : int - JPEG 編碼子程序數量, 0 表示不使用 EncodePool
+        output     : str - 量測結果的 JSON 檔, 於停止服務前寫入, None 表示不寫入
+        log        : logging.Logger
+    傳回:
+        dict - 量測結果, 格式為 {'config', 'host', 'throughput', 'server', 'summary', 'viewers', 'cameras', 'latency', 'sources'}
+    '''
+    from webSvc import HttpService, WebHandler, HttpEvents
+    log = log or logging.getLogger(__name__)
+    config = {
+        'cameras': cameras, 'ws': ws, 'mjpeg': mjpeg, 'sizes': ['%dx%d' % tuple(s) for s in sizes],
+        'protocol': protocol, 'duration': duration, 'warmup': warmup, 'source': source,
+        'resolution': '%dx%d' % tuple(resolution), 'fps': fps, 'workers': workers,
+    }
+    tmp = tempfile.TemporaryDirectory(prefix='cctv-bench-')
+    try:
+        if source is None:
+            log.info(f'Generating stand-in video {config["resolution"]}@{fps}...')
+            source = standInVideo(os.path.join(tmp.name, 'cam.avi'), resolution, fps, warmup + duration + 10)
+        # 擷取中心以網址區分攝影機, 本機檔案以不同檔名的連結模擬多台攝影機
+        urls = {}
+        for i in range(cameras):
+            url = source
+            if i and os.path.isfile(source):
+                url = os.path.join(tmp.name, f'cam-{i + 1}{os.path.splitext(source)[1]}')
+                os.symlink(os.path.abspath(source), url)
+            elif i:
+                url = f"{source}{'&' if '?' in source else '?'}bench={i + 1}"
+            urls[f'BENCH-{i + 1}'] = url
+            hub.register(f'BENCH-{i + 1}', url)
+        pool = encoder = None
+        if workers:
+            from .encodePool import EncodePool
+            encoder, pool = hub.encoder, EncodePool(workers)
+            hub.encoder = pool
+
+        def webGet(handler, cnt):
+            fds = cnt['info'].url.split('/')
+            if len(fds) < 2 or fds[0] != 'live' or fds[1] not in urls: return
+            cnt['handled'] = True
+            query = cnt['info'].query
+            size = _parseSize(query['size'][0]) if query and 'size' in query else (0, 0)
+            HttpMJpegPusher(handler, urls[fds[1]], size).start()
+
+        handler = WebHandler.events[HttpEvents.GET]
+        WebHandler.events[HttpEvents.GET] = webGet
+        svr = HttpService(('127.0.0.1', 0), tempfile.gettempdir(), WebHandler)
+        proxy = RtspProxy(host=('127.0.0.1', _freePort()), log=log)
+        try:
+            proxy.start()
+            svr.start()
+            ids = list(urls)
+            specs = [{'kind': 'ws', 'host': proxy.host, 'camera': ids[i % cameras], 'url': urls[ids[i % cameras]],
+                      'size': sizes[i % len(sizes)], 'protocol': protocol} for i in range(ws)]
+            specs += [{'kind': 'mjpeg', 'host': ('127.0.0.1', svr.port), 'camera': ids[i % cameras],
+                       'size': sizes[i % len(sizes)]} for i in range(mjpeg)]
+            sampler = _Sampler()
+            sampler.start()
+            ctx = mp.get_context('spawn')
+            queue = ctx.Queue()
+            log.info(f'Running {ws} WebSocket and {mjpeg} M-Jpeg viewers on {cameras} camera(s) for {warmup + duration:.0f}s...')
+            started = time.time()
+            child = ctx.Process(target=_runViewers, args=(specs, warmup, duration, queue), daemon=True)
+            child.start()
+            since = started + warmup
+            try:
+                # 觀看端結束前取得伺服器端的統計(結束後 M-Jpeg 觀看端即不在清單中)
+                time.sleep(max(0.0, since + duration - 0.5 - time.time()))
+                sources = hub.stats()
+                latency = {'cameras': hub.latencyStats(), 'clients': proxy.latencyStats() + HttpMJpegPusher.latencyStats()}
+                viewers = queue.get(timeout=60)
+            finally:
+                child.join(timeout=5)
+                sampler.stop()
+            result = {
+                'config': config,
+                'host': {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+                         'opencv': cv2.__version__},
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+                'server': sampler.result(since, since + duration),
+                'sources': sources,
+                'latency': latency,
+            }
+            frames = sum(v['frames'] for v in viewers)
+            sent = sum(v['bytes'] for v in viewers)
+            result['throughput'] = {'frames': frames, 'fps': frames / duration, 'bytes': sent, 'mbps': sent * 8 / duration / 1e6}
+            result['summary'] = _summary(viewers)
+            result['viewers'] = viewers
+            if output:
+                # 先寫入結果再停止服務, 停止過程的異常不致遺失量測結果
+                with open(output, 'w') as f:
+                    json.dump(result, f, indent=2, default=str)
+            return result
+        finally:
+            WebHandler.events[HttpEvents.GET] = handler
+            proxy.stop()
+            if svr.started: svr.stop()
+            if pool:
+                hub.encoder = encoder
+                pool.stop()
+    finally:
+        tmp.cleanup()
+
+
+def _freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _print(result):
+    th, srv = result['throughput'], result['server']
+    print(f"{'Viewers':<20} {'Count':>5} {'Errors':>6} {'FPS':>7} {'MinFPS':>7} {'p95 ms':>8} {'MB':>8}")
+    for key, st in result['summary'].items():
+        p95 = f"{st['p95']:>8.1f}" if st['p95'] is not None else f"{'-':>8}"
+        print(f"{key:<20} {st['viewers']:>5} {st['errors']:>6} {st['fps']:>7.1f} {st['fpsMin']:>7.1f} {p95} {st['bytes'] / 1048576:>8.1f}")
+    print(f"Throughput: {th['fps']:.1f} frames/s, {th['mbps']:.1f} Mbit/s")
+    if srv:
+        print(f"Server: CPU {srv['cpu']:.0f}% (peak {srv['cpuPeak']:.0f}%), RSS {srv['rss']:.0f} MB (peak {srv['rssPeak']:.0f} MB)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m cctv.benchmark', description='CCTV proxy load benchmark')
+    parser.add_argument('-c', '--cameras', type=int, default=1, help='number of cameras')
+    parser.add_argument('-w', '--ws', type=int, default=4, help='number of WebSocket viewers')
+    parser.add_argument('-m', '--mjpeg', type=int, default=2, help='number of M-Jpeg viewers')
+    parser.add_argument('-s', '--sizes', default='640x480', help='viewer resolutions, e.g. 320x240,640x480,0x0')
+    parser.add_argument('-p', '--protocol', type=int, default=PROTOCOL_BINARY, choices=(PROTOCOL_BINARY, PROTOCOL_TILES),
+                        help='WebSocket protocol')
+    parser.add_argument('-d', '--duration', type=float, default=20.0, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=3.0, help='warm-up seconds excluded from results')
+    parser.add_argument('--source', help='stream url or video file of the stand-in camera (default: generated)')
+    parser.add_argument('--resolution', default='1280x720', help='resolution of the generated video')
+    parser.add_argument('--fps', type=float, default=25, help='frame rate of the generated video')
+    parser.add_argument('--workers', type=int, default=0, help='JPEG encode worker processes')
+    parser.add_argument('-o', '--output', help='result JSON file (default: benchmark-YYYYmmdd-HHMMSS.json)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    output = args.output or time.strftime('benchmark-%Y%m%d-%H%M%S.json')
+    result = run(args.cameras, args.ws, args.mjpeg, [_parseSize(s) for s in args.sizes.split(',')], args.protocol,
+                 args.duration, args.warmup, args.source, _parseSize(args.resolution), args.fps, args.workers, output)
+    _print(result)
+    print(f'Result: {output}')
@@ -0,0 +1,289 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os, threading, time, queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from . import captureHub
+from .captureHub import _encodeJpeg
+from .frameRing import FrameRing
+from .jpegEncoder import createEncoder
+
+__all__ = ['EncodePool']
+# 子程序回傳狀態, 置於 JPEG 內容之前
+_DONE = b'\x00'
+_STALE = b'\x01'
+_FAIL = b'\x02'
+
+
+def _encode_Proc(conn, spec=None):
+    '''編碼子程序: 由共享記憶體讀取頁框, 調整解析度並編碼成 JPEG 後回傳
+
+    spec 為主程序 JPEG 編碼器的設定(JpegEncoder.spec), 子程序以相同設定建立編碼器
+
+    工作內容不含頁框本身, 頁框經由以下兩種共享記憶體之一傳入:
+        ('shm', 名稱, shape, dtype, resolution, quality)  -- 子程序專屬的輸入緩衝區
+        ('ring', 名稱, shape, seq, resolution, quality)   -- 攝影機的頁框環, 以 seqlock 確認未被覆寫
+    '''
+    shm = None
+    rings = {}
+    if spec:
+        captureHub.hub.jpeg = createEncoder(*spec)
+    try:
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                break
+            if job is None: break
+            kind, name, shape, arg, resolution, quality = job
+            if kind == 'ring':
+                ring = rings.get(name)
+                if ring is None or ring.shape != tuple(shape):
+                    if ring: ring.close()
+                    try:
+                        # 子程序與主程序共用 resource_tracker, 直接開啟即可
+                        ring = rings[name] = FrameRing(shared_memory.SharedMemory(name=name), False)
+                    except (FileNotFoundError, ValueError):
+                        rings.pop(name, None)
+                        conn.send_bytes(_STALE)
+                        continue
+                frame, counter = ring.readSeq(arg)
+            else:
+                if shm is None or shm.name != name:
+                    if shm: shm.close()
+                    shm = shared_memory.SharedMemory(name=name)
+                frame = np.ndarray(shape, dtype=arg, buffer=shm.buf)
+            if frame is None:
+                conn.send_bytes(_STALE)
+                continue
+            try:
+                jpg = _encodeJpeg(frame, resolution, quality)
+            except Exception:
+                jpg = None
+            del frame
+            if kind == 'ring' and not ring.isValid(arg, counter):
+                # 編碼期間該槽已被覆寫, 結果可能不完整
+                conn.send_bytes(_STALE)
+            else:
+                conn.send_bytes(_DONE + jpg if jpg else _FAIL)
+    finally:
+        if shm: shm.close()
+        for ring in rings.values():
+            ring.close()
+
+
+class _Worker(object):
+    '''單一編碼子程序與其輸入用的共享記憶體'''
+    def __init__(self, ctx, no, window=10.0, spec=None, timeout=5.0):
+        self.no = no
+        # 等待子程序回應的秒數, 逾時視為子程序卡住(如編碼器無回應或被暫停)
+        self.timeout = timeout
+        self.__spec = spec
+        self.__ctx = ctx
+        self.__window = window
+        self.__shm = None
+        self.__proc = None
+        self.__conn = None
+        self.jobs = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.utilisation = 0.0
+        self.__started = time.time()
+        self.__winStart = self.__started
+        self.__winBusy = 0.0
+        self.__spawn()
+
+    pid = property(fget=lambda self: self.__proc.pid if self.__proc else None, doc='子程序 PID')
+
+    def __spawn(self):
+        self.__conn, child = self.__ctx.Pipe()
+        self.__proc = self.__ctx.Process(target=_encode_Proc, args=(child, self.__spec), daemon=True,
+                                         name=f'EncodeWorker-{self.no}')
+        self.__proc.start()
+        child.close()
+
+    def __buffer(self, size):
+        '''取得足夠大小的共享記憶體, 不足時重新配置'''
+        if self.__shm is None or self.__shm.size < size:
+            if self.__shm:
+                self.__shm.close()
+                self.__shm.unlink()
+            self.__shm = shared_memory.SharedMemory(create=True, size=size)
+        return self.__shm
+
+    def encode(self, frame, resolution, quality, ring=None, seq=0):
+        t = time.perf_counter()
+        try:
+            res = _STALE
+            if ring:
+                self.__conn.send(('ring', ring.name, ring.shape, seq, resolution, quality))
+                res = self.__recv()
+            if res[:1] == _STALE:
+                shm = self.__buffer(frame.nbytes)
+                np.ndarray(frame.shape, dtype=frame.dtype, buffer=shm.buf)[...] = frame
+                self.__conn.send(('shm', shm.name, frame.shape, frame.dtype.str, resolution, quality))
+                res = self.__recv()
+            jpg = res[1:] if res[:1] == _DONE else None
+        except (EOFError, OSError, BrokenPipeError):
+            # 子程序異常結束或逾時未回應, 強制結束並重新啟動後此次改由本程序編碼
+            self.errors += 1
+            self.__kill()
+            self.__spawn()
+            jpg = _encodeJpeg(frame, resolution, quality)
+        self.__account(time.perf_counter() - t)
+        return jpg
+
+    def __recv(self):
+        '''等待子程序回應
+        引發錯誤:
+            `TimeoutError` -- 超過 timeout 秒未回應
+        '''
+        if not self.__conn.poll(self.timeout):
+            raise TimeoutError(f'encode worker {self.no} not responding')
+        return self.__conn.recv_bytes()
+
+    def __kill(self):
+        '''強制結束子程序(SIGKILL 對暫停中的程序亦有效)'''
+        self.__conn.close()
+        if self.__proc.is_alive():
+            self.__proc.kill()
+        self.__proc.join(1)
+
+    def __account(self, spent):
+        self.jobs += 1
+        self.busy += spent
+        self.__winBusy += spent
+        now = time.time()
+        if now - self.__winStart >= self.__window:
+            self.utilisation = self.__winBusy / (now - self.__winStart)
+            self.__winStart = now
+            self.__winBusy = 0.0
+
+    def close(self):
+        try:
+            self.__conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.__conn.close()
+        self.__proc.join(1)
+        if self.__proc.is_alive():
+            self.__proc.terminate()
+
+    def release(self):
+        self.close()
+        if self.__shm:
+            self.__shm.close()
+            self.__shm.unlink()
+            self.__shm = None
+
+    @property
+    def stats(self):
+        elapsed = time.time() - self.__started
+        return {
+            'worker': self.no, 'pid': self.pid, 'jobs': self.jobs, 'errors': self.errors,
+            'busy': self.busy, 'utilisation': self.utilisation,
+            'average': self.busy / elapsed if elapsed else 0.0,
+        }
+
+
+class EncodePool(object):
+    def __init__(self, workers=None, window=10.0, jpeg=None, timeout=5.0):
+        '''以多個子程序進行解析度調整與 JPEG 編碼, 避開 GIL 限制
+
+        頁框經由各子程序專屬的共享記憶體傳遞(僅一次記憶體複製, 不經 pickle),
+        編碼完成的 JPEG 內容再回傳給呼叫端; 呼叫端執行緒等待期間不佔用 GIL
+
+        傳入:
+            workers : int - 子程序數量, 未傳入時使用 CPU 核心數
+            window  : float - 計算各子程序使用率的統計區間秒數
+            jpeg    : JpegEncoder - 子程序使用的 JPEG 編碼器設定, 未傳入時與 hub.jpeg 相同
+            timeout : float - 子程序逾時未回應的秒數, 逾時時強制重新啟動該子程序並改由呼叫端編碼
+        '''
+        ctx = mp.get_context('spawn')
+        self.__idle = queue.Queue()
+        self.__lock = threading.Lock()
+        self.workers = []
+        # 已停止時改由呼叫端於本程序內編碼
+        self.stopped = False
+        spec = (jpeg or captureHub.hub.jpeg).spec
+        for no in range(workers or os.cpu_count() or 1):
+            w = _Worker(ctx, no, window, spec, timeout)
+            self.workers.append(w)
+            self.__idle.put(w)
+
+    def encode(self, frame, resolution=(0, 0), quality=0):
+        '''將頁框交由閒置的子程序編碼, 參數與傳回值同 captureHub._encodeJpeg
+        傳入:
+            frame     : cv2 image - 來自 OpenCV 的圖像(頁框)資料
+            resolution: tuple - 輸出解析度, (0, 0) 表示不調整
+            quality   : int - 壓縮品質, 0 表示預設品質
+        傳回:
+            bytes - JPEG 資料, 編碼失敗時傳回 None
+        '''
+        w = self.__acquire()
+        if w is None:
+            return _encodeJpeg(frame, resolution, quality)
+        try:
+            return w.encode(frame, resolution, quality)
+        finally:
+            self.__release(w)
+
+    __call__ = encode
+
+    def encodeRing(self, ring, seq, frame, resolution=(0, 0), quality=0):
+        '''頁框已寫入攝影機的頁框環時使用, 子程序直接自頁框環讀取而不再複製;
+        該槽已被覆寫時改以 encode() 的方式傳遞 frame
+        傳入:
+            ring      : FrameRing - 攝影機的頁框環
+            seq       : int - 頁框序號
+            frame     : cv2 image - 同一頁框(備用)
+            resolution: tuple - 輸出解析度
+            quality   : int - 壓縮品質
+        傳回:
+            bytes - JPEG 資料, 編碼失敗時傳回 None
+        '''
+        w = self.__acquire()
+        if w is None:
+            return _encodeJpeg(frame, resolution, quality)
+        try:
+            return w.encode(frame, resolution, quality, ring, seq)
+        finally:
+            self.__release(w)
+
+    def __acquire(self):
+        '''等待閒置的子程序, 已停止時傳回 None'''
+        while not self.stopped:
+            try:
+                return self.__idle.get(timeout=0.5)
+            except queue.Empty:
+                pass
+        return None
+
+    def __release(self, w):
+        '''歸還子程序, 已停止時直接結束該子程序'''
+        with self.__lock:
+            if not self.stopped:
+                self.__idle.put(w)
+                return
+        w.release()
+
+    def stop(self):
+        '''停止所有子程序; 編碼中的子程序於完成目前的工作後結束, 之後的編碼改於本程序內進行'''
+        with self.__lock:
+            self.stopped = True
+            self.workers = []
+        while True:
+            try:
+                w = self.__idle.get_nowait()
+            except queue.Empty:
+                break
+            w.release()
+
+    def stats(self):
+        '''傳回各子程序的工作數、忙碌時間與使用率
+        傳回:
+            list(dict) - utilisation 為最近一個統計區間的使用率, average 為啟動以來的平均使用率
+        '''
+        return [w.stats for w in self.workers]
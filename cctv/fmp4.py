@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import re, struct
+
+__all__ = ['Fmp4Muxer', 'splitNalus', 'parseExtradata']
+# H.264 NAL 類型
+NAL_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+# 影格取樣旗標(ISO/IEC 14496-12 sample_flags)
+_FLAGS_SYNC = 0x02000000
+_FLAGS_NON_SYNC = 0x01010000
+_MATRIX = struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+_OUT_OF_BAND = (NAL_SPS, NAL_PPS, NAL_AUD)
+_START_CODE = re.compile(b'\x00\x00\x01')
+
+
+def splitNalus(data):
+    '''將 Annex-B 格式(以 00 00 01 或 00 00 00 01 分隔)的 H.264 資料拆解成 NAL 單元
+    傳入:
+        data : bytes - Annex-B 格式的 H.264 資料
+    傳回:
+        list(bytes) - 不含起始碼的 NAL 單元
+    '''
+    starts = [m.end() for m in _START_CODE.finditer(data)]
+    nalus = []
+    for i, s in enumerate(starts):
+        e = starts[i + 1] - 3 if i + 1 < len(starts) else len(data)
+        nal = data[s:e].rstrip(b'\x00') if i + 1 < len(starts) else data[s:e]
+        if nal: nalus.append(nal)
+    return nalus
+
+
+def parseExtradata(extra):
+    '''由解碼器設定資料(extradata)取出 SPS 與 PPS, 支援 avcC 與 Annex-B 兩種格式
+    傳入:
+        extra : bytes - VideoCapture 取得的 extradata
+    傳回:
+        tuple(sps:bytes, pps:bytes) - 無法取得時為 None
+    '''
+    sps = pps = None
+    if not extra:
+        return sps, pps
+    if extra[0] == 1 and len(extra) > 8:
+        # avcC: version, profile, compat, level, lengthSize, numSps, (len, sps)..., numPps, (len, pps)...
+        pos = 6
+        for i in range(extra[5] & 0x1F):
+            n = struct.unpack_from('>H', extra, pos)[0]
+            sps = sps or extra[pos + 2:pos + 2 + n]
+            pos += 2 + n
+        for i in range(extra[pos]):
+            n = struct.unpack_from('>H', extra, pos + 1)[0]
+            pps = pps or extra[pos + 3:pos + 3 + n]
+            pos += 2 + n
+        return sps, pps
+    for nal in splitNalus(extra):
+        if nal[0] & 0x1F == NAL_SPS: sps = sps or nal
+        elif nal[0] & 0x1F == NAL_PPS: pps = pps or nal
+    return sps, pps
+
+
+def _box(kind, *payloads):
+    data = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(data), kind) + data
+
+
+def _fullBox(kind, version, flags, *payloads):
+    return _box(kind, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+class Fmp4Muxer(object):
+    '''將 H.264 存取單元(access unit)封裝成 Fragmented MP4, 不需解碼, 供瀏覽器的 Media Source Extensions 播放
+
+    >>> mux = Fmp4Muxer(1920, 1080)
+    >>> mux.update(nalus)                       # 由串流或 extradata 取得 SPS/PPS
+    >>> init = mux.initSegment()                # ftyp + moov, 每一觀看端先送出一次
+    >>> seg = mux.fragment(nalus, ts, key)      # moof + mdat, 每一存取單元一個片段
+
+    僅支援無 B-Frame(解碼順序即顯示順序)的串流, 監視攝影機的即時串流通常如此
+    '''
+    def __init__(self, width, height, fps=0, timescale=90000):
+        '''
+        傳入:
+            width, height : int - 影像解析度
+            fps           : float - 串流回報的 FPS, 用以估計第一個影格的長度
+            timescale     : int - 時間刻度(每秒單位數)
+        '''
+        self.width = width
+        self.height = height
+        self.timescale = timescale
+        self.sps = None
+        self.pps = None
+        self.__sequence = 0
+        self.__duration = int(timescale / fps) if fps and fps > 0 else timescale // 25
+        self.__start = None
+        self.__last = None
+
+    ready = property(fget=lambda self: bool(self.sps and self.pps), doc='是否已取得 SPS 與 PPS, 可產生初始化片段')
+
+    @property
+    def codec(self):
+        '''MSE 使用的 codecs 字串, 如 avc1.64001F'''
+        if not self.sps: return ''
+        return 'avc1.' + self.sps[1:4].hex().upper()
+
+    def update(self, nalus):
+        '''由 NAL 單元中取出 SPS 與 PPS
+        傳回:
+            bool - SPS 或 PPS 是否有變更(需重新送出初始化片段)
+        '''
+        changed = False
+        for nal in nalus:
+            kind = nal[0] & 0x1F
+            if kind == NAL_SPS and nal != self.sps:
+                self.sps, changed = nal, True
+            elif kind == NAL_PPS and nal != self.pps:
+                self.pps, changed = nal, True
+        return changed
+
+    def initSegment(self):
+        '''產生初始化片段(ftyp + moov)
+        傳回:
+            bytes
+        '''
+        w, h = self.width, self.height
+        ftyp = _box(b'ftyp', b'isom', struct.pack('>I', 0x200), b'isom', b'iso6', b'avc1', b'mp41')
+        mvhd = _fullBox(b'mvhd', 0, 0,
+                        struct.pack('>IIIIIH', 0, 0, self.timescale, 0, 0x00010000, 0x0100),
+                        bytes(10), _MATRIX, bytes(24), struct.pack('>I', 2))
+        tkhd = _fullBox(b'tkhd', 0, 3,
+                        struct.pack('>IIIII', 0, 0, 1, 0, 0), bytes(8), struct.pack('>hhhH', 0, 0, 0, 0),
+                        _MATRIX, struct.pack('>II', w << 16, h << 16))
+        mdhd = _fullBox(b'mdhd', 0, 0, struct.pack('>IIIIHH', 0, 0, self.timescale, 0, 0x55C4, 0))
+        hdlr = _fullBox(b'hdlr', 0, 0, struct.pack('>I', 0), b'vide', bytes(12), b'VideoHandler\x00')
+        vmhd = _fullBox(b'vmhd', 0, 1, struct.pack('>HHHH', 0, 0, 0, 0))
+        dinf = _box(b'dinf', _fullBox(b'dref', 0, 0, struct.pack('>I', 1), _fullBox(b'url ', 0, 1)))
+        avcC = _box(b'avcC', bytes([1, self.sps[1], self.sps[2], self.sps[3], 0xFF, 0xE1]),
+                    struct.pack('>H', len(self.sps)), self.sps,
+                    bytes([1]), struct.pack('>H', len(self.pps)), self.pps)
+        avc1 = _box(b'avc1', bytes(6), struct.pack('>H', 1), bytes(16),
+                    struct.pack('>HHIIIH', w, h, 0x00480000, 0x00480000, 0, 1), bytes(32),
+                    struct.pack('>Hh', 0x18, -1), avcC)
+        stbl = _box(b'stbl',
+                    _fullBox(b'stsd', 0, 0, struct.pack('>I', 1), avc1),
+                    _fullBox(b'stts', 0, 0, struct.pack('>I', 0)),
+                    _fullBox(b'stsc', 0, 0, struct.pack('>I', 0)),
+                    _fullBox(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+                    _fullBox(b'stco', 0, 0, struct.pack('>I', 0)))
+        minf = _box(b'minf', vmhd, dinf, stbl)
+        trak = _box(b'trak', tkhd, _box(b'mdia', mdhd, hdlr, minf))
+        mvex = _box(b'mvex', _fullBox(b'trex', 0, 0, struct.pack('>IIIII', 1, 1, 0, 0, 0)))
+        return ftyp + _box(b'moov', mvhd, trak, mvex)
+
+    def fragment(self, nalus, timestamp, keyframe):
+        '''將一個存取單元封裝成媒體片段(moof + mdat)
+        傳入:
+            nalus     : list(bytes) - 該存取單元的 NAL 單元
+            timestamp : float - 擷取時間(秒), 用以計算解碼時間
+            keyframe  : bool - 是否為關鍵影格(IDR)
+        傳回:
+            bytes
+        '''
+        if self.__start is None:
+            self.__start = timestamp
+        dts = int((timestamp - self.__start) * self.timescale)
+        if self.__last is not None:
+            if dts <= self.__last:
+                dts = self.__last + 1
+            self.__duration = dts - self.__last
+        self.__last = dts
+        self.__sequence += 1
+        # SPS/PPS 已寫入初始化片段的 avcC, 與存取單元分隔符號(AUD)一併自取樣中移除
+        data = b''.join(struct.pack('>I', len(n)) + n for n in nalus if n[0] & 0x1F not in _OUT_OF_BAND)
+        flags = _FLAGS_SYNC if keyframe else _FLAGS_NON_SYNC
+
+        def moof(offset):
+            trun = _fullBox(b'trun', 0, 0x000701, struct.pack('>IiIII', 1, offset, self.__duration, len(data), flags))
+            traf = _box(b'traf',
+                        _fullBox(b'tfhd', 0, 0x020000, struct.pack('>I', 1)),
+                        _fullBox(b'tfdt', 1, 0, struct.pack('>Q', dts)), trun)
+            return _box(b'moof', _fullBox(b'mfhd', 0, 0, struct.pack('>I', self.__sequence)), traf)
+
+        size = len(moof(0))
+        return moof(size + 8) + _box(b'mdat', data)
@@ -0,0 +1,214 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import re, struct, time
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+__all__ = ['FrameRing', 'ringName']
+
+# 共享記憶體配置:
+#   [0, 64)       全域標頭: magic:4s, version:uint16, slots:uint16, width:uint32, height:uint32,
+#                           channels:uint32, slotBytes:uint32, latest:uint64(最新已發佈的頁框序號)
+#   [64, ...)     各槽控制區, 每槽 4 個 uint64: counter(seqlock, 寫入中為奇數), seq, timestamp(float64), 保留
+#   [dataOffset,) 各槽頁框資料, 每槽 slotBytes
+_MAGIC = b'CCRB'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHHIIII')
+_HEADER_SIZE = 64
+_LATEST_OFFSET = _HEADER.size
+_CTL_WIDTH = 4
+
+
+def ringName(cameraId):
+    '''由攝影機代號產生共享記憶體名稱
+    傳入:
+        cameraId : str - 攝影機代號, 如 'A-1'
+    傳回:
+        str - 共享記憶體名稱
+    '''
+    return 'cctv_ring_' + re.sub(r'[^0-9A-Za-z_]', '_', str(cameraId))
+
+
+def _attachShm(name):
+    '''開啟已存在的共享記憶體, 且不交由本程序的 resource_tracker 管理
+
+    Python 3.13 以前, 開啟他人建立的共享記憶體也會被 resource_tracker 記錄,
+    導致本程序結束時誤將共享記憶體刪除; 與建立者共用 resource_tracker 的子程序不需使用
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        except Exception:
+            pass
+        return shm
+
+
+class FrameRing(object):
+    '''以 multiprocessing.shared_memory 實作的固定槽數頁框環狀緩衝區
+
+    每一攝影機一個環, 擷取端依序寫入各槽, 讀取端(其他程序)取用最新已完成的槽;
+    每槽以 seqlock 計數器保護, 讀取端可判斷頁框是否在讀取期間被覆寫, 不會取得撕裂(torn)的頁框
+
+    建立(寫入端):
+        >>> ring = FrameRing.create('A-1', (1080, 1920, 3))
+        >>> ring.write(frame, seq, time.time())
+    讀取端(如影像分析程序):
+        >>> ring = FrameRing.attach('A-1')
+        >>> frame, seq, ts = ring.read()     # 零複製, frame 為唯讀 numpy view
+        >>> ...                              # 處理 frame
+        >>> ring.isValid(seq)                # 確認處理期間該槽未被覆寫
+    '''
+    def __init__(self, shm, owner):
+        self.__shm = shm
+        self.owner = owner
+        magic, version, slots, width, height, channels, slotBytes = _HEADER.unpack_from(shm.buf, 0)
+        if magic != _MAGIC or version != _VERSION:
+            shm.close()
+            raise ValueError(f'"{shm.name}" is not a frame ring')
+        self.name = shm.name
+        self.slots = slots
+        self.shape = (height, width, channels) if channels > 1 else (height, width)
+        self.slotBytes = slotBytes
+        dataOffset = _HEADER_SIZE + ((slots * _CTL_WIDTH * 8 + 63) // 64) * 64
+        self.__latest = np.ndarray((1, ), dtype='<u8', buffer=shm.buf, offset=_LATEST_OFFSET)
+        self.__ctl = np.ndarray((slots, _CTL_WIDTH), dtype='<u8', buffer=shm.buf, offset=_HEADER_SIZE)
+        self.__ts = self.__ctl.view('<f8')
+        self.__data = np.ndarray((slots, ) + self.shape, dtype=np.uint8, buffer=shm.buf, offset=dataOffset)
+        if not owner:
+            # 讀取端僅能唯讀存取
+            for arr in (self.__latest, self.__ctl, self.__ts, self.__data):
+                arr.flags.writeable = False
+
+    @classmethod
+    def create(cls, cameraId, shape, slots=4):
+        '''建立頁框環(寫入端), 同名的舊環(如前次異常結束所遺留)將被移除
+        傳入:
+            cameraId : str - 攝影機代號
+            shape    : tuple - 頁框形狀 (height, width[, channels]), 依 OpenCV 回報的解析度
+            slots    : int - 槽數
+        傳回:
+            FrameRing
+        '''
+        name = ringName(cameraId)
+        height, width = shape[:2]
+        channels = shape[2] if len(shape) > 2 else 1
+        slotBytes = height * width * channels
+        size = _HEADER_SIZE + ((slots * _CTL_WIDTH * 8 + 63) // 64) * 64 + slots * slotBytes
+        try:
+            old = shared_memory.SharedMemory(name=name)
+            old.close()
+            old.unlink()
+        except FileNotFoundError:
+            pass
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:_HEADER_SIZE] = bytes(_HEADER_SIZE)
+        _HEADER.pack_into(shm.buf, 0, _MAGIC, _VERSION, slots, width, height, channels, slotBytes)
+        return cls(shm, True)
+
+    @classmethod
+    def attach(cls, cameraId):
+        '''以攝影機代號唯讀開啟既有的頁框環(讀取端)
+        傳入:
+            cameraId : str - 攝影機代號
+        傳回:
+            FrameRing
+        引發錯誤:
+            `FileNotFoundError` -- 該攝影機尚未建立頁框環
+        '''
+        return cls(_attachShm(ringName(cameraId)), False)
+
+    latest = property(fget=lambda self: int(self.__latest[0]), doc='最新已發佈的頁框序號, 0 表示尚無頁框')
+
+    def write(self, frame, seq, timestamp):
+        '''寫入頁框(僅寫入端), 序號需遞增且大於 0
+        傳入:
+            frame     : numpy.ndarray - 頁框, 形狀須與建立時相同
+            seq       : int - 頁框序號
+            timestamp : float - 擷取時間
+        '''
+        i = seq % self.slots
+        ctl = self.__ctl[i]
+        ctl[0] += 1
+        # 先使舊序號失效, 讀取端在寫入期間不會以舊序號視為有效
+        ctl[1] = 0
+        self.__data[i][...] = frame
+        ctl[1] = seq
+        self.__ts[i, 2] = timestamp
+        ctl[0] += 1
+        self.__latest[0] = seq
+
+    def read(self, copy=False, retries=8):
+        '''讀取最新的頁框
+        傳入:
+            copy    : bool - 是否複製, False 時傳回共享記憶體的唯讀 view(零複製),
+                             該 view 在之後 slots - 1 張頁框內有效, 使用完畢可以 isValid() 確認
+            retries : int - 遇到寫入中的槽時的重試次數
+        傳回:
+            tuple(frame, seq:int, timestamp:float) - 尚無頁框時 frame 為 None
+        '''
+        for _ in range(retries):
+            seq = int(self.__latest[0])
+            if seq == 0: break
+            i = seq % self.slots
+            c1 = int(self.__ctl[i, 0])
+            if c1 & 1 or int(self.__ctl[i, 1]) != seq:
+                continue
+            frame = self.__data[i].copy() if copy else self.__data[i]
+            ts = float(self.__ts[i, 2])
+            if int(self.__ctl[i, 0]) == c1:
+                return frame, seq, ts
+        return None, 0, 0.0
+
+    def readSeq(self, seq):
+        '''讀取指定序號的頁框(零複製)
+        傳回:
+            tuple(frame, counter:int) - 該槽已被覆寫或寫入中時 frame 為 None;
+                                        counter 為開始讀取時的寫入計數, 使用完畢以 isValid(seq, counter) 確認
+        '''
+        i = seq % self.slots
+        c1 = int(self.__ctl[i, 0])
+        if c1 & 1 or int(self.__ctl[i, 1]) != seq:
+            return None, c1
+        return self.__data[i], c1
+
+    def isValid(self, seq, counter=None):
+        '''確認指定序號的頁框仍完整存在於環中(未被覆寫且非寫入中)
+        傳入:
+            seq     : int - 頁框序號
+            counter : int - readSeq() 傳回的寫入計數, 傳入時另確認讀取期間該槽未曾寫入
+        '''
+        i = seq % self.slots
+        c2 = int(self.__ctl[i, 0])
+        if c2 & 1 or (counter is not None and c2 != counter):
+            return False
+        return int(self.__ctl[i, 1]) == seq and int(self.__ctl[i, 0]) == c2
+
+    def wait(self, seq=0, timeout=None, interval=0.005):
+        '''等待序號大於 seq 的頁框(供其他程序輪詢使用)
+        傳入:
+            seq      : int - 上一次取得的頁框序號
+            timeout  : float - 逾時秒數, None 表示無限等待
+            interval : float - 輪詢間隔秒數
+        傳回:
+            tuple(frame, seq:int, timestamp:float) - 逾時時 frame 為 None
+        '''
+        limit = None if timeout is None else time.time() + timeout
+        while int(self.__latest[0]) <= seq:
+            if limit is not None and time.time() >= limit:
+                return None, seq, 0.0
+            time.sleep(interval)
+        return self.read()
+
+    def close(self):
+        '''關閉頁框環, 寫入端同時移除共享記憶體'''
+        self.__latest = self.__ctl = self.__ts = self.__data = None
+        self.__shm.close()
+        if self.owner:
+            try:
+                self.__shm.unlink()
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,213 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import time, importlib
+import numpy as np
+import cv2
+
+__all__ = ['JpegEncoder', 'OpenCvJpeg', 'SimpleJpeg', 'TurboJpeg', 'BACKENDS', 'createEncoder', 'availableBackends']
+# 未指定品質時使用的壓縮品質, 與 OpenCV 預設值相同
+DEFAULT_QUALITY = 95
+# 色度抽樣(chroma subsampling)設定值
+SUBSAMPLINGS = ('444', '422', '420')
+
+
+class JpegEncoder(object):
+    '''JPEG 編碼器介面
+
+    各實作僅負責將 BGR 頁框編碼成 JPEG, 不處理解析度調整
+    '''
+    name = ''
+
+    def __init__(self, fastDct=False, subsampling=None):
+        '''
+        傳入:
+            fastDct     : bool - 使用較快(精度略低)的 DCT 演算法, 不支援的實作忽略此設定
+            subsampling : str - 色度抽樣, '444'、'422' 或 '420', None 表示使用該實作的預設值
+        '''
+        if subsampling is not None and subsampling not in SUBSAMPLINGS:
+            raise ValueError(f'subsampling must be one of {SUBSAMPLINGS}')
+        self.fastDct = fastDct
+        self.subsampling = subsampling
+
+    spec = property(fget=lambda self: (self.name, self.fastDct, self.subsampling),
+                    doc='可傳入 createEncoder(*spec) 重建相同設定的編碼器, 供編碼子程序使用')
+
+    def encode(self, frame, quality=0):
+        '''將頁框編碼成 JPEG
+        傳入:
+            frame   : numpy.ndarray - BGR(或灰階)頁框
+            quality : int - 壓縮品質, 1~100, 0 表示預設品質
+        傳回:
+            bytes - JPEG 資料, 編碼失敗時傳回 None
+        '''
+        raise NotImplementedError()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(fastDct={self.fastDct}, subsampling={self.subsampling})'
+
+
+class OpenCvJpeg(JpegEncoder):
+    '''以 cv2.imencode() 編碼, 預設的實作; OpenCV 不支援 fast DCT 設定'''
+    name = 'opencv'
+    _SAMPLING = {
+        '444': 'IMWRITE_JPEG_SAMPLING_FACTOR_444',
+        '422': 'IMWRITE_JPEG_SAMPLING_FACTOR_422',
+        '420': 'IMWRITE_JPEG_SAMPLING_FACTOR_420',
+    }
+
+    def __init__(self, fastDct=False, subsampling=None):
+        super(OpenCvJpeg, self).__init__(fastDct, subsampling)
+        self.__params = []
+        if subsampling and hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):
+            # OpenCV 4.5.5 起支援
+            self.__params = [int(cv2.IMWRITE_JPEG_SAMPLING_FACTOR), int(getattr(cv2, self._SAMPLING[subsampling]))]
+
+    def encode(self, frame, quality=0):
+        params = list(self.__params)
+        if quality:
+            params += [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        ret, image = cv2.imencode('.jpg', frame, params)
+        return image.tobytes() if ret else None
+
+
+class SimpleJpeg(JpegEncoder):
+    '''以 simplejpeg(libjpeg-turbo) 編碼, 需另行安裝: pip install simplejpeg'''
+    name = 'simplejpeg'
+
+    def __init__(self, fastDct=True, subsampling='420'):
+        super(SimpleJpeg, self).__init__(fastDct, subsampling or '420')
+        self.__lib = importlib.import_module('simplejpeg')
+
+    def encode(self, frame, quality=0):
+        if frame.ndim == 2:
+            frame = frame[:, :, None]
+            colorspace = 'GRAY'
+        else:
+            colorspace = 'BGR'
+        if not frame.flags['C_CONTIGUOUS']:
+            frame = np.ascontiguousarray(frame)
+        return self.__lib.encode_jpeg(frame, quality=quality or DEFAULT_QUALITY, colorspace=colorspace,
+                                      colorsubsampling=self.subsampling, fastdct=self.fastDct)
+
+
+class TurboJpeg(JpegEncoder):
+    '''以 PyTurboJPEG(libjpeg-turbo) 編碼, 需另行安裝 libturbojpeg 與 pip install PyTurboJPEG'''
+    name = 'turbojpeg'
+
+    def __init__(self, fastDct=True, subsampling='420'):
+        super(TurboJpeg, self).__init__(fastDct, subsampling or '420')
+        lib = importlib.import_module('turbojpeg')
+        self.__jpeg = lib.TurboJPEG()
+        self.__subsample = getattr(lib, f'TJSAMP_{self.subsampling}')
+        self.__flags = lib.TJFLAG_FASTDCT if fastDct else 0
+        self.__gray = lib.TJPF_GRAY
+
+    def encode(self, frame, quality=0):
+        if not frame.flags['C_CONTIGUOUS']:
+            frame = np.ascontiguousarray(frame)
+        if frame.ndim == 2:
+            return self.__jpeg.encode(frame[:, :, None], quality=quality or DEFAULT_QUALITY,
+                                      pixel_format=self.__gray, jpeg_subsample=self.__subsample, flags=self.__flags)
+        return self.__jpeg.encode(frame, quality=quality or DEFAULT_QUALITY,
+                                  jpeg_subsample=self.__subsample, flags=self.__flags)
+
+
+BACKENDS = {cls.name: cls for cls in (OpenCvJpeg, SimpleJpeg, TurboJpeg)}
+
+
+def createEncoder(backend='opencv', fastDct=None, subsampling=None):
+    '''建立 JPEG 編碼器
+    傳入:
+        backend     : str - 'opencv'、'simplejpeg'、'turbojpeg' 或 'auto'(優先使用已安裝的 libjpeg-turbo 實作)
+        fastDct     : bool - 使用 fast DCT, None 表示使用該實作的預設值
+        subsampling : str - 色度抽樣, '444'、'422' 或 '420', None 表示使用該實作的預設值
+    傳回:
+        JpegEncoder
+    引發錯誤:
+        `KeyError` -- 不支援的實作名稱
+        `ImportError` -- 該實作所需的模組未安裝
+    '''
+    if backend == 'auto':
+        names = availableBackends()
+        backend = next((n for n in ('simplejpeg', 'turbojpeg') if n in names), 'opencv')
+    cls = BACKENDS[backend]
+    kwargs = {}
+    if fastDct is not None: kwargs['fastDct'] = fastDct
+    if subsampling is not None: kwargs['subsampling'] = subsampling
+    return cls(**kwargs)
+
+
+def availableBackends():
+    '''傳回可使用(相關模組已安裝)的實作名稱
+    傳回:
+        list(str)
+    '''
+    names = []
+    for name, cls in BACKENDS.items():
+        try:
+            cls()
+        except (ImportError, OSError, RuntimeError):
+            continue
+        names.append(name)
+    return names
+
+
+def _syntheticFrame(width, height):
+    '''產生近似監視畫面的測試頁框: 平滑漸層背景、幾何圖形與少量雜訊'''
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    frame = np.dstack([(x + y) / 2, np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width))])
+    frame = frame.astype(np.uint8)
+    for i in range(12):
+        cx, cy = (i * 97) % width, (i * 61) % height
+        cv2.rectangle(frame, (cx, cy), (cx + width // 8, cy + height // 10), (i * 20, 255 - i * 20, 128), -1)
+        cv2.putText(frame, f'CAM-{i:02}', (cx, cy), cv2.FONT_HERSHEY_SIMPLEX, height / 720, (255, 255, 255), 2)
+    noise = np.random.default_rng(0).integers(0, 8, frame.shape, dtype=np.uint8)
+    return cv2.add(frame, noise)
+
+
+def benchmark(resolutions=((320, 240), (640, 480), (1280, 720), (1920, 1080)), quality=70, seconds=1.0):
+    '''比較各實作(含 fast DCT 與色度抽樣組合)於常用解析度的編碼速度與大小
+    傳入:
+        resolutions : list(tuple) - 測試解析度
+        quality     : int - 壓縮品質
+        seconds     : float - 每一組合的測試秒數
+    傳回:
+        list(dict) - 每一組合的 backend、fastDct、subsampling、resolution、fps、ms、bytes
+    '''
+    configs = [('opencv', False, None), ('opencv', False, '420'), ('opencv', False, '444')]
+    for name in ('simplejpeg', 'turbojpeg'):
+        for fastDct in (False, True):
+            for sub in ('420', '444'):
+                configs.append((name, fastDct, sub))
+    names = availableBackends()
+    results = []
+    for w, h in resolutions:
+        frame = _syntheticFrame(w, h)
+        for name, fastDct, sub in configs:
+            if name not in names: continue
+            enc = createEncoder(name, fastDct, sub)
+            size = len(enc.encode(frame, quality))
+            count, start = 0, time.perf_counter()
+            while True:
+                enc.encode(frame, quality)
+                count += 1
+                spent = time.perf_counter() - start
+                if spent >= seconds: break
+            results.append({
+                'backend': name, 'fastDct': fastDct, 'subsampling': sub or 'default',
+                'resolution': f'{w}x{h}', 'fps': count / spent, 'ms': spent / count * 1000, 'bytes': size,
+            })
+    return results
+
+
+if __name__ == "__main__":
+    import sys
+    args = sys.argv[1:]
+    seconds = float(args[0]) if args else 1.0
+    print(f'Available backends: {", ".join(availableBackends())}')
+    print(f'{"Resolution":<11} {"Backend":<11} {"FastDCT":<8} {"Sub":<8} {"ms":>8} {"FPS":>8} {"Bytes":>9}')
+    for r in benchmark(seconds=seconds):
+        print(f"{r['resolution']:<11} {r['backend']:<11} {str(r['fastDct']):<8} {r['subsampling']:<8} "
+              f"{r['ms']:>8.2f} {r['fps']:>8.1f} {r['bytes']:>9}")
@@ -0,0 +1,197 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import threading, time
+from bisect import bisect_left
+from collections import deque
+import numpy as np
+
+__all__ = ['LatencyHistogram', 'LatencyTracker', 'ShardedCounter', 'CallTimer', 'STAGES', 'BUCKETS', 'CALL_BUCKETS']
+# 頁框處理的各階段(秒):
+#   decode : OpenCV 解碼(retrieve)耗時
+#   resize : 直接轉送 JPEG 的解碼與縮小金字塔耗時
+#   encode : JPEG 編碼耗時(含編碼器內最後一次縮放), 僅計入未命中快取者
+#   ready  : 擷取至打包完成(等待處理、縮放與編碼, 或等待其他觀看端的編碼結果)
+#   send   : 打包完成至寫入 socket 完成(傳送佇列等待與寫入)
+#   display: 寫入 socket 完成至收到終端顯示回報(網路傳輸、瀏覽器解碼與繪製, 另含回報的上傳時間)
+#   paint  : 終端回報的收到訊息至繪製完成耗時
+#   total  : 擷取至收到終端顯示回報(M-Jpeg 無顯示回報, 為擷取至寫入完成)
+STAGES = ('decode', 'resize', 'encode', 'ready', 'send', 'display', 'paint', 'total')
+# 累計直方圖的區間上限(秒), 與 Prometheus histogram 的 le 相同
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 外部呼叫(ONVIF、WS-Discovery 等網路操作)的區間上限(秒)
+CALL_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class ShardedCounter(object):
+    '''以執行緒分片的累加計數器
+
+    每一執行緒只寫入自己的分片(單一寫入者), 不需加鎖, 可於每張頁框的處理迴圈中使用; 讀取時加總所有分片
+    '''
+    def __init__(self):
+        self.__shards = {}
+
+    def add(self, value=1):
+        '''累加 value'''
+        key = threading.get_ident()
+        self.__shards[key] = self.__shards.get(key, 0) + value
+
+    value = property(fget=lambda self: sum(list(self.__shards.values())), doc='目前的累計值')
+
+
+class _Shard(object):
+    '''LatencyHistogram 單一執行緒的分片'''
+    __slots__ = ['counts', 'count', 'sum', 'max']
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+class LatencyHistogram(object):
+    '''延遲直方圖
+
+    累計各區間的次數與總和(供匯出), 另保留最近 window 筆樣本計算 p50/p95/p99, 反映目前的延遲而非啟動以來的平均;
+    累計值依執行緒分片(請參閱 ShardedCounter), 記錄時不需加鎖
+    '''
+    def __init__(self, buckets=BUCKETS, window=512):
+        '''
+        傳入:
+            buckets : tuple(float) - 區間上限(秒), 由小至大
+            window  : int - 計算百分位數的樣本數
+        '''
+        self.buckets = tuple(buckets)
+        self.__shards = {}
+        self.__recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        '''記錄一筆延遲(秒), 負值(時鐘誤差)以 0 計'''
+        seconds = max(0.0, seconds)
+        key = threading.get_ident()
+        shard = self.__shards.get(key)
+        if shard is None:
+            shard = self.__shards[key] = _Shard(len(self.buckets) + 1)
+        shard.counts[bisect_left(self.buckets, seconds)] += 1
+        shard.count += 1
+        shard.sum += seconds
+        if seconds > shard.max: shard.max = seconds
+        self.__recent.append(seconds)
+
+    count = property(fget=lambda self: sum(s.count for s in list(self.__shards.values())), doc='累計筆數')
+    sum = property(fget=lambda self: sum(s.sum for s in list(self.__shards.values())), doc='累計秒數')
+    max = property(fget=lambda self: max([s.max for s in list(self.__shards.values())] or [0.0]), doc='最大值(秒)')
+
+    @property
+    def counts(self):
+        '''各區間的次數(非累計), 最後一筆為超過最大區間者'''
+        counts = [0] * (len(self.buckets) + 1)
+        for shard in list(self.__shards.values()):
+            for i, n in enumerate(shard.counts):
+                counts[i] += n
+        return counts
+
+    def percentiles(self, ps=(50, 95, 99)):
+        '''最近樣本的百分位數
+        傳回:
+            list(float) - 秒, 無樣本時皆為 0
+        '''
+        recent = list(self.__recent)
+        if not recent: return [0.0] * len(ps)
+        return [float(v) for v in np.percentile(recent, ps)]
+
+    def cumulative(self):
+        '''累計次數, 格式為 [(le, count), ...], 最後一筆的 le 為 float('inf')'''
+        counts = self.counts
+        total, result = 0, []
+        for le, n in zip(self.buckets + (float('inf'), ), counts):
+            total += n
+            result.append((le, total))
+        return result
+
+    @property
+    def stats(self):
+        '''統計資料(毫秒), 格式為 {'count', 'mean', 'p50', 'p95', 'p99', 'max'}'''
+        p50, p95, p99 = self.percentiles()
+        count = self.count
+        return {
+            'count': count, 'mean': self.sum / count * 1000 if count else 0.0,
+            'p50': p50 * 1000, 'p95': p95 * 1000, 'p99': p99 * 1000, 'max': self.max * 1000,
+        }
+
+
+class LatencyTracker(object):
+    '''一組處理階段的延遲直方圖與丟棄頁框數
+
+    觀看端的記錄同時累計至 parent(該攝影機), 可分別查詢每一觀看端與每一攝影機的延遲
+    '''
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.histograms = {}
+        self.__dropped = ShardedCounter()
+        self.__lock = threading.Lock()
+
+    dropped = property(fget=lambda self: self.__dropped.value, doc='未送達觀看端的頁框數')
+
+    def observe(self, stage, seconds):
+        '''記錄一筆階段延遲(秒)
+        傳入:
+            stage   : str - 階段名稱, 請參閱 STAGES
+            seconds : float - 延遲秒數
+        '''
+        hist = self.histograms.get(stage)
+        if hist is None:
+            with self.__lock:
+                hist = self.histograms.setdefault(stage, LatencyHistogram())
+        hist.observe(seconds)
+        if self.parent: self.parent.observe(stage, seconds)
+
+    def drop(self, count=1):
+        '''記錄未送達觀看端的頁框數'''
+        if count <= 0: return
+        self.__dropped.add(count)
+        if self.parent: self.parent.drop(count)
+
+    @property
+    def stats(self):
+        '''統計資料, 格式為 {'dropped': int, 'stages': {階段: LatencyHistogram.stats}}, 依 STAGES 順序'''
+        order = {s: i for i, s in enumerate(STAGES)}
+        stages = sorted(self.histograms.items(), key=lambda kv: order.get(kv[0], len(order)))
+        return {'dropped': self.dropped, 'stages': {k: h.stats for k, h in stages}}
+
+
+class CallTimer(object):
+    '''依操作名稱統計外部呼叫(如 ONVIF、WS-Discovery)的耗時與失敗次數'''
+    def __init__(self, buckets=CALL_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self.errors = {}
+        self.__lock = threading.Lock()
+
+    def call(self, op, func, *args, **kwargs):
+        '''執行 func 並記錄耗時, 引發例外時計入失敗次數後再次引發
+        傳入:
+            op   : str - 操作名稱, 如 'GetProfiles'
+            func : def - 欲執行的函式
+        傳回:
+            func 的傳回值
+        '''
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self.__lock:
+                self.errors[op] = self.errors.get(op, 0) + 1
+            raise
+        finally:
+            hist = self.histograms.get(op)
+            if hist is None:
+                with self.__lock:
+                    hist = self.histograms.setdefault(op, LatencyHistogram(self.buckets))
+            hist.observe(time.perf_counter() - start)
+
+    @property
+    def stats(self):
+        '''統計資料, 格式為 {操作名稱: dict(LatencyHistogram.stats, errors=int)}'''
+        return {op: dict(h.stats, errors=self.errors.get(op, 0)) for op, h in list(self.histograms.items())}
@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import threading
+from .captureHub import hub, SourceState
+from .latency import STAGES
+
+__all__ = ['collector']
+# 度量名稱前綴
+PREFIX = 'cctv'
+
+
+def _histogram(name, doc, items):
+    '''將 LatencyHistogram 轉為 Prometheus histogram
+    傳入:
+        items : list(tuple(labels:dict, LatencyHistogram))
+    '''
+    samples = []
+    for labels, hist in items:
+        for le, count in hist.cumulative():
+            samples.append(('_bucket', dict(labels, le='+Inf' if le == float('inf') else repr(le)), count))
+        samples.append(('_sum', labels, hist.sum))
+        samples.append(('_count', labels, hist.count))
+    return (name, 'histogram', doc, samples)
+
+
+def _sources():
+    '''每一擷取來源(攝影機與組合畫面)的度量'''
+    sources = hub.snapshot()
+    rows = [({'camera': src.cameraId}, src) for src in sources]
+
+    def family(name, kind, doc, value):
+        return (f'{PREFIX}_{name}', kind, doc, [('', labels, value(src)) for labels, src in rows])
+
+    order = {s: i for i, s in enumerate(STAGES)}
+    stages = []
+    for labels, src in rows:
+        items = sorted(list(src.latency.histograms.items()), key=lambda kv: order.get(kv[0], len(order)))
+        stages += [(dict(labels, stage=stage), hist) for stage, hist in items]
+    return [
+        (f'{PREFIX}_source_state', 'gauge', 'Capture state of the source, 1 for the current state',
+         [('', dict(labels, state=state.value), int(src.state == state)) for labels, src in rows for state in SourceState]),
+        family('source_subscribers', 'gauge', 'Number of subscribers sharing the capture', lambda s: s.refs),
+        family('source_fps', 'gauge', 'Measured decode frame rate', lambda s: s.decodeFps),
+        family('source_grab_fps', 'gauge', 'Measured stream read frame rate, including frames not decoded', lambda s: s.measuredFps),
+        family('source_frames_grabbed_total', 'counter', 'Frames read from the stream', lambda s: s.grabbed),
+        family('source_frames_decoded_total', 'counter', 'Frames decoded', lambda s: s.decoded),
+        family('source_frames_skipped_total', 'counter', 'Frames grabbed but not decoded (no demand)', lambda s: s.skipped),
+        family('source_reconnects_total', 'counter', 'Stream reconnects', lambda s: s.reconnects),
+        family('source_failures', 'gauge', 'Consecutive connect failures', lambda s: s.failures),
+        family('encode_cache_hits_total', 'counter', 'Encoded frames served from the cache', lambda s: s.cache.hits),
+        family('encode_cache_misses_total', 'counter', 'Frames encoded on a cache miss', lambda s: s.cache.misses),
+        family('bytes_sent_total', 'counter', 'Bytes written to all viewers of the source', lambda s: s.bytesSent.value),
+        family('frames_dropped_total', 'counter', 'Frames not delivered to viewers', lambda s: s.latency.dropped),
+        _histogram(f'{PREFIX}_stage_seconds', 'Frame latency by processing stage, see latency.STAGES', stages),
+    ]
+
+
+def _clients(proxy):
+    '''觀看端數量, 依通訊協定分類'''
+    counts = {}
+    if proxy:
+        for clt in list(proxy.clients):
+            protocol = str(clt.get('protocol', 1))
+            counts[protocol] = counts.get(protocol, 0) + 1
+    from .rtspProxy import HttpMJpegPusher
+    counts['mjpeg'] = len(HttpMJpegPusher.active)
+    return [(f'{PREFIX}_clients', 'gauge', 'Connected viewers by protocol',
+             [('', {'protocol': p}, n) for p, n in sorted(counts.items())])]
+
+
+def _threads():
+    '''執行緒數量, 依類別名稱分類'''
+    counts = {}
+    for t in threading.enumerate():
+        kind = type(t).__name__
+        counts[kind] = counts.get(kind, 0) + 1
+    return [(f'{PREFIX}_threads', 'gauge', 'Live threads by class', [('', {'kind': k}, n) for k, n in sorted(counts.items())])]
+
+
+def _pool(pool):
+    '''JPEG 編碼子程序的工作量'''
+    if not pool: return []
+    stats = pool.stats()
+    rows = [({'worker': str(st['worker'])}, st) for st in stats]
+    return [
+        (f'{PREFIX}_encode_worker_jobs_total', 'counter', 'JPEG encode jobs per worker',
+         [('', labels, st['jobs']) for labels, st in rows]),
+        (f'{PREFIX}_encode_worker_errors_total', 'counter', 'JPEG encode errors per worker',
+         [('', labels, st['errors']) for labels, st in rows]),
+        (f'{PREFIX}_encode_worker_busy_seconds_total', 'counter', 'Time spent encoding per worker',
+         [('', labels, st['busy']) for labels, st in rows]),
+    ]
+
+
+def _calls(agent):
+    '''ONVIF 與 WS-Discovery 呼叫的耗時與失敗次數'''
+    timer = agent.timer if agent and hasattr(agent, 'timer') else None
+    if timer is None: return []
+    items = sorted(list(timer.histograms.items()))
+    return [
+        _histogram(f'{PREFIX}_onvif_call_seconds', 'Duration of discovery and ONVIF calls',
+                   [({'op': op}, hist) for op, hist in items]),
+        (f'{PREFIX}_onvif_call_errors_total', 'counter', 'Failed discovery and ONVIF calls',
+         [('', {'op': op}, timer.errors.get(op, 0)) for op, hist in items]),
+    ]
+
+
+def collector(proxy=None, agent=None, pool=None):
+    '''建立供 webSvc.Metrics.register() 使用的收集函式
+
+    所有數值於讀取時才由各物件現有的計數取得, 熱路徑上的計數為單一寫入者或依執行緒分片(latency.ShardedCounter)
+    傳入:
+        proxy : RtspProxy - WebSocket 串流代理, None 表示不統計其觀看端
+        agent : CCTV_Agent - 攝影機探索代理, 提供 ONVIF 呼叫耗時
+        pool  : EncodePool - JPEG 編碼子程序池
+    傳回:
+        def - 無參數, 傳回度量資料, 請參閱 webSvc.Metrics.register()
+    '''
+    def collect():
+        return _sources() + _clients(proxy) + _threads() + _pool(pool) + _calls(agent)
+    return collect
@@ -0,0 +1,234 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import math, threading, time
+import numpy as np
+from urllib.parse import urlsplit, parse_qsl
+from .captureHub import CaptureSource, SourceState
+
+__all__ = ['MosaicSource', 'parseLayout', 'mosaicUrl']
+# 組合畫面的緩衝區數量: 觀看端編碼中的頁框不可被覆寫, 輪流寫入各緩衝區
+_BUFFERS = 3
+
+
+def parseLayout(url):
+    '''解析組合畫面網址
+    傳入:
+        url : str - 格式為 'mosaic:A-1,A-2,,A-4?grid=2x2&size=1280x720&fps=15',
+                    路徑為以逗號分隔的攝影機代號(空白表示空格子), 查詢參數皆可省略:
+                    grid 預設為容納所有格子的最小正方格, size 預設 4 格以下為 1280x720、其餘為 1920x1080, fps 預設 25
+    傳回:
+        tuple(ids:list(str), grid:tuple(cols, rows), size:tuple(width, height), fps:float)
+    引發錯誤:
+        `ValueError` -- 網址格式錯誤
+    '''
+    parts = urlsplit(url)
+    if parts.scheme.lower() != 'mosaic':
+        raise ValueError(f'not a mosaic url: {url}')
+    ids = [i.strip() for i in parts.path.split(',')]
+    query = dict(parse_qsl(parts.query))
+
+    def pair(name, default):
+        if name not in query: return default
+        w, h = (int(v) for v in query[name].lower().split('x'))
+        if w <= 0 or h <= 0: raise ValueError(f'invalid {name}: {query[name]}')
+        return w, h
+
+    cols = math.ceil(math.sqrt(len(ids)))
+    grid = pair('grid', (cols, math.ceil(len(ids) / cols)))
+    size = pair('size', (1280, 720) if grid[0] * grid[1] <= 4 else (1920, 1080))
+    fps = float(query.get('fps', 25))
+    if fps <= 0: raise ValueError(f'invalid fps: {fps}')
+    return ids[:grid[0] * grid[1]], grid, (size[0] & ~1, size[1] & ~1), fps
+
+
+def mosaicUrl(ids, grid=None, size=None, fps=None):
+    '''產生組合畫面網址, 請參閱 parseLayout()
+    傳入:
+        ids  : list(str) - 攝影機代號, 空字串或 None 表示空格子
+        grid : tuple | str - (cols, rows) 或 'COLSxROWS', None 表示自動
+        size : tuple | str - 畫面解析度 (width, height) 或 'WxH', None 表示自動
+        fps  : float - 組合畫面的最高更新頻率, None 表示預設值
+    傳回:
+        str
+    '''
+    pair = lambda v: v if isinstance(v, str) else f'{v[0]}x{v[1]}'
+    query = []
+    if grid: query.append(f'grid={pair(grid)}')
+    if size: query.append(f'size={pair(size)}')
+    if fps: query.append(f'fps={fps}')
+    url = 'mosaic:' + ','.join(i or '' for i in ids)
+    return url + ('?' + '&'.join(query) if query else '')
+
+
+class _Cell(object):
+    '''組合畫面中的一格'''
+    __slots__ = ['id', 'rect', 'source', 'seq', 'image', 'inner', 'size', 'updates']
+
+    def __init__(self, cameraId, rect):
+        self.id = cameraId
+        # 格子在畫面中的位置 (x, y, w, h), 與維持長寬比後實際繪製的範圍
+        self.rect = rect
+        self.inner = rect
+        self.size = None
+        self.source = None
+        self.seq = 0
+        self.image = None
+        self.updates = 0
+
+
+class MosaicSource(CaptureSource):
+    '''多攝影機組合畫面, 由 CaptureHub.subscribe('mosaic:...') 建立
+
+    訂閱每一格的攝影機, 於預先配置的畫布上以 numpy 切片指派貼上各攝影機最新的縮小頁框,
+    每一格只在該攝影機有新頁框時更新(依各自的速率), 組合後的畫面以一般擷取來源的介面提供,
+    RtspProxy 與 HttpMJpegPusher 不需修改即可將整面牆以單一串流送出, 顯示端只需解碼一個串流
+
+    縮小使用各攝影機來源的縮小金字塔與快取, 與同時觀看單一攝影機的觀看端共用
+    '''
+    def __init__(self, url, key=None, hub=None, packets=False):
+        super(MosaicSource, self).__init__(url, key, hub, packets)
+        self.ids, self.grid, self.resolution, self.maxFps = parseLayout(url)
+        self.fps = self.maxFps
+        self.live = True
+        self.composed = 0
+        self.blits = 0
+        cols, rows = self.grid
+        w, h = self.resolution
+        self.__cells = []
+        for i, cid in enumerate(self.ids):
+            c, r = i % cols, i // cols
+            x, y = (c * w // cols) & ~1, (r * h // rows) & ~1
+            self.__cells.append(_Cell(cid, (x, y, ((c + 1) * w // cols - x) & ~1, ((r + 1) * h // rows - y) & ~1)))
+        self.__buffers = [np.zeros((h, w, 3), np.uint8) for i in range(_BUFFERS)]
+        # 各緩衝區中每一格目前的內容 (seq, inner), 只重貼有變動的格子
+        self.__marks = [[None] * len(self.__cells) for i in range(_BUFFERS)]
+        self.__next = 0
+        self.__demand = {}
+        self.__wake = threading.Event()
+
+    cameraId = property(fget=lambda self: self.key, doc='組合畫面以網址識別')
+
+    def run(self):
+        if self.packets:
+            # 組合畫面須解碼後重新編碼, 無法提供 H.264 封包
+            self.unsupported = 'mosaic'
+            self._setState(SourceState.BACKOFF, 'packets not supported')
+            self.__wake.wait()
+            self._setState(SourceState.STOPPED)
+            return
+        try:
+            self.__open()
+            self._setState(SourceState.LIVE)
+            interval = 1.0 / self.maxFps
+            last = 0.0
+            while not self.stopped:
+                now = time.time()
+                if now >= self.__due() and self.__compose():
+                    self._publish(self.__buffers[self.__next], now)
+                    self.__next = (self.__next + 1) % _BUFFERS
+                    if last:
+                        fps = 1.0 / max(now - last, 1e-3)
+                        self.measuredFps = fps if not self.measuredFps else self.measuredFps * 0.9 + fps * 0.1
+                    last = now
+                self.__wake.wait(max(0.0, now + interval - time.time()))
+        finally:
+            self.__close()
+            self._setState(SourceState.STOPPED)
+
+    def stop(self):
+        super(MosaicSource, self).stop()
+        self.__wake.set()
+
+    def __open(self):
+        '''訂閱每一格的攝影機, 未登錄的代號保留為空格子'''
+        due = self.__due()
+        for cell in self.__cells:
+            url = self.hub.urlOf(cell.id) if self.hub and cell.id else None
+            if not url: continue
+            cell.source = self.hub.subscribe(url)
+            cell.source.demand(self, due)
+
+    def __close(self):
+        for cell in self.__cells:
+            if cell.source is None: continue
+            cell.source.demand(self, None)
+            self.hub.unsubscribe(cell.source)
+            cell.source = None
+
+    def __compose(self):
+        '''取得各格的新頁框, 貼到下一個緩衝區
+        傳回:
+            bool - 是否有任何一格更新
+        '''
+        updated = False
+        for cell in self.__cells:
+            src = cell.source
+            if src is None or src.seq <= cell.seq: continue
+            frame, seq, ts = src.latestFrame(cell.seq, 0)
+            if frame is None: continue
+            image = self.__fit(cell, src, frame, seq)
+            if image is None: continue
+            cell.image, cell.seq = image, seq
+            cell.updates += 1
+            updated = True
+        if not updated: return False
+        canvas, marks = self.__buffers[self.__next], self.__marks[self.__next]
+        for i, cell in enumerate(self.__cells):
+            if cell.image is None or marks[i] == (cell.seq, cell.inner): continue
+            if marks[i] is None or marks[i][1] != cell.inner:
+                # 來源解析度改變(或首次繪製), 先清除整格的黑邊
+                x, y, w, h = cell.rect
+                canvas[y:y + h, x:x + w] = 0
+            x, y, w, h = cell.inner
+            canvas[y:y + h, x:x + w] = cell.image
+            marks[i] = (cell.seq, cell.inner)
+            self.blits += 1
+        self.composed += 1
+        return True
+
+    def __fit(self, cell, src, frame, seq):
+        '''將頁框等比例縮小至格子內(置中, 其餘為黑邊)'''
+        image = src.decode(frame, seq)
+        if image is None: return None
+        size = (image.shape[1], image.shape[0])
+        if size != cell.size:
+            x, y, w, h = cell.rect
+            scale = min(w / size[0], h / size[1])
+            iw, ih = min(w, int(size[0] * scale + 0.5) & ~1), min(h, int(size[1] * scale + 0.5) & ~1)
+            cell.size, cell.inner = size, (x + (w - iw) // 2 & ~1, y + (h - ih) // 2 & ~1, iw, ih)
+        image = src.scaled(image, seq, cell.inner[2:])
+        if image is None or image.ndim != 3: return None
+        return image
+
+    def demand(self, subscriber, due=0.0):
+        '''記錄組合畫面的觀看端需求, 並轉告各格的攝影機, 使其略過無人需要的頁框解碼'''
+        super(MosaicSource, self).demand(subscriber, due)
+        if due is None:
+            self.__demand.pop(id(subscriber), None)
+        else:
+            self.__demand[id(subscriber)] = due
+        due = self.__due()
+        for cell in self.__cells:
+            if cell.source: cell.source.demand(self, due)
+
+    def __due(self):
+        demand = list(self.__demand.values())
+        return min(demand) if demand else 0.0
+
+    def checkStall(self, now, timeout):
+        '''組合畫面不直接讀取串流, 由各格的攝影機來源各自處理卡住與重新連線'''
+        return False
+
+    @property
+    def stats(self):
+        '''組合畫面統計資料, 另含各格的攝影機代號、狀態與更新次數'''
+        stats = super(MosaicSource, self).stats
+        stats.update({
+            'grid': self.grid, 'composed': self.composed, 'blits': self.blits,
+            'cells': [{
+                'id': cell.id, 'state': cell.source.state.value if cell.source else '',
+                'updates': cell.updates, 'fps': cell.source.rate if cell.source else 0,
+            } for cell in self.__cells],
+        })
+        return stats
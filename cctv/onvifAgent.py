@@ -6,6 +6,7 @@ from queue import Queue
 from wsdiscovery import WSDiscovery, QName
 from onvif import ONVIFCamera, ONVIFError
 from urllib.parse import urlparse
+from .latency import CallTimer
 
 ONVIF_TYPE_NVT = QName('http://www.onvif.org/ver10/network/wsdl', 'NetworkVideoTransmitter')
 DEF_AUTHS = [('', ''), ('admin', ''), ('admin', 'admin')]
@@ -33,6 +34,8 @@ class OnvifAgent(object):
             ipc['SvcUrl'] = 'http://{}{}/onvif/device_service'.format(
                 ipc["IP"], f':{ipc["Port"]}' if ipc['Port'] and ipc['Port'] != 80 else '')
         self.__started = False
+        # WS-Discovery 與 ONVIF 呼叫的耗時與失敗次數
+        self.timer = CallTimer()
         self.__seenSvcs = []
         self.__camInfo = []
         if log:
@@ -55,7 +58,7 @@ class OnvifAgent(object):
         try:
             wsd = WSDiscovery()
             wsd.start()
-            services = wsd.searchServices(types=[ONVIF_TYPE_NVT], timeout=timeout)
+            services = self.timer.call('WSDiscovery', wsd.searchServices, types=[ONVIF_TYPE_NVT], timeout=timeout)
         except Exception as ex:
             self.log.error(f'WS-Discovery Error:{ex}')
             return svcs
@@ -112,7 +115,7 @@ class OnvifAgent(object):
             if authed: break
             # Try get Camera Info
             try:
-                mycam = ONVIFCamera(ip, port, authinfo[0], authinfo[1])
+                mycam = self.timer.call('Connect', ONVIFCamera, ip, port, authinfo[0], authinfo[1])
             except:
                 continue
             # Get Host Name
@@ -123,9 +126,9 @@ class OnvifAgent(object):
             res['pwd'] = authinfo[1]
             # Get Profiles
             try:
-                svc = mycam.create_media_service()
-                profiles = svc.GetProfiles()
-                vsc = svc.GetVideoSourceConfigurations()
+                svc = self.timer.call('CreateMediaService', mycam.create_media_service)
+                profiles = self.timer.call('GetProfiles', svc.GetProfiles)
+                vsc = self.timer.call('GetVideoSourceConfigurations', svc.GetVideoSourceConfigurations)
                 if vsc and len(vsc) != 0:
                     res['source'] = {
                         'name': vsc[0].Name,
@@ -149,7 +152,7 @@ class OnvifAgent(object):
                     params = svc.create_type('GetStreamUri')
                     params.ProfileToken = pf.token
                     params.StreamSetup = {'Stream': 'RTP-Unicast', 'Transport': {'Protocol': 'RTSP'}}
-                    resp = svc.GetStreamUri(params)
+                    resp = self.timer.call('GetStreamUri', svc.GetStreamUri, params)
                     d['url'] = resp.Uri
                 except:
                     pass
@@ -251,7 +254,7 @@ class OnvifAgent(object):
         _auth = False
         _name = None
         try:
-            resp = mycam.devicemgmt.GetHostname()
+            resp = self.timer.call('GetHostname', mycam.devicemgmt.GetHostname)
             if resp.Name:
                 _name = str(resp.Name)
             _auth = True
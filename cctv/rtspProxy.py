@@ -3,14 +3,48 @@
 
 # Ref.: https://www.itread01.com/content/1547446926.html
 
-import os, threading, time, cv2, base64, types, json, re
+import threading, time, logging, base64, types, json, re, struct, socket
+from collections import deque, OrderedDict
+import numpy as np
+import cv2
+from email.utils import formatdate, parsedate_to_datetime
+from http import HTTPStatus
 from websocket_server import WebsocketServer, WebSocketHandler
 from socketserver import TCPServer
+from .captureHub import hub, canonicalUrl, FramePacer, SourceState, _EncodeCache, _isPacket, _cropRect
+from .fmp4 import Fmp4Muxer, splitNalus, parseExtradata, NAL_IDR
+from .latency import LatencyTracker
 
 
-__all__ = ['RtspProxy', 'HttpMJpegPusher']  
-# 設定 OpenCV 的 VideoCapture() 拉 RTSP 流時，使用 UDP....... ?? (未驗證)
-os.environ["OPENCV_FFMPEG_CAPTURE_OPTIONS"] = "rtsp_transport;udp"
+__all__ = ['RtspProxy', 'HttpMJpegPusher', 'HttpSnapshot', 'RESOLUTION_BUCKETS', 'PROTOCOL_TEXT', 'PROTOCOL_BINARY', 'PROTOCOL_FMP4', 'PROTOCOL_TILES',
+           'FRAME_HEADER', 'TILE_HEADER', 'TILE_ENTRY']
+# 建議使用的輸出解析度級距, 可傳入 RtspProxy(buckets=...) 以提高編碼快取命中率
+RESOLUTION_BUCKETS = [(320, 240), (640, 480), (1280, 720), (1920, 1080)]
+# WebSocket 傳輸協定版本
+#   1: 舊版文字協定, 先送出 "::封包數::" 再送出以 "~序號~" 開頭、每段 32KB 的 base64 字串
+#   2: 二進位協定, 每張 JPEG 一個 Binary Message, 前置固定長度的 FRAME_HEADER
+#   3: H.264 轉封裝, 不解碼、不重新編碼, 以 Fragmented MP4 片段(Binary Message)供瀏覽器的 MSE 播放;
+#      先送出 {"act": "init", "codec": ...} 文字訊息, 之後的第一個片段前置初始化片段(ftyp + moov)
+#   4: 分塊差異, 與 v2 相同的 FRAME_HEADER 之後為 TILE_HEADER 與各分塊(TILE_ENTRY + JPEG),
+#      僅送出與該觀看端上一次畫面不同的分塊, flags 含 TILE_KEY 時為完整頁框
+PROTOCOL_TEXT = 1
+PROTOCOL_BINARY = 2
+PROTOCOL_FMP4 = 3
+PROTOCOL_TILES = 4
+# 二進位協定頁框標頭(Big-Endian, 16 Bytes):
+#   version:uint8, flags:uint8, camera:uint16, seq:uint32, timestamp:float64(擷取時間, 秒)
+FRAME_HEADER = struct.Struct('!BBHId')
+# 分塊差異協定: 畫面 width:uint16, height:uint16, 分塊數 count:uint16;
+#   每一分塊 x:uint16, y:uint16, w:uint16, h:uint16, length:uint32(JPEG 長度) 之後接 JPEG 內容
+TILE_HEADER = struct.Struct('!HHH')
+TILE_ENTRY = struct.Struct('!HHHHI')
+TILE_KEY = 0x01
+# WebSocket 訊框操作碼
+_OPCODE_TEXT = 0x1
+_OPCODE_BINARY = 0x2
+_OPCODE_CLOSE = 0x8
+_OPCODE_PING = 0x9
+_OPCODE_PONG = 0xA
 
 
 def _parse_headers(had):
@@ -18,6 +52,289 @@ def _parse_headers(had):
     return dict([(k.lower(), v) for k, v in reg.findall(had)])
 
 
+def _snapResolution(resolution, buckets, source=None):
+    '''將要求的解析度對齊至級距清單中
+    寬度取可容納要求寬度的最小級距寬度, 高度依要求的長寬比推算, 不會因級距的長寬比不同而變形;
+    結果超過最大級距或來源解析度時, 寬高等比例縮小至可容納的大小
+    傳入:
+        resolution: tuple - 要求的解析度, 格式為 (width, height), (0, 0) 表示原始解析度
+        buckets   : list(tuple) - 解析度級距清單, 未傳入時不調整
+        source    : tuple - 來源(或裁切範圍)的解析度, None 表示不限制
+    傳回:
+        tuple - 對齊後的解析度
+    '''
+    if not buckets or not resolution or not resolution[0] or not resolution[1]:
+        return resolution
+    w, h = resolution
+    widths = sorted(set(b[0] for b in buckets))
+    fits = [bw for bw in widths if bw >= w]
+    bw = fits[0] if fits else widths[-1]
+    bh = max(2, int(round(bw * h / w)) & ~1)
+    limits = [max(buckets, key=lambda b: b[0] * b[1])]
+    if source and source[0] and source[1]:
+        limits.append(source)
+    scale = min([1.0] + [min(lw / bw, lh / bh) for lw, lh in limits])
+    if scale < 1.0:
+        bw, bh = max(2, int(bw * scale) & ~1), max(2, int(bh * scale) & ~1)
+    return bw, bh
+
+
+def _parseCrop(value):
+    '''解析觀看端要求的裁切範圍
+    傳入:
+        value : list | str - [x, y, w, h] 或 "x,y,w,h", 皆不大於 1 時為比例, 否則為原始頁框的像素座標
+    傳回:
+        tuple - 格式錯誤或未指定時傳回 None
+    '''
+    if isinstance(value, str):
+        value = value.split(',')
+    try:
+        crop = tuple(float(v) for v in value) if value else None
+    except (TypeError, ValueError):
+        return None
+    return crop if crop and len(crop) == 4 and crop[2] > 0 and crop[3] > 0 else None
+
+
+def _parseResolution(value, default=(0, 0)):
+    '''解析觀看端要求的解析度
+    傳入:
+        value   : list | str - [width, height] 或 "WxH", (0, 0) 表示原始解析度
+        default : tuple - 格式錯誤時傳回的值
+    傳回:
+        tuple(int, int) - 寬高皆介於 0 ~ 8192
+    '''
+    if isinstance(value, str):
+        value = value.lower().split('x')
+    try:
+        w, h = (int(float(v)) for v in value)
+    except (TypeError, ValueError):
+        return default
+    return max(0, min(8192, w)), max(0, min(8192, h))
+
+
+def _parseQuality(value, default=0):
+    '''解析觀看端要求的壓縮品質
+    傳入:
+        value   : int | str - 1 ~ 100, 0 表示預設品質
+        default : int - 格式錯誤時傳回的值
+    傳回:
+        int - 0 ~ 100
+    '''
+    try:
+        return max(0, min(100, int(float(value or 0))))
+    except (TypeError, ValueError, OverflowError):
+        return default
+
+
+def _parseFps(value, default=0.0):
+    '''解析觀看端要求的最大 FPS
+    傳入:
+        value   : float | str - 最大 FPS, 0 表示跟隨來源速率
+        default : float - 格式錯誤時傳回的值
+    傳回:
+        float - 不小於 0
+    '''
+    try:
+        fps = float(value)
+    except (TypeError, ValueError):
+        return default
+    return max(0.0, fps) if fps == fps and fps != float('inf') else default
+
+
+def _scaleResolution(resolution, scale, minimum=(0, 0), buckets=None):
+    '''依壅塞控制的縮放比例降低解析度
+    傳入:
+        resolution: tuple - 觀看端要求(或串流原始)的解析度, 格式為 (width, height)
+        scale     : float - 縮放比例, 1.0 表示不縮放
+        minimum   : tuple - 觀看端宣告的最低解析度
+        buckets   : list(tuple) - 解析度級距清單, 傳入時寬度改為不超過縮放結果的最大級距寬度, 高度依原長寬比推算
+    傳回:
+        tuple - 縮放後的解析度
+    '''
+    if scale >= 1.0 or not resolution or not resolution[0] or not resolution[1]:
+        return resolution
+    w, h = int(resolution[0] * scale) & ~1, int(resolution[1] * scale) & ~1
+    if buckets:
+        widths = sorted(set(b[0] for b in buckets))
+        fits = [bw for bw in widths if bw <= w]
+        w = fits[-1] if fits else widths[0]
+        h = max(2, int(round(w * resolution[1] / resolution[0])) & ~1)
+    if w < minimum[0] or h < minimum[1]:
+        w, h = minimum
+    return (w, h)
+
+
+class _RateControl(object):
+    '''觀看端的壅塞控制, 依傳送積壓與實際送達的頁框數調整 JPEG 品質與解析度
+
+    每個統計區間比較送入傳送佇列與實際送出的頁框數:
+        * 有頁框被捨棄、傳送積壓或送達率低於 90% 時, 先逐級降低品質, 已達下限時再降低解析度
+        * 連續 `recover` 個區間皆順暢時, 先恢復解析度, 再逐級提高品質
+    品質以 QUALITY_STEP 為級距調整, 同一級距的觀看端可共用編碼結果
+    '''
+    QUALITY_STEP = 10
+    SCALE_STEP = 0.75
+
+    def __init__(self, quality=(0, 0), minResolution=(0, 0), interval=1.0, recover=3):
+        '''
+        傳入:
+            quality      : tuple - 品質上下限 (min, max)
+            minResolution: tuple - 可接受的最低解析度 (width, height), (0, 0) 表示不降低解析度
+            interval     : float - 統計區間秒數
+            recover      : int - 連續順暢幾個區間後才提高畫質
+        '''
+        self.minQuality, self.maxQuality = sorted(max(1, _parseQuality(q, 100)) for q in quality)
+        self.quality = self.maxQuality
+        self.minResolution = _parseResolution(minResolution) if minResolution else (0, 0)
+        self.scale = 1.0
+        self.interval = interval
+        self.recover = recover
+        self.fps = 0.0
+        self.throughput = 0.0
+        self.__good = 0
+        self.__mark = None
+
+    def update(self, sender, resolution):
+        '''依傳送狀況調整品質與縮放比例, 未達統計區間時不做任何事
+        傳入:
+            sender    : _Sender - 觀看端的傳送執行緒
+            resolution: tuple - 目前(縮放前)的解析度, 用以判斷是否已達最低解析度
+        '''
+        now = time.time()
+        mark = (now, sender.pushed, sender.sent, sender.dropped, sender.bytes)
+        if self.__mark is None:
+            self.__mark = mark
+            return
+        dt = now - self.__mark[0]
+        if dt < self.interval: return
+        pushed, sent, dropped, sent_bytes = [a - b for a, b in zip(mark[1:], self.__mark[1:])]
+        self.__mark = mark
+        self.fps = sent / dt
+        self.throughput = sent_bytes / dt
+        if not pushed: return
+        if dropped or sender.backlog > 1 or sent < pushed * 0.9:
+            self.__good = 0
+            if self.quality > self.minQuality:
+                self.quality = max(self.minQuality, self.quality - self.QUALITY_STEP)
+            elif self.__canShrink(resolution):
+                self.scale *= self.SCALE_STEP
+            return
+        self.__good += 1
+        if self.__good < self.recover: return
+        self.__good = 0
+        if self.scale < 1.0:
+            self.scale = min(1.0, self.scale / self.SCALE_STEP)
+        elif self.quality < self.maxQuality:
+            self.quality = min(self.maxQuality, self.quality + self.QUALITY_STEP)
+
+    def __canShrink(self, resolution):
+        if self.minResolution == (0, 0) or not resolution or resolution == (0, 0):
+            return False
+        w, h = resolution[0] * self.scale, resolution[1] * self.scale
+        return w * self.SCALE_STEP >= self.minResolution[0] and h * self.SCALE_STEP >= self.minResolution[1]
+
+    def resolution(self, resolution, buckets=None):
+        '''傳回套用縮放比例後的解析度, 請參閱 _scaleResolution'''
+        return _scaleResolution(resolution, self.scale, self.minResolution, buckets)
+
+    @property
+    def stats(self):
+        return {
+            'quality': self.quality, 'scale': round(self.scale, 3),
+            'fps': round(self.fps, 2), 'throughput': int(self.throughput),
+        }
+
+
+class _ActivityGate(object):
+    '''場景變動偵測, 畫面靜止時僅定時送出保活頁框, 偵測到變動時恢復全速
+
+    以縮小的灰階縮圖與參考縮圖比較(扣除整體亮度變化), 差異超過 threshold 的像素比例達 area 即視為變動;
+    參考縮圖於偵測到變動或送出保活頁框時更新, 緩慢的變化會累積至超過門檻
+    '''
+    def __init__(self, threshold=12, area=0.005, keepalive=5.0, hold=2.0, interval=0.2, size=(64, 48)):
+        '''
+        傳入:
+            threshold : int - 像素灰階差異門檻(0~255)
+            area      : float - 變動像素比例門檻(0~1)
+            keepalive : float - 畫面靜止時送出頁框的間隔秒數
+            hold      : float - 最後一次偵測到變動後維持全速的秒數
+            interval  : float - 畫面靜止時的偵測間隔秒數, 期間擷取來源不需解碼
+            size      : tuple - 縮圖解析度 (width, height)
+        '''
+        self.threshold = threshold
+        self.area = area
+        self.keepalive = keepalive
+        self.hold = hold
+        self.interval = interval
+        self.size = tuple(size)
+        self.activity = 0.0
+        self.__ref = None
+        self.__active = 0.0
+        self.__sent = 0.0
+        self.__checked = 0.0
+        # 略過的頁框數, 省下的 JPEG 編碼次數與傳送位元組數(估計值)
+        self.skipped = 0
+        self.savedEncodes = 0
+        self.savedBytes = 0
+
+    static = property(fget=lambda self: self.__ref is not None and self.__checked - self.__active >= self.hold,
+                      doc='畫面是否為靜止狀態')
+    nextCheck = property(fget=lambda self: self.__checked + self.interval if self.static else 0.0,
+                         doc='下一次需要偵測的時間, 非靜止狀態時為 0')
+
+    def __thumbnail(self, frame):
+        if _isPacket(frame):
+            # 直接轉送的 JPEG 以 1/8 縮小解碼, 不需完整解碼
+            gray = cv2.imdecode(frame, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+            if gray is None: return None
+        else:
+            gray = frame
+        h, w = gray.shape[:2]
+        step = max(1, min(w // (self.size[0] * 4), h // (self.size[1] * 4)))
+        small = cv2.resize(gray[::step, ::step], self.size, interpolation=cv2.INTER_AREA)
+        if small.ndim == 3:
+            small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return small.astype(np.int16)
+
+    def check(self, frame, timestamp):
+        '''判斷此頁框是否需要送出
+        傳入:
+            frame     : numpy.ndarray - 頁框(或直接轉送的 JPEG 封包)
+            timestamp : float - 擷取時間
+        傳回:
+            bool
+        '''
+        self.__checked = timestamp
+        thumb = self.__thumbnail(frame)
+        if thumb is None: return True
+        if self.__ref is None or self.__ref.shape != thumb.shape:
+            self.__ref = thumb
+            self.__active = self.__sent = timestamp
+            return True
+        diff = thumb - self.__ref
+        diff -= int(diff.mean())
+        self.activity = float(np.count_nonzero(np.abs(diff) > self.threshold)) / diff.size
+        if self.activity >= self.area:
+            self.__ref = thumb
+            self.__active = timestamp
+        if timestamp - self.__active < self.hold:
+            self.__sent = timestamp
+            return True
+        if timestamp - self.__sent >= self.keepalive:
+            self.__ref = thumb
+            self.__sent = timestamp
+            return True
+        self.skipped += 1
+        return False
+
+    @property
+    def stats(self):
+        return {
+            'static': self.static, 'activity': round(self.activity, 4), 'skipped': self.skipped,
+            'savedEncodes': self.savedEncodes, 'savedBytes': self.savedBytes,
+        }
+
+
 class _wsServer(WebsocketServer):
     def __init__(self, port, host='127.0.0.1'):
         self.port = port
@@ -28,11 +345,15 @@ class _wsHandler(WebSocketHandler):
     def setup(self):
         '''覆寫自 websocket_server.WebSocketHandler.setup
 
-        增加 path 與 headers 兩屬性
+        增加 path、headers、sendLock、lastSeen 與 pingSent 屬性
         '''
         super(_wsHandler, self).setup()
         self.path = ''
         self.headers = {}
+        self.sendLock = threading.Lock()
+        self.lastSeen = time.time()
+        # 最後一次收到資料後, 第一個實際送出的 Ping 的時間
+        self.pingSent = 0.0
 
     def handshake(self):
         '''覆寫自 websocket_server.WebSocketHandler.handshake
@@ -64,56 +385,512 @@ class _wsHandler(WebSocketHandler):
         self.valid_client = True
         self.server._new_client_(self)
 
+    def read_next_message(self):
+        '''覆寫自 websocket_server.WebSocketHandler.read_next_message
+
+        增加 Ping/Pong 控制訊框處理, 並記錄最後一次收到資料的時間 lastSeen
+        '''
+        try:
+            b1, b2 = self.read_bytes(2)
+        except (ValueError, OSError):
+            self.keep_alive = False
+            return
+        opcode = b1 & 0x0F
+        length = b2 & 0x7F
+        if not b1 or opcode == _OPCODE_CLOSE or not (b2 & 0x80):
+            # 遠端已斷線, 要求關閉, 或未遮罩(Masked)的訊框
+            self.keep_alive = False
+            return
+        if length == 126:
+            length = struct.unpack('!H', self.read_bytes(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self.read_bytes(8))[0]
+        masks = self.read_bytes(4)
+        payload = bytes(b ^ masks[i % 4] for i, b in enumerate(self.read_bytes(length)))
+        self.lastSeen = time.time()
+        if opcode == _OPCODE_PING:
+            self._sendFrame(_OPCODE_PONG, payload)
+        elif opcode == _OPCODE_TEXT:
+            self.server._message_received_(self, payload.decode('utf-8', 'ignore'))
+
+    def send_text(self, message):
+        '''覆寫自 websocket_server.WebSocketHandler.send_text
+
+        改為與 send_binary、send_ping 共用傳送鎖定, 避免多執行緒傳送時訊框交錯
+        '''
+        if isinstance(message, str):
+            message = message.encode('utf-8')
+        self._sendFrame(_OPCODE_TEXT, message)
+
+    def send_binary(self, data):
+        '''以 Binary Message 方式傳送資料, websocket_server 僅支援文字訊息
+        傳入:
+            data : bytes - 欲傳送的資料
+        '''
+        self._sendFrame(_OPCODE_BINARY, data)
+
+    def send_ping(self):
+        '''傳送 Ping 控制訊框, 瀏覽器收到後會自動回應 Pong
+
+        傳送中(已鎖定)時不等待, 直接略過此次 Ping, 卡住的傳送由傳送逾時處理
+        傳回:
+            bool - 是否已送出
+        '''
+        if not self.sendLock.acquire(blocking=False):
+            return False
+        try:
+            self.request.sendall(struct.pack('!BB', 0x80 | _OPCODE_PING, 0))
+        finally:
+            self.sendLock.release()
+        if self.pingSent <= self.lastSeen:
+            self.pingSent = time.time()
+        return True
+
+    @property
+    def unanswered(self):
+        '''已送出的 Ping 未獲回應的秒數, 略過未送出的 Ping 不列入計算'''
+        sent = self.pingSent
+        return time.time() - sent if sent > self.lastSeen else 0.0
+
+    def _sendFrame(self, opcode, data):
+        length = len(data)
+        if length <= 125:
+            header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length <= 65535:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.sendLock:
+            self.request.sendall(header + data)
+
+
+class _TileDelta(object):
+    '''觀看端的分塊差異狀態(PROTOCOL_TILES)
+
+    頁框切成 size x size 的分塊, 每一分塊以 GRID x GRID 的平均灰階為特徵,
+    與該觀看端最後一次收到此分塊時的特徵比較, 任一格差異超過 threshold 的分塊才重新編碼送出;
+    首次、每 keyInterval 秒、傳送佇列曾捨棄內容或變動分塊比例超過 keyRatio 時改送完整頁框
+    '''
+    GRID = 8
+
+    def __init__(self, resolution, size=256, threshold=4, keyInterval=10.0, keyRatio=0.5):
+        '''
+        傳入:
+            resolution  : tuple - 輸出解析度 (width, height)
+            size        : int - 分塊大小(像素), 須為 16 的倍數, 使分塊邊界與 JPEG 區塊對齊
+            threshold   : int - 特徵差異門檻(平均灰階)
+            keyInterval : float - 完整頁框的送出間隔秒數
+            keyRatio    : float - 變動分塊比例超過此值時改送完整頁框
+        '''
+        self.resolution = tuple(resolution)
+        self.size = max(16, int(size) // 16 * 16)
+        self.threshold = threshold
+        self.keyInterval = keyInterval
+        self.keyRatio = keyRatio
+        w, h = self.resolution
+        self.cols = (w + self.size - 1) // self.size
+        self.rows = (h + self.size - 1) // self.size
+        self.keys = 0
+        self.tiles = 0
+        self.__ref = None
+        self.__keyTime = 0.0
+        self.__dropped = 0
+
+    def signature(self, image):
+        '''計算頁框的分塊特徵(以邊緣像素補齊至分塊的整數倍後縮小), 同一頁框同一解析度的觀看端可共用
+        傳回:
+            numpy.ndarray - (rows * GRID, cols * GRID) 的 int16 陣列
+        '''
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        h, w = gray.shape[:2]
+        padded = cv2.copyMakeBorder(gray, 0, self.rows * self.size - h, 0, self.cols * self.size - w, cv2.BORDER_REPLICATE)
+        return cv2.resize(padded, (self.cols * self.GRID, self.rows * self.GRID), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def changes(self, sig, timestamp):
+        '''比較特徵, 並將送出的分塊記為該觀看端目前的畫面
+        傳入:
+            sig       : numpy.ndarray - signature() 的傳回值
+            timestamp : float - 頁框擷取時間
+        傳回:
+            list(tuple) - 變動分塊 [(x, y, w, h), ...], 需送出完整頁框時傳回 None
+        '''
+        if self.__ref is None or timestamp - self.__keyTime >= self.keyInterval:
+            return self.__key(sig, timestamp)
+        g = self.GRID
+        diff = np.abs(sig - self.__ref).reshape(self.rows, g, self.cols, g).max(axis=(1, 3))
+        mask = diff > self.threshold
+        count = int(np.count_nonzero(mask))
+        if count > self.keyRatio * mask.size:
+            return self.__key(sig, timestamp)
+        if not count: return []
+        cells = np.repeat(np.repeat(mask, g, axis=0), g, axis=1)
+        self.__ref[cells] = sig[cells]
+        self.tiles += count
+        w, h = self.resolution
+        sz = self.size
+        return [(int(c) * sz, int(r) * sz, min(sz, w - int(c) * sz), min(sz, h - int(r) * sz)) for r, c in np.argwhere(mask)]
+
+    def __key(self, sig, timestamp):
+        self.__ref = sig.copy()
+        self.__keyTime = timestamp
+        self.keys += 1
+        return None
+
+    def sent(self, dropped):
+        '''記錄加入傳送佇列前的捨棄數'''
+        self.__dropped = dropped
+
+    def check(self, dropped):
+        '''傳送佇列捨棄過內容時, 觀看端畫面已不完整, 下一張改送完整頁框'''
+        if dropped != self.__dropped:
+            self.__ref = None
+
+    def invalidate(self):
+        self.__ref = None
+
+
+class _Sender(threading.Thread):
+    '''觀看端專屬的傳送執行緒
+
+    每一觀看端擁有一個小型佇列, 佇列已滿時捨棄最舊的內容而保留最新的頁框,
+    使慢速的觀看端不會拖慢同一攝影機的其他觀看端
+
+    加入時附帶頁框戳記 (seq, 擷取時間, 打包完成時間) 者, 於寫入完成時記錄 ready 與 send 延遲,
+    並保留最近送出的頁框, 供終端回報顯示時(displayed())計算 display 與 total 延遲
+    '''
+    # 等待終端顯示回報的頁框數上限
+    INFLIGHT = 64
+
+    def __init__(self, client, size=2):
+        super(_Sender, self).__init__(daemon=True)
+        self.client = client
+        self.size = size
+        self.__evt_exit = threading.Event()
+        self.__cond = threading.Condition()
+        self.__queue = deque()
+        # Fragmented MP4 串流是否須等待下一個關鍵影格(並重送初始化片段)才可繼續
+        self.__resync = True
+        self.resyncs = 0
+        self.busySince = 0.0
+        self.pushed = 0
+        self.sent = 0
+        self.dropped = 0
+        self.bytes = 0
+        # 延遲統計, parent 為目前觀看的攝影機(CaptureSource.latency)
+        self.latency = LatencyTracker()
+        # 目前觀看的攝影機的傳送位元組計數(CaptureSource.bytesSent)
+        self.meter = None
+        self.__inflight = OrderedDict()
+
+    def run(self):
+        handler = self.client['handler']
+        while not self.__evt_exit.isSet():
+            with self.__cond:
+                if not self.__queue:
+                    self.__cond.wait(timeout=0.5)
+                if not self.__queue: continue
+                pkgs, stamp = self.__queue.popleft()
+            self.busySince = time.time()
+            try:
+                size = 0
+                if isinstance(pkgs, bytes):
+                    handler.send_binary(pkgs)
+                    size = len(pkgs)
+                elif isinstance(pkgs, str):
+                    handler.send_text(pkgs)
+                else:
+                    handler.send_message(f"::{len(pkgs)}::")
+                    for pkg in pkgs:
+                        if self.__evt_exit.isSet(): break
+                        handler.send_message(pkg)
+                        size += len(pkg)
+                self.bytes += size
+                meter = self.meter
+                if meter and size: meter.add(size)
+                self.sent += 1
+                if stamp: self.__sent(*stamp)
+            except (OSError, ValueError):
+                # 連線已中斷, 由 RtspProxy 負責清除此觀看端
+                break
+            finally:
+                self.busySince = 0.0
+
+    def __sent(self, seq, captured, ready):
+        now = time.time()
+        self.latency.observe('ready', ready - captured)
+        self.latency.observe('send', now - ready)
+        self.__inflight[seq] = (captured, now)
+        while len(self.__inflight) > self.INFLIGHT:
+            self.__inflight.popitem(last=False)
+
+    def displayed(self, seq, paint=None):
+        '''終端回報頁框已顯示, 以收到回報的時間計算 display 與 total 延遲(含回報的上傳時間, 為上限值)
+        傳入:
+            seq   : int - 頁框序號
+            paint : float - 終端回報的收到訊息至繪製完成秒數, None 表示未回報
+        傳回:
+            bool - 是否為等待回報中的頁框
+        '''
+        stamp = self.__inflight.pop(seq, None)
+        if stamp is None: return False
+        now = time.time()
+        self.latency.observe('display', now - stamp[1])
+        self.latency.observe('total', now - stamp[0])
+        if paint is not None:
+            self.latency.observe('paint', paint)
+        return True
+
+    def push(self, pkgs, stamp=None):
+        '''加入欲傳送的內容, 佇列已滿時捨棄最舊的一筆頁框
+        傳入:
+            pkgs  : bytes | str | list(str) - 欲傳送的內容
+            stamp : tuple - 頁框戳記 (seq, 擷取時間, 打包完成時間), None 表示不記錄延遲
+        '''
+        with self.__cond:
+            frames = [i for i, q in enumerate(self.__queue) if not isinstance(q[0], str)]
+            if len(frames) >= self.size:
+                # 控制訊息(文字)不可捨棄
+                del self.__queue[frames[0]]
+                self.dropped += 1
+                self.latency.drop()
+            self.__queue.append((pkgs, stamp))
+            self.pushed += 1
+            self.__cond.notify()
+
+    def pushStream(self, data, keyframe=False, limit=0, header=b'', stamp=None):
+        '''加入 Fragmented MP4 片段; 片段之間有相依性不可任意捨棄,
+        佇列超過 limit 筆時清空尚未送出的片段, 並略過後續片段直到下一個關鍵影格
+        傳入:
+            data     : bytes - 媒體片段; str 為控制訊息, 一律依序送出
+            keyframe : bool - 是否為關鍵影格的片段
+            limit    : int - 佇列上限, 0 表示不限制
+            header   : bytes - 初始化片段, 重新同步時前置於關鍵影格的片段
+            stamp    : tuple - 頁框戳記, 請參閱 push()
+        '''
+        with self.__cond:
+            if isinstance(data, str):
+                # 控制訊息(文字)不受佇列上限與重新同步影響
+                self.__queue.append((data, None))
+                self.__cond.notify()
+                return
+            if limit and len(self.__queue) >= limit:
+                # 僅保留控制訊息(文字)
+                kept = [q for q in self.__queue if isinstance(q[0], str)]
+                self.dropped += len(self.__queue) - len(kept)
+                self.latency.drop(len(self.__queue) - len(kept))
+                self.__queue = deque(kept)
+                self.__resync = True
+                self.resyncs += 1
+            if self.__resync:
+                if not keyframe:
+                    self.dropped += 1
+                    self.latency.drop()
+                    return
+                self.__resync = False
+                data = header + data
+            self.__queue.append((data, stamp))
+            self.pushed += 1
+            self.__cond.notify()
+
+    def resync(self):
+        '''串流參數變更(如解析度), 下一個關鍵影格起以新的初始化片段重新開始'''
+        with self.__cond:
+            self.__resync = True
+
+    def stop(self):
+        self.__evt_exit.set()
+        with self.__cond:
+            self.__queue.clear()
+            self.__cond.notify()
+
+    backlog = property(fget=lambda self: len(self.__queue) + (1 if self.busySince else 0), doc='尚未送出的頁框數(含傳送中)')
+
+    @property
+    def stalled(self):
+        '''目前這一筆傳送已經卡住的秒數, 未在傳送中時為 0'''
+        since = self.busySince
+        return time.time() - since if since else 0.0
+
 
 class _Camera(threading.Thread):
     '''自訂 Camera 執行緒類別, 此類別僅供 RtspProxy 使用'''
-    def __init__(self, svr, url):
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, svr, url, buckets=None, id=0, warm=0, activity=None):
+        '''
+        傳入:
+            svr      : _wsServer
+            url      : str - 串流網址
+            buckets  : list(tuple) - 輸出解析度級距
+            id       : int - 攝影機編號
+            warm     : float - 預先開啟(常駐)的攝影機於無觀看端時仍維持解碼與編碼的 FPS,
+                               使新的觀看端可立即取得頁框, 0 表示非常駐
+            activity : dict - 場景變動偵測參數, 請參閱 _ActivityGate, None 表示送出每一張頁框
+        '''
         super(_Camera, self).__init__()
         self.daemon = True
+        self.id = id
         self.__evt_exit = threading.Event()
         self.__svr = svr
         self.__lock = threading.Lock()
         self.url = url
         self.clients = []
-        self.camera = cv2.VideoCapture(url)
-        if not self.camera.isOpened():
-            self.camera.open()
-        self.resolution = (
-            int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
-            int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        )
-        self.fps = int(self.camera.get(cv2.CAP_PROP_FPS))
+        self.buckets = buckets
+        # 打包後(含傳輸協定)的內容快取, JPEG 編碼結果則由 CaptureSource 與其他訂閱者共用
+        self.cache = _EncodeCache()
+        self.source = hub.subscribe(url)
+        self.dropped = 0
+        # 最後一個觀看端離開的時間, 有觀看端時為 0
+        self.idleSince = 0.0
+        self.__warm = None
+        # 無觀看端時維持編碼所用的輸出參數, 沿用最後一個觀看端的 (resolution, quality)
+        self.__warmKey = ((0, 0), 0)
+        self.gate = None
+        self.tuneActivity(activity)
+        self.keepWarm(warm)
+
+    resolution = property(fget=lambda self: self.source.resolution, doc='串流原始解析度')
+    fps = property(fget=lambda self: self.source.fps, doc='串流回報的 FPS')
+    pinned = property(fget=lambda self: self.__warm is not None, doc='是否為預先開啟(常駐)的攝影機, 閒置時不會被停止')
 
     def __del__(self):
         self.clients = []
-        if self.camera and self.camera.isOpened():
-            self.camera.release()
+
+    def tuneActivity(self, params):
+        '''設定場景變動偵測參數
+        傳入:
+            params : dict - 請參閱 _ActivityGate, None 表示停用(送出每一張頁框)
+        '''
+        self.gate = _ActivityGate(**params) if params is not None else None
+
+    def keepWarm(self, fps):
+        '''設定無觀看端時維持解碼與編碼的 FPS, 0 表示取消常駐'''
+        self.__warm = FramePacer(fps) if fps and fps > 0 else None
+        self.__refreshDemand()
 
     def run(self):
         self.__evt_exit.clear()
-        while not self.__evt_exit.wait(timeout=0.05):
-            ret, frame = self.camera.read()
-            if ret:
-                thds = []
-                for clt in self.clients:
-                    if self.__evt_exit.isSet(): break
-                    pkgs = self.__encodingImage(frame, clt['resolution'])
-                    if not pkgs: continue
-                    thd = threading.Thread(target=self.__sendPackages, daemon=True, args=(clt, pkgs))
-                    thds.append(thd)
-                [thd.start() for thd in thds]
-                [thd.join() for thd in thds]
-            else:
-                # 讀取失敗，重置 IP Cam
+        last = 0
+        state = None
+        while not self.__evt_exit.isSet():
+            frame, seq, ts = self.source.latestFrame(last, timeout=0.5)
+            if state != self.source.state:
+                state = self.source.state
+                self.__notifyState(state)
+            if frame is None: continue
+            warm = self.__warm
+            if not self.clients and warm and warm.due(ts, self.source.rate):
+                # 常駐攝影機無觀看端時, 仍以低 FPS 更新 lastJpeg
+                self.source.encode(frame, seq, *self.__warmKey)
+            if last and seq - last > 1:
+                # 編碼/發送過慢而未被處理的頁框
+                self.dropped += seq - last - 1
+                self.source.latency.drop(seq - last - 1)
+            last = seq
+            gate = self.gate
+            # 畫面靜止時僅送出保活頁框, 略過的頁框統計省下的編碼與傳送量
+            send = gate.check(frame, ts) if gate and self.clients else True
+            saved = set()
+            for clt in list(self.clients):
                 if self.__evt_exit.isSet(): break
-                self.camera = cv2.VideoCapture(self.url)
-                if not self.camera.isOpened(): self.camera.open()
+                try:
+                    self.__serve(clt, frame, seq, ts, send, saved)
+                except Exception:
+                    # 單一觀看端的錯誤不可中斷其他觀看端的串流
+                    if not clt.get('failed'):
+                        clt['failed'] = True
+                        self.logger.exception(f"Camera({self.id}) client({clt.get('id')}) error!")
+            if saved:
+                gate.savedEncodes += len(saved)
+            self.__refreshDemand()
+
+    def __serve(self, clt, frame, seq, ts, send, saved):
+        '''為一個觀看端處理目前的頁框(FPS 限制、壅塞控制、編碼與加入傳送佇列)'''
+        # 尚無傳送執行緒的觀看端不處理, 亦不列入常駐編碼參數與省下的編碼統計
+        if 'sender' not in clt: return
+        gate = self.gate
+        pacer = clt.get('pacer')
+        if pacer and not pacer.due(ts, self.source.rate):
+            # 此觀看端限制了 FPS, 本頁框不需編碼
+            return
+        resolution = clt['resolution']
+        quality = clt.get('quality', 0)
+        crop = clt.get('crop')
+        ctrl = clt.get('control')
+        rect = _cropRect(crop, self.source.resolution) if crop else None
+        size = rect[2:] if rect else self.source.resolution
+        if ctrl:
+            if resolution == (0, 0):
+                resolution = size
+            ctrl.update(clt['sender'], resolution)
+            quality = ctrl.quality
+            resolution = ctrl.resolution(resolution, self.buckets)
+        resolution = _snapResolution(resolution, self.buckets, size)
+        if not crop:
+            self.__warmKey = (resolution, quality)
+        protocol = clt.get('protocol', PROTOCOL_TEXT)
+        if not send:
+            saved.add((resolution, quality, crop))
+            if gate: gate.savedBytes += clt.get('lastBytes', 0)
+            return
+        if protocol == PROTOCOL_TILES:
+            pkgs = self.__tiles(clt, frame, seq, ts, resolution, quality)
+        else:
+            pkgs = self.cache.get(seq, (resolution, quality, protocol, crop),
+                                  lambda: self.__packing(frame, seq, ts, resolution, quality, protocol, crop))
+        if not pkgs: return
+        clt['lastBytes'] = len(pkgs) if isinstance(pkgs, bytes) else sum(len(p) for p in pkgs)
+        dropped = clt['sender'].dropped
+        clt['sender'].push(pkgs, (seq, ts, time.time()))
+        if protocol == PROTOCOL_TILES:
+            # 此次加入時若擠掉尚未送出的內容, 下一張即可察覺
+            clt['tiles'].sent(dropped)
+
+    def __notifyState(self, state, clients=None):
+        '''通知(二進位協定的)觀看端串流狀態, 格式為 {"act": "state", "camera": 編號, "state": 狀態}'''
+        msg = json.dumps({'act': 'state', 'camera': self.id, 'state': state.value})
+        for clt in clients or list(self.clients):
+            if clt.get('protocol') not in (PROTOCOL_BINARY, PROTOCOL_TILES): continue
+            # 經由 _Sender 佇列依序送出, 不可在共用的擷取執行緒中等待傳送卡住的連線
+            if 'sender' in clt:
+                clt['sender'].pushStream(msg)
+
+    def __refreshDemand(self):
+        '''以所有觀看端中最早需要下一張頁框的時間, 告知擷取來源'''
+        clients = list(self.clients)
+        if not clients:
+            warm = self.__warm
+            self.source.demand(self, warm.next if warm else float('inf'))
+            return
+        due = min(c['pacer'].next if c.get('pacer') else 0.0 for c in clients)
+        gate = self.gate
+        if gate and gate.static:
+            # 畫面靜止時僅需以偵測間隔解碼
+            due = max(due, gate.nextCheck)
+        self.source.demand(self, due)
 
     def stop(self):
         self.__evt_exit.set()
         time.sleep(0.1)
-        if self.camera and self.camera.isOpened():
-            self.camera.release()
+        self.source.demand(self, None)
+        hub.unsubscribe(self.source)
+
+    @property
+    def stats(self):
+        '''攝影機統計資料'''
+        return {
+            'url': self.url, 'clients': len(self.clients), 'state': self.source.state.value,
+            'idle': time.time() - self.idleSince if self.idleSince else 0.0,
+            'captured': self.source.captured, 'dropped': self.dropped,
+            'decoded': self.source.decoded, 'skipped': self.source.skipped,
+            'cache': self.source.cache.stats,
+            'adaptive': {c['id']: c['control'].stats for c in self.clients if c.get('control')},
+            'activity': self.gate.stats if self.gate else None,
+        }
+
+    def latestFrame(self, seq=0, timeout=None):
+        '''取得最新的頁框, 請參閱 CaptureSource.latestFrame'''
+        return self.source.latestFrame(seq, timeout)
 
     def appendClient(self, client):
         with self.__lock:
@@ -122,39 +899,111 @@ class _Camera(threading.Thread):
                 self.clients.append(client)
             else:
                 ids[0].update(client)
+            self.idleSince = 0.0
+            if 'sender' in client:
+                # 觀看端的延遲與傳送量同時累計至此攝影機
+                client['sender'].latency.parent = self.source.latency
+                client['sender'].meter = self.source.bytesSent
+        self.__refreshDemand()
 
     def removeClient(self, client):
         with self.__lock:
             [self.clients.remove(c) for c in self.clients if c['id'] == client['id']]
+            if not self.clients and not self.idleSince:
+                self.idleSince = time.time()
+        self.__refreshDemand()
 
     def updateClient(self, client):
         with self.__lock:
             [c.update(client) for c in self.clients if c['id'] == client['id']]
+        self.__refreshDemand()
 
     def __find(self, id):
         ids = [c for c in self.clients if c['id'] == id]
         return ids[0] if ids else None
 
-    def __encodingImage(self, frame, resolution=(0, 0), quality=0, size=32 * 1024):
-        '''將圖片依 resolution 調整解析度, 並編碼成可傳輸之 base64 字串
+    def __packing(self, frame, seq, timestamp, resolution, quality, protocol, crop=None):
+        '''依傳輸協定將頁框編碼並打包, 同一頁框的 JPEG 編碼結果由各協定及其他訂閱者共用
         傳入:
             frame     : cv2 image - 來自 OpenCV 的圖像(頁框)資料
+            seq       : int - 頁框序號
+            timestamp : float - 頁框擷取時間
             resolution: tuple - 欲調整的解析度, 格式為 (width, height)
-                                未傳入或傳入 (0, 0) 時則表示不調整, 預設值不調整
-            quality   : int - 壓縮品質, 1~100, 預設值為 0 表示原畫質不壓縮
-            size      : int - 拆解的封包大小
+            quality   : int - 壓縮品質
+            protocol  : int - PROTOCOL_TEXT 或 PROTOCOL_BINARY
+            crop      : tuple - 裁切範圍, 請參閱 CaptureSource.encode
         傳回:
-            list(str) - 拆解完成的字串列表
+            list(str) - PROTOCOL_TEXT 時為拆解完成的字串列表
+            bytes     - PROTOCOL_BINARY 時為含 FRAME_HEADER 的二進位資料
         '''
-        frm = frame if resolution == (0, 0) or resolution == self.resolution else cv2.resize(frame, resolution)
-        quality = 100 if quality > 100 else 0 if quality < 0 else quality
-        if quality != 0:
-            params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
-            ret, image = cv2.imencode('.jpg', frm, params)
+        jpg = self.source.encode(frame, seq, resolution, quality, crop)
+        if jpg is None: return None
+        return self.__pack(jpg, seq, timestamp, protocol)
+
+    def __tiles(self, clt, frame, seq, timestamp, resolution, quality):
+        '''PROTOCOL_TILES: 僅編碼並打包與該觀看端目前畫面不同的分塊
+        傳回:
+            bytes - 無變動分塊時傳回 None
+        '''
+        crop = clt.get('crop')
+        image = self.source.scaled(frame, seq, resolution, crop)
+        if image is None: return None
+        h, w = image.shape[:2]
+        state = clt.get('tiles')
+        if state is None or state.resolution != (w, h):
+            state = clt['tiles'] = _TileDelta((w, h), **clt.get('tileOptions', {}))
+        state.check(clt['sender'].dropped)
+        sig = self.cache.get(seq, ('signature', (w, h), state.size, crop), lambda: state.signature(image))
+        rects = state.changes(sig, timestamp)
+        if rects is None:
+            # 完整頁框與其他協定的觀看端共用 JPEG 編碼結果
+            jpg = self.source.encode(frame, seq, (w, h), quality, crop)
+            tiles, flags = [((0, 0, w, h), jpg)], TILE_KEY
+        elif rects:
+            encoder = hub.encoder
+            tiles, flags = [], 0
+            for x, y, tw, th in rects:
+                tile = np.ascontiguousarray(image[y:y + th, x:x + tw])
+                jpg = self.cache.get(seq, ('tile', (w, h), quality, crop, x, y, tw, th),
+                                     lambda: encoder(tile, (0, 0), quality))
+                tiles.append(((x, y, tw, th), jpg))
         else:
-            ret, image = cv2.imencode('.jpg', frm)
-        if not ret: return None
-        base64_data = base64.b64encode(image)
+            return None
+        if any(jpg is None for _, jpg in tiles):
+            state.invalidate()
+            return None
+        data = [FRAME_HEADER.pack(PROTOCOL_TILES, flags, self.id & 0xFFFF, seq & 0xFFFFFFFF, timestamp),
+                TILE_HEADER.pack(w, h, len(tiles))]
+        for rect, jpg in tiles:
+            data += [TILE_ENTRY.pack(*rect, len(jpg)), jpg]
+        return b''.join(data)
+
+    def __pack(self, jpg, seq, timestamp, protocol):
+        if protocol == PROTOCOL_BINARY:
+            return FRAME_HEADER.pack(PROTOCOL_BINARY, 0, self.id & 0xFFFF, seq & 0xFFFFFFFF, timestamp) + jpg
+        return self.__splitPackages(jpg)
+
+    def primeClient(self, client):
+        '''立即送出最後一次編碼完成的 JPEG 給新的觀看端, 之後再接續即時串流
+        傳回:
+            bool - 是否已送出
+        '''
+        seq, ts, jpg = self.source.lastJpeg
+        if not jpg or 'sender' not in client: return False
+        # 分塊差異協定須由完整頁框開始, 裁切的觀看端不適用整張頁框, 皆由擷取執行緒送出
+        if client.get('protocol') == PROTOCOL_TILES or client.get('crop'): return False
+        client['sender'].push(self.__pack(jpg, seq, ts, client.get('protocol', PROTOCOL_TEXT)))
+        return True
+
+    def __splitPackages(self, jpg, size=32 * 1024):
+        '''將 JPEG 資料轉成 base64 字串, 並拆解成舊版文字協定的封包
+        傳入:
+            jpg  : bytes - JPEG 資料
+            size : int - 拆解的封包大小
+        傳回:
+            list(str) - 拆解完成的字串列表
+        '''
+        base64_data = base64.b64encode(jpg)
         buf = f'data:image/jpeg;base64,{base64_data.decode()}'
         # # 拆解封包內容
         # # pks = len(buf) / size
@@ -163,19 +1012,188 @@ class _Camera(threading.Thread):
         # pks = int((len(buf) + (size - 1)) / size)
         return [f'~{int(i / size) + 1}~{buf[i:i + size]}' for i in range(0, len(buf), size)]
 
-    def __sendPackages(self, client, pkgs):
-        if not pkgs: return
-        try:
-            self.__svr.send_message(client, f"::{len(pkgs)}::")
-            [self.__svr.send_message(client, pkg) for pkg in pkgs if not self.__evt_exit.isSet()]
-        except:
-            pass
+
+class _Remux(threading.Thread):
+    '''H.264 轉封裝執行緒, 此類別僅供 RtspProxy 使用
+
+    不解碼也不重新編碼, 將攝影機的 H.264 封包封裝成 Fragmented MP4 後分送給所有觀看端(PROTOCOL_FMP4);
+    保留目前 GOP(最近一個關鍵影格起)的片段, 新的觀看端可立即由關鍵影格開始播放
+    '''
+    # 每一觀看端的片段佇列上限, 超過時捨棄至下一個關鍵影格
+    QUEUE_LIMIT = 90
+
+    def __init__(self, svr, url, id=0):
+        '''
+        傳入:
+            svr : _wsServer
+            url : str - 串流網址
+            id  : int - 攝影機編號
+        '''
+        super(_Remux, self).__init__()
+        self.daemon = True
+        self.id = id
+        self.__evt_exit = threading.Event()
+        self.__svr = svr
+        self.__lock = threading.Lock()
+        self.url = url
+        self.clients = []
+        self.muxer = None
+        self.__init = b''
+        # 目前 GOP 的片段, 超過 QUEUE_LIMIT 時為 None(新的觀看端等待下一個關鍵影格)
+        self.__gop = None
+        self.fragments = 0
+        self.bytes = 0
+        self.idleSince = 0.0
+        self.source = hub.subscribe(url, packets=True, listener=self.__packetReceived)
+
+    resolution = property(fget=lambda self: self.source.resolution, doc='串流原始解析度')
+    fps = property(fget=lambda self: self.source.fps, doc='串流回報的 FPS')
+    pinned = property(fget=lambda self: False, doc='轉封裝不支援預先開啟')
+    codec = property(fget=lambda self: self.muxer.codec if self.muxer else '', doc='MSE 使用的 codecs 字串')
+
+    def run(self):
+        self.__evt_exit.clear()
+        state = None
+        error = ''
+        while not self.__evt_exit.wait(0.5):
+            if state != self.source.state:
+                state = self.source.state
+                self.__notify({'act': 'state', 'camera': self.id, 'state': state.value})
+            if error != self.source.unsupported:
+                error = self.source.unsupported
+                if error:
+                    self.__notify({'act': 'error', 'camera': self.id, 'reason': f'unsupported codec {error}'})
+
+    def __notify(self, msg, clients=None):
+        msg = json.dumps(msg)
+        for clt in clients or list(self.clients):
+            if 'sender' in clt:
+                clt['sender'].pushStream(msg)
+
+    def __initMessage(self):
+        w, h = self.muxer.width, self.muxer.height
+        return json.dumps({'act': 'init', 'camera': self.id, 'codec': self.muxer.codec, 'resolution': [w, h]})
+
+    def __packetReceived(self, source, packet, seq, timestamp, keyframe):
+        '''CaptureSource 封包模式的回呼函式, 於擷取執行緒中執行'''
+        nalus = splitNalus(packet)
+        if not nalus: return
+        keyframe = keyframe or any(n[0] & 0x1F == NAL_IDR for n in nalus)
+        with self.__lock:
+            muxer = self.muxer or Fmp4Muxer(*source.resolution, source.fps)
+            if self.muxer is None:
+                muxer.update([n for n in parseExtradata(source.extradata) if n])
+            changed = muxer.update(nalus) or self.muxer is None
+            if not muxer.ready: return
+            if changed:
+                # 首次取得或變更 SPS/PPS(如解析度), 重新產生初始化片段, 各觀看端於下一個關鍵影格重新開始
+                muxer.width, muxer.height = source.resolution
+                self.muxer = muxer
+                self.__init = muxer.initSegment()
+                self.__gop = None
+                msg = self.__initMessage()
+                for clt in self.clients:
+                    if 'sender' not in clt: continue
+                    clt['sender'].resync()
+                    clt['sender'].pushStream(msg)
+            if keyframe:
+                self.__gop = []
+            elif self.__gop is None and not self.fragments:
+                # 尚未取得第一個關鍵影格
+                return
+            frag = muxer.fragment(nalus, timestamp, keyframe)
+            self.fragments += 1
+            self.bytes += len(frag)
+            if self.__gop is not None:
+                self.__gop = self.__gop + [frag] if len(self.__gop) < self.QUEUE_LIMIT else None
+            clients = list(self.clients)
+            init = self.__init
+        stamp = (seq, timestamp, time.time())
+        for clt in clients:
+            if 'sender' in clt:
+                clt['sender'].pushStream(frag, keyframe, self.QUEUE_LIMIT, init, stamp)
+
+    def stop(self):
+        self.__evt_exit.set()
+        self.source.unlisten(self.__packetReceived)
+        hub.unsubscribe(self.source)
+
+    @property
+    def stats(self):
+        '''轉封裝統計資料'''
+        return {
+            'url': self.url, 'clients': len(self.clients), 'state': self.source.state.value,
+            'idle': time.time() - self.idleSince if self.idleSince else 0.0,
+            'remux': True, 'codec': self.codec, 'captured': self.source.captured,
+            'fragments': self.fragments, 'bytes': self.bytes, 'cache': self.source.cache.stats,
+            'dropped': sum(c['sender'].dropped for c in self.clients if 'sender' in c),
+        }
+
+    def appendClient(self, client):
+        '''加入觀看端, 已取得初始化片段時立即送出 init 訊息與目前 GOP 的片段'''
+        with self.__lock:
+            ids = [c for c in self.clients if c['id'] == client['id']]
+            if not ids:
+                self.clients.append(client)
+            else:
+                ids[0].update(client)
+            self.idleSince = 0.0
+            if 'sender' in client:
+                client['sender'].latency.parent = self.source.latency
+                client['sender'].meter = self.source.bytesSent
+            if not self.muxer or 'sender' not in client: return
+            snd = client['sender']
+            snd.resync()
+            snd.pushStream(self.__initMessage())
+            for i, frag in enumerate(self.__gop or []):
+                snd.pushStream(frag, i == 0, self.QUEUE_LIMIT, self.__init)
+
+    def removeClient(self, client):
+        with self.__lock:
+            [self.clients.remove(c) for c in self.clients if c['id'] == client['id']]
+            if not self.clients and not self.idleSince:
+                self.idleSince = time.time()
+
+    def updateClient(self, client):
+        # 轉封裝不調整解析度、品質與 FPS
+        with self.__lock:
+            [c.update(client) for c in self.clients if c['id'] == client['id']]
+
+    def primeClient(self, client):
+        '''已於 appendClient() 送出目前 GOP'''
+        return False
 
 
 class RtspProxy(object):
-    def __init__(self, host, log=None):
+    def __init__(self, host, log=None, buckets=None, queueSize=2, sendTimeout=5.0, pingInterval=5.0, idleTimeout=30.0,
+                 activity=None):
+        '''建立 RTSP over WebSocket 代理服務
+
+        傳入:
+            host         : tuple - 監聽位址, 格式為 (ip, port)
+            log          : logging.Logger
+            buckets      : list(tuple) - 輸出解析度級距, 傳入時觀看端要求的解析度將對齊至級距,
+                                         以提高多個觀看端共用編碼結果的機率, 可使用 RESOLUTION_BUCKETS
+            queueSize    : int - 每一觀看端的傳送佇列大小, 已滿時捨棄最舊的頁框
+            sendTimeout  : float - 單次傳送卡住超過此秒數的觀看端將被斷線
+            pingInterval : float - 發送 Ping 的間隔秒數, 超過三倍間隔未回應的觀看端將被斷線
+            idleTimeout  : float - 攝影機無觀看端超過此秒數後停止擷取並釋放 VideoCapture,
+                                   期間內重新觀看者可立即接續; 檢查間隔同 pingInterval
+            activity     : dict - 預設的場景變動偵測參數(請參閱 _ActivityGate), 畫面靜止時僅定時送出保活頁框,
+                                  {} 表示使用預設值, None 表示停用; 個別攝影機可以 tuneActivity() 調整
+        '''
         self.clients = []
         self.cameras = []
+        self.buckets = buckets
+        self.queueSize = queueSize
+        self.sendTimeout = sendTimeout
+        self.pingInterval = pingInterval
+        self.idleTimeout = idleTimeout
+        self.activity = activity
+        self.__tuning = {}
+        self.__camId = 0
+        self.__camLock = threading.Lock()
+        self.__evt_exit = threading.Event()
         # 建立 Websocket Server
         self.__svr = _wsServer(host=host[0], port=host[1])
         self.host = self.__svr.server_address
@@ -204,13 +1222,62 @@ class RtspProxy(object):
             }
         '''
         self.log.debug(f"New client connected, ID: \x1B[92m{client['id']}\x1B[39m")
+        client['sender'] = _Sender(client, self.queueSize)
+        client['sender'].start()
         self.clients.append(client)
 
     def __clientLeft(self, client, server):
         self.log.debug(f"Client(\x1B[92m{client['id']}\x1B[39m) disconnected")
-        [cam.removeClient(client) for cam in self.cameras if cam.url == client['url']]
+        if 'sender' in client:
+            client['sender'].stop()
+        [cam.removeClient(client) for cam in self.cameras if cam.url == client.get('url')]
         [self.clients.remove(c) for c in self.clients if c['id'] == client['id']]
 
+    def __keepalive_Proc(self):
+        '''定時發送 Ping, 並斷開傳送卡住或無回應的觀看端'''
+        while not self.__evt_exit.wait(timeout=self.pingInterval):
+            now = time.time()
+            for clt in list(self.clients):
+                hdl = clt['handler']
+                snd = clt.get('sender')
+                if snd and snd.stalled > self.sendTimeout:
+                    reason = f'send stalled {snd.stalled:.1f}s'
+                elif hdl.unanswered > self.pingInterval * 3:
+                    reason = f'no response for {hdl.unanswered:.1f}s'
+                else:
+                    try:
+                        hdl.send_ping()
+                        continue
+                    except OSError:
+                        reason = 'ping failed'
+                self.log.warn(f"Evict client(\x1B[92m{clt['id']}\x1B[39m): {reason}")
+                self.__evict(clt)
+            self.__reapCameras()
+
+    def __reapCameras(self):
+        '''停止無觀看端超過 idleTimeout 秒的攝影機'''
+        now = time.time()
+        with self.__camLock:
+            idle = [cam for cam in self.cameras
+                    if cam.idleSince and not cam.pinned and now - cam.idleSince >= self.idleTimeout]
+            for cam in idle:
+                self.cameras.remove(cam)
+        for cam in idle:
+            self.log.info(f"Camera(\x1B[92m{cam.id}\x1B[39m) idle for {now - cam.idleSince:.0f}s, stopped: {cam.url}")
+            cam.stop()
+            cam.join(1)
+
+    def __evict(self, client):
+        '''強制斷開觀看端連線, 後續由 websocket_server 呼叫 __clientLeft 清除'''
+        hdl = client['handler']
+        hdl.keep_alive = False
+        if 'sender' in client:
+            client['sender'].stop()
+        try:
+            hdl.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def __msgReceived(self, client, server, message):
         self.log.debug(f"Client(\x1B[92m{client['id']}\x1B[39m) said: \x1B[92m{message}\x1B[39m")
         d = json.loads(message)
@@ -221,65 +1288,224 @@ class RtspProxy(object):
         if act == 'open':
             url = d.get('url', None)
             if not url: return
-            clts[0]['resolution'] = tuple(d.get('resolution', (0, 0)))
+            clts[0]['resolution'] = _parseResolution(d.get('resolution', (0, 0)))
+            # 傳輸協定協商: 未指定或不支援的版本皆使用舊版文字協定
+            protocol = d.get('protocol', PROTOCOL_TEXT)
+            if protocol not in (PROTOCOL_TEXT, PROTOCOL_BINARY, PROTOCOL_FMP4, PROTOCOL_TILES):
+                protocol = PROTOCOL_TEXT
+            # 轉封裝(PROTOCOL_FMP4)與 JPEG 協定分別使用 _Remux 與 _Camera
+            kind = _Remux if protocol == PROTOCOL_FMP4 else _Camera
+            okind = _Remux if clts[0].get('protocol') == PROTOCOL_FMP4 else _Camera
+            clts[0]['protocol'] = protocol
+            clts[0].pop('tiles', None)
+            if protocol == PROTOCOL_TILES and d.get('tileSize'):
+                try:
+                    clts[0]['tileOptions'] = {'size': max(64, min(1024, int(d['tileSize'])))}
+                except (TypeError, ValueError):
+                    pass
+            clts[0]['pacer'] = FramePacer(_parseFps(d.get('fps', 0)))
+            clts[0]['crop'] = _parseCrop(d.get('crop'))
+            self.__setQuality(clts[0], d)
             ourl = clts[0].get('url', '')
-            if ourl != url:
+            if ourl != url or okind is not kind:
                 [cam.removeClient(clts[0]) for cam in self.cameras if cam.url == ourl]
                 clts[0]['url'] = url
-                # 原先連線的網址為空值或與現在要連線的網址不同
-                cams = [cam for cam in self.cameras if cam.url == url]
-                if not cams:
-                    cam = _Camera(self.__svr, url)
+                # 原先連線的網址為空值或與現在要連線的網址(或協定)不同
+                with self.__camLock:
+                    cams = [cam for cam in self.cameras if cam.url == url and isinstance(cam, kind)]
+                    if not cams:
+                        self.__camId += 1
+                        if kind is _Remux:
+                            cam = _Remux(self.__svr, url, self.__camId)
+                        else:
+                            cam = _Camera(self.__svr, url, self.buckets, self.__camId, activity=self.__activityFor(url))
+                        self.cameras.append(cam)
+                        cam.start()
+                    else:
+                        # 閒置中(尚未逾時)的攝影機, 直接接續
+                        cam = cams[0]
+                    cam.appendClient(clts[0])
+                primed = True
+            else:
+                primed = False
+                [cam.updateClient(clts[0]) for cam in self.cameras if cam.url == url]
+            cams = [cam for cam in self.cameras if cam.url == url and isinstance(cam, kind)]
+            if protocol != PROTOCOL_TEXT:
+                server.send_message(client, json.dumps({
+                    'act': 'open', 'protocol': protocol, 'camera': cams[0].id if cams else 0,
+                    'state': cams[0].source.state.value if cams else SourceState.CONNECTING.value
+                }))
+            if primed:
+                [cam.primeClient(clts[0]) for cam in cams]
+        elif act == 'resize':
+            clts[0]['resolution'] = _parseResolution(d.get('resolution', (0, 0)), clts[0].get('resolution', (0, 0)))
+            [cam.updateClient(clts[0]) for cam in self.cameras if cam.url == clts[0].get('url')]
+        elif act == 'quality':
+            self.__setQuality(clts[0], d)
+        elif act == 'shown':
+            # 終端回報頁框已顯示(延遲量測), paint 為收到訊息至繪製完成的毫秒數
+            paint = d.get('paint')
+            if 'sender' in clts[0]:
+                clts[0]['sender'].displayed(d.get('seq', 0), paint / 1000 if isinstance(paint, (int, float)) else None)
+        elif act == 'crop':
+            # 伺服器端裁切(數位變焦), 未傳入或空值表示取消裁切
+            clts[0]['crop'] = _parseCrop(d.get('crop'))
+            clts[0].pop('tiles', None)
+            [cam.updateClient(clts[0]) for cam in self.cameras if cam.url == clts[0].get('url')]
+        elif act == 'rate':
+            # 變更最大 FPS, 0 表示跟隨來源速率
+            pacer = clts[0].get('pacer')
+            fps = _parseFps(d.get('fps', 0), None)
+            if fps is None: return
+            if pacer:
+                pacer.fps = fps
+            else:
+                clts[0]['pacer'] = FramePacer(fps)
+            [cam.updateClient(clts[0]) for cam in self.cameras if cam.url == clts[0].get('url')]
+
+    def prewarm(self, urls, fps=1.0):
+        '''預先開啟攝影機(常駐), 各串流的連線於各自的擷取執行緒中同時進行;
+        無觀看端時仍以 fps 維持解碼與編碼, 使新的觀看端可立即取得第一張頁框
+        傳入:
+            urls : list(str) - 串流網址
+            fps  : float - 無觀看端時維持的 FPS
+        傳回:
+            list(_Camera)
+        '''
+        cams = []
+        with self.__camLock:
+            for url in urls:
+                found = [cam for cam in self.cameras if cam.url == url and isinstance(cam, _Camera)]
+                if found:
+                    cam = found[0]
+                    cam.keepWarm(fps)
+                else:
+                    self.__camId += 1
+                    cam = _Camera(self.__svr, url, self.buckets, self.__camId, fps, self.__activityFor(url))
+                    cam.idleSince = time.time()
                     self.cameras.append(cam)
                     cam.start()
-                else:
-                    cam = cams[0]
-                cam.appendClient(clts[0])
-        elif act == 'resize':
-            clts[0]['resolution'] = tuple(d.get('resolution', (0, 0)))
-            [cam.updateClient(clts[0]) for cam in self.cameras if cam.url == clts[0]['url']]
+                    self.log.info(f"Camera(\x1B[92m{cam.id}\x1B[39m) pre-opened: {url}")
+                cams.append(cam)
+        return cams
+
+    def release(self, urls):
+        '''取消預先開啟(常駐), 無觀看端的攝影機於 idleTimeout 秒後停止
+        傳入:
+            urls : list(str) - 串流網址
+        '''
+        with self.__camLock:
+            cams = [cam for cam in self.cameras if cam.url in urls and cam.pinned]
+        for cam in cams:
+            cam.keepWarm(0)
+            self.log.info(f"Camera(\x1B[92m{cam.id}\x1B[39m) released: {cam.url}")
+
+    def tuneActivity(self, camera, params):
+        '''調整個別攝影機的場景變動偵測參數, 覆蓋 activity 中的同名參數, 並套用至已開啟的攝影機
+        傳入:
+            camera : str - 攝影機代號(CaptureHub.register 登錄者)或串流網址
+            params : dict - 請參閱 _ActivityGate, None 表示此攝影機停用偵測
+        '''
+        self.__tuning[camera] = params
+        with self.__camLock:
+            cams = [cam for cam in self.cameras if isinstance(cam, _Camera)]
+        for cam in cams:
+            if camera in (cam.url, cam.source.cameraId):
+                cam.tuneActivity(self.__activityFor(cam.url))
+
+    def __activityFor(self, url):
+        '''取得攝影機的場景變動偵測參數'''
+        cid = hub.cameraId(canonicalUrl(url))
+        key = url if url in self.__tuning else cid if cid in self.__tuning else None
+        if key is None:
+            return self.activity
+        params = self.__tuning[key]
+        if params is None:
+            return None
+        return dict(self.activity or {}, **params)
+
+    def __setQuality(self, client, d):
+        '''設定觀看端的壓縮品質
+        傳入:
+            client : dict - 觀看端
+            d      : dict - 請求內容, 可包含:
+                quality      : int - 固定的壓縮品質, 0 表示預設品質
+                               list - [最低品質, 最高品質], 依網路壅塞狀況自動調整品質與解析度
+                minResolution: list - [width, height] 自動調整時可接受的最低解析度, 未傳入時僅調整品質
+        '''
+        quality = d.get('quality', 0)
+        if isinstance(quality, (list, tuple)) and len(quality) == 2:
+            client['quality'] = 0
+            client['control'] = _RateControl(quality, d.get('minResolution', (0, 0)))
+        else:
+            client['quality'] = _parseQuality(quality, client.get('quality', 0))
+            client.pop('control', None)
+
+    def stats(self):
+        '''傳回所有攝影機的統計資料
+        傳回:
+            list(dict) - 每一攝影機的擷取、丟棄頁框數與編碼快取命中統計
+        '''
+        return [cam.stats for cam in self.cameras]
+
+    def latencyStats(self):
+        '''傳回每一觀看端的延遲統計, 攝影機的延遲統計請參閱 CaptureHub.latencyStats()
+        傳回:
+            list(dict) - 格式為 {'client', 'address', 'url', 'protocol', 'dropped', 'stages'}, 請參閱 LatencyTracker.stats
+        '''
+        result = []
+        for clt in list(self.clients):
+            if 'sender' not in clt: continue
+            result.append(dict(clt['sender'].latency.stats, client=clt['id'], address='%s:%s' % clt['address'][:2],
+                               url=canonicalUrl(clt.get('url', '')), protocol=clt.get('protocol', PROTOCOL_TEXT)))
+        return result
 
     def start(self):
+        self.__evt_exit.clear()
         threading.Thread(target=self.__svr.run_forever, daemon=True).start()
+        threading.Thread(target=self.__keepalive_Proc, daemon=True).start()
         ip = '*' if not self.host[0] or self.host[0] == '0.0.0.0' else self.host[0]
         self.log.info(f'RTSP WebSocket Proxy Started @ \x1B[92mws://{ip}:{self.host[1]}/\x1B[39m')
 
     def stop(self):
-        for cam in self.cameras:
-            for c in self.clients:
+        self.__evt_exit.set()
+        for c in self.clients:
+            if 'sender' in c: c['sender'].stop()
+        with self.__camLock:
+            cams, self.cameras = self.cameras, []
+        for cam in cams:
+            for c in list(self.clients):
                 cam.removeClient(c)
-                self.clients.remove(c)
             cam.stop()
             cam.join(0.1)
-            self.cameras.remove(cam)
+        self.clients = []
         self.__svr.server_close()
         self.log.warn(f'RTSP WebSocket Proxy Stoped')
 
 
 class HttpMJpegPusher(threading.Thread):
     BOUNDARY_KEY = '--jpgboundary'
+    # 傳送中的 M-Jpeg 觀看端, 供查詢延遲統計
+    active = set()
 
-    def __init__(self, handler, rtsp, size=(0, 0), quality=0):
+    def __init__(self, handler, rtsp, size=(0, 0), quality=0, fps=0, crop=None):
         super(HttpMJpegPusher, self).__init__(daemon=True)
         self.size = size or (0, 0)
         self.quality = quality or 70
+        # 裁切範圍(數位變焦), 請參閱 CaptureSource.encode
+        self.crop = crop
+        # 最大 FPS, 0 表示跟隨來源速率
+        self.pacer = FramePacer(fps)
         self.daemon = True
         self.handler = handler
         self.rtsp = rtsp
         self.__evt_exit = threading.Event()
-        self.camera = cv2.VideoCapture(rtsp)
-        if not self.camera.isOpened():
-            self.camera.open()
-        self.resolution = (
-            int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
-            int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        )
-        self.fps = int(self.camera.get(cv2.CAP_PROP_FPS))
+        # 與 RtspProxy 及其他 M-Jpeg 觀看端共用同一個擷取來源
+        self.source = hub.subscribe(rtsp)
+        self.latency = LatencyTracker(self.source.latency)
 
-    def __del__(self):
-        self.clients = []
-        if self.camera and self.camera.isOpened():
-            self.camera.release()
+    resolution = property(fget=lambda self: self.source.resolution, doc='串流原始解析度')
+    fps = property(fget=lambda self: self.source.fps, doc='串流回報的 FPS')
 
     def run(self):
         self.__evt_exit.clear()
@@ -289,47 +1515,262 @@ class HttpMJpegPusher(threading.Thread):
             self.handler.end_headers()
             time.sleep(0.2)
         except:
+            hub.unsubscribe(self.source)
             return
-        while not self.__evt_exit.wait(timeout=0.05):
-            ret, frame = self.camera.read()
-            if ret:
-                frm = frame if (self.size == (0, 0) or self.size == self.resolution) else cv2.resize(frame, self.size)
-                quality = 100 if self.quality > 100 else 0 if self.quality <= 0 else self.quality
-                if quality == 0:
-                    params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
-                    ret, jpg = cv2.imencode('.jpg', frm, params)
-                else:
-                    ret, jpg = cv2.imencode('.jpg', frm)
-                try:
-                    self.handler.wfile.write(f'{self.BOUNDARY_KEY}\r\n'.encode('latin-1', 'strict'))
-                    self.handler.send_header('Content-type', 'image/jpeg')
-                    self.handler.send_header('Content-length', str(jpg.size))
-                    self.handler.end_headers()
-                    self.handler.wfile.write(jpg.tostring())
-                    self.handler.wfile.write(b'\r\n\r\n')
-                    self.handler.wfile.flush()
-                except (OSError, ConnectionResetError):
-                    break
-                except:
-                    pass
-            else:
-                # 讀取失敗，重置 IP Cam
-                if self.__evt_exit.isSet(): break
-                self.camera = cv2.VideoCapture(self.url)
-                if not self.camera.isOpened(): self.camera.open()
+        last = 0
+        HttpMJpegPusher.active.add(self)
+        try:
+            # 先送出最後一次編碼完成的 JPEG, 不必等待第一張即時頁框
+            jpg = self.source.lastJpeg[2] if not self.crop else None
+            if jpg and not self.__writeFrame(jpg): return
+            while not self.__evt_exit.isSet():
+                frame, seq, ts = self.source.latestFrame(last, timeout=0.5)
+                if frame is None: continue
+                if last and seq - last > 1 and not self.pacer.fps:
+                    # 未限制 FPS 時, 編碼或寫入過慢而未送出的頁框
+                    self.latency.drop(seq - last - 1)
+                last = seq
+                if not self.pacer.due(ts, self.source.rate): continue
+                jpg = self.source.encode(frame, seq, self.size, self.quality, self.crop)
+                if jpg is None: continue
+                ready = time.time()
+                if not self.__writeFrame(jpg): break
+                now = time.time()
+                self.source.bytesSent.add(len(jpg))
+                self.latency.observe('ready', ready - ts)
+                self.latency.observe('send', now - ready)
+                self.latency.observe('total', now - ts)
+                self.source.demand(self, self.pacer.next)
+        finally:
+            HttpMJpegPusher.active.discard(self)
+            self.source.demand(self, None)
+            hub.unsubscribe(self.source)
+
+    def __writeFrame(self, jpg):
+        '''送出一張 JPEG
+        傳回:
+            bool - 連線已中斷時傳回 False
+        '''
+        try:
+            self.handler.wfile.write(f'{self.BOUNDARY_KEY}\r\n'.encode('latin-1', 'strict'))
+            self.handler.send_header('Content-type', 'image/jpeg')
+            self.handler.send_header('Content-length', str(len(jpg)))
+            self.handler.end_headers()
+            self.handler.wfile.write(jpg)
+            self.handler.wfile.write(b'\r\n\r\n')
+            self.handler.wfile.flush()
+        except (OSError, ConnectionResetError):
+            return False
+        except:
+            pass
+        return True
 
     def stop(self):
         self.__evt_exit.set()
         time.sleep(0.1)
 
+    @classmethod
+    def latencyStats(cls):
+        '''傳回每一 M-Jpeg 觀看端的延遲統計
+        傳回:
+            list(dict) - 格式為 {'client', 'address', 'url', 'protocol', 'dropped', 'stages'}, protocol 為 'mjpeg'
+        '''
+        result = []
+        for pxy in list(cls.active):
+            address = pxy.handler.client_address if hasattr(pxy.handler, 'client_address') else ('', 0)
+            result.append(dict(pxy.latency.stats, client=id(pxy), address='%s:%s' % tuple(address[:2]),
+                               url=pxy.source.key, protocol='mjpeg'))
+        return result
+
+
+class _SnapshotSource(object):
+    '''快照服務對單一串流的訂閱, 最後一次請求後保留 linger 秒'''
+    def __init__(self, url):
+        self.url = url
+        self.source = hub.subscribe(url)
+        self.lastUsed = time.time()
+        self.waiters = 0
+        self.source.demand(self, float('inf'))
+
+    def wait(self, newerThan, timeout):
+        '''等待擷取時間(毫秒)晚於 newerThan 的頁框, 等待期間才要求擷取來源解碼
+        傳回:
+            tuple(frame, seq:int, timestamp:float) - 逾時時 frame 為 None
+        '''
+        self.waiters += 1
+        self.source.demand(self, 0.0)
+        try:
+            limit = time.time() + timeout
+            frame, seq, ts = self.source.latestFrame(0)
+            while frame is None or int(ts * 1000) <= newerThan:
+                left = limit - time.time()
+                if left <= 0 or self.source.stopped:
+                    return None, seq, ts
+                nframe, nseq, nts = self.source.latestFrame(seq, min(left, 0.5))
+                if nframe is not None:
+                    frame, seq, ts = nframe, nseq, nts
+            return frame, seq, ts
+        finally:
+            self.waiters -= 1
+            self.lastUsed = time.time()
+            if not self.waiters:
+                self.source.demand(self, float('inf'))
+
+    def close(self):
+        self.source.demand(self, None)
+        hub.unsubscribe(self.source)
+
+
+class HttpSnapshot(object):
+    def __init__(self, maxAge=1.0, linger=30.0, pollTimeout=25.0, log=None):
+        '''以共用的最新頁框與 JPEG 編碼快取提供單張快照, 支援條件式 GET 與等待新頁框的長輪詢(long-poll)
+
+        請求: GET /snapshot/<id>.jpg?size=WxH&q=N[&after=<etag>]
+            * 回應含 ETag 與 Last-Modified, 帶 If-None-Match 或 If-Modified-Since 且頁框未更新時回應 304
+            * 帶 after=<etag> 時, 待有比該 ETag 更新的頁框才回應, 逾時則回應 304
+        串流於最後一次請求後保留 linger 秒, 期間無請求時只 grab() 不解碼; 同一頁框、同輸出參數只編碼一次
+
+        傳入:
+            maxAge      : float - 最新頁框超過此秒數時, 等待新頁框後再回應
+            linger      : float - 最後一次請求後保留串流的秒數
+            pollTimeout : float - 長輪詢的最長等待秒數
+            log         : logging.Logger
+        '''
+        self.maxAge = maxAge
+        self.linger = linger
+        self.pollTimeout = pollTimeout
+        self.log = log
+        self.__lock = threading.Lock()
+        self.__sources = {}
+        self.__reaper = None
+        self.served = 0
+        self.notModified = 0
+
+    @staticmethod
+    def etag(timestamp, resolution, quality):
+        '''以頁框擷取時間(毫秒)與輸出參數產生 ETag'''
+        return f'"{int(timestamp * 1000)}-{resolution[0]}x{resolution[1]}-{quality}"'
+
+    @staticmethod
+    def _etagTime(tag):
+        '''取出 ETag 中的頁框擷取時間(毫秒), 格式錯誤時傳回 0'''
+        m = re.match(r'(?:W/)?"?(\d+)-', (tag or '').strip())
+        return int(m.group(1)) if m else 0
+
+    def __acquire(self, url):
+        with self.__lock:
+            snap = self.__sources.get(url)
+            if snap is None or snap.source.stopped:
+                snap = self.__sources[url] = _SnapshotSource(url)
+            snap.lastUsed = time.time()
+            if self.__reaper is None:
+                self.__reaper = threading.Thread(target=self.__reap_Proc, daemon=True)
+                self.__reaper.start()
+            return snap
+
+    def __reap_Proc(self):
+        '''釋放超過 linger 秒未被請求的串流'''
+        while True:
+            time.sleep(min(self.linger, 5.0) or 1.0)
+            now = time.time()
+            with self.__lock:
+                idle = [snap for snap in self.__sources.values()
+                        if not snap.waiters and now - snap.lastUsed >= self.linger]
+                for snap in idle:
+                    del self.__sources[snap.url]
+            for snap in idle:
+                snap.close()
+
+    def serve(self, handler, rtsp, size=(0, 0), quality=0, after=None):
+        '''回應快照請求
+        傳入:
+            handler : BaseHTTPRequestHandler - HTTP 請求處理器
+            rtsp    : str - 串流網址
+            size    : tuple - 輸出解析度, (0, 0) 表示原始解析度
+            quality : int - 壓縮品質, 0 表示預設品質
+            after   : str - 長輪詢, 等待比此 ETag 更新的頁框
+        '''
+        size = tuple(size) if size else (0, 0)
+        snap = self.__acquire(rtsp)
+        if after:
+            newerThan, timeout = self._etagTime(after), self.pollTimeout
+        else:
+            # 最新頁框已過舊(如無人觀看時未解碼)才等待新頁框
+            frame, seq, ts = snap.source.latestFrame(0)
+            fresh = frame is not None and time.time() - ts <= self.maxAge
+            newerThan, timeout = (0, 0.0) if fresh else (int((time.time() - self.maxAge) * 1000), 2.0)
+        frame, seq, ts = snap.wait(newerThan, timeout)
+        if frame is None and not after:
+            # 取不到新頁框時仍以最後一張頁框回應
+            frame, seq, ts = snap.source.latestFrame(0)
+        if frame is None:
+            if after:
+                self.__notModified(handler, after)
+            else:
+                handler.send_error(HTTPStatus.SERVICE_UNAVAILABLE, f'Stream not ready: {snap.source.state.value}')
+            return
+        tag = self.etag(ts, size, quality)
+        if self.__fresh(handler, tag, ts):
+            self.__notModified(handler, tag, ts)
+            return
+        jpg = snap.source.encode(frame, seq, size, quality)
+        if jpg is None:
+            handler.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, 'Encode failed')
+            return
+        handler.send_response(HTTPStatus.OK)
+        handler.send_header('Content-Type', 'image/jpeg')
+        handler.send_header('Content-Length', str(len(jpg)))
+        handler.send_header('ETag', tag)
+        handler.send_header('Last-Modified', formatdate(ts, usegmt=True))
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+        handler.wfile.write(jpg)
+        self.served += 1
+
+    def __fresh(self, handler, tag, ts):
+        '''依 If-None-Match 或 If-Modified-Since 判斷觀看端的快照是否仍為最新'''
+        inm = handler.headers.get('If-None-Match')
+        if inm:
+            return tag in [t.strip() for t in inm.split(',')] or inm.strip() == '*'
+        ims = handler.headers.get('If-Modified-Since')
+        if ims:
+            try:
+                return int(ts) <= parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def __notModified(self, handler, tag, ts=0.0):
+        handler.send_response(HTTPStatus.NOT_MODIFIED)
+        handler.send_header('ETag', tag)
+        if ts:
+            handler.send_header('Last-Modified', formatdate(ts, usegmt=True))
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+        self.notModified += 1
+
+    def stats(self):
+        '''傳回快照服務統計資料'''
+        with self.__lock:
+            urls = [snap.url for snap in self.__sources.values()]
+        return {'served': self.served, 'notModified': self.notModified, 'streams': urls}
+
+    def stop(self):
+        with self.__lock:
+            snaps, self.__sources = list(self.__sources.values()), {}
+        for snap in snaps:
+            snap.close()
+
 
 if __name__ == "__main__":
     import sys
     args = sys.argv[1:]
     if not args:
-        print('usage: python rtspProxy.py ip:port')
+        # 模組使用相對匯入, 須於專案根目錄以 -m 執行
+        print('usage: python -m cctv.rtspProxy ip:port')
         sys.exit(0)
-    proxy = RtspProxy(tuple(args[0].split(':')))
+    ip, _, port = args[0].rpartition(':')
+    proxy = RtspProxy((ip, int(port)))
     proxy.start()
     ip = '*' if not proxy.host[0] or proxy.host[0] == '0.0.0.0' else proxy.host[0]
     print(f'RTSP WebSocket Proxy Started @ \x1B[92mws://{ip}:{proxy.host[1]}/\x1B[39m')
@@ -1,10 +1,16 @@
 #! /usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import sys, os, socket, readline
+import sys, os, socket, readline, json
+from http import HTTPStatus
 from webSvc import HttpService, WebHandler, HttpEvents
 from cctv.agent import CCTV_Agent as CCTV, AgentEvents
-from cctv.rtspProxy import RtspProxy, HttpMJpegPusher
+from cctv.rtspProxy import RtspProxy, HttpMJpegPusher, HttpSnapshot
+from cctv.captureHub import hub as _Hub, HubEvents
+from cctv.mosaic import mosaicUrl, parseLayout
+from cctv.metrics import collector as metricsCollector
+from cctv.encodePool import EncodePool
+from cctv.jpegEncoder import createEncoder
 
 class Completer:
     def __init__(self, words):
@@ -30,16 +36,36 @@ readline.parse_and_bind('tab: complete')
 readline.parse_and_bind('set editing-mode vi')
 readline.set_completer(completer.complete)
 
+# "Activity" 可個別調整該攝影機的場景變動偵測參數(覆蓋 _SceneActivity), None 表示停用
+# "Frozen" 為停格偵測秒數, 畫面超過此秒數完全未變動時重新連線, 未設定表示不檢查(靜態場景請勿設定)
 _IpCams = [
     {"ID": "A-1", "IP": "172.18.0.87", "Profile": "OnvifProfile2", "User": "admin", "Passwd": ""}
 ]
 _HttpPort = 8000
 _ProxyPort = 8001
+# 攝影機無觀看端超過此秒數後停止擷取
+_ProxyIdleTimeout = 30.0
+# 啟動時預先開啟所有 IP Cam 選用(useit)的串流, 切換畫面時可立即顯示
+_PrewarmCameras = False
+# 場景變動偵測: 畫面靜止時僅定時送出保活頁框, 偵測到變動時恢復全速, None 表示停用
+#   threshold: 像素灰階差異門檻, area: 變動像素比例, keepalive: 靜止時送出間隔(秒), hold: 變動後維持全速秒數
+_SceneActivity = None
+# JPEG 編碼器: 'opencv'(預設)、'simplejpeg'、'turbojpeg' 或 'auto'(已安裝 libjpeg-turbo 實作時優先使用)
+_JpegBackend = 'opencv'
+# 使用 fast DCT 與色度抽樣('444'、'422'、'420'), None 表示使用該編碼器的預設值
+_JpegFastDct = None
+_JpegSubsampling = None
+# JPEG 編碼子程序數量, 0 表示於本程序內以執行緒編碼
+_EncodeWorkers = 0
+# 共享記憶體頁框環的槽數, 供其他程序(如影像分析)以攝影機 ID 讀取頁框, 0 表示不建立
+_FrameRingSlots = 0
+_Pool: EncodePool = None
 _LocalDomain = []
 _Agent: CCTV = None
 _Proxy: RtspProxy = None
 _WebSvr: HttpService = None
 _MJpeg: HttpMJpegPusher = None
+_Snapshot: HttpSnapshot = HttpSnapshot()
 _log = None
 
 _help_commands_ = '''usage: command [argument]
@@ -62,6 +88,11 @@ commands and arguments:
           > info      : Display IP Cam detail information by ID
             >> id     : IP Cam's ID
           > proxy     : 
+            >> reset  : Restart RTSP WebSocket Proxy
+            >> stats  : Display proxy statistics of each camera
+            >> hub    : Display shared capture sources and subscriber counts
+            >> pool   : Display JPEG encode worker utilisation
+            >> latency: Display frame latency percentiles of each camera and client
 '''
 
 def _setLogger():
@@ -86,7 +117,7 @@ def _entry():
     print(f'Run as Python \x1B[92mv{sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}\x1B[39m')
     print('-' * 70)
     # Set Local Domain name
-    global _LocalDomain, _IpCams, _Agent, _WebSvr, _Proxy
+    global _LocalDomain, _IpCams, _Agent, _WebSvr, _Proxy, _Pool
     _LocalDomain.append(socket.gethostname())
     _LocalDomain.append(socket.gethostbyname(socket.gethostname()))
     _setLogger()
@@ -96,6 +127,10 @@ def _entry():
     _Agent.bind(AgentEvents.JOINED, _cctvJoined)
     _Agent.bind(AgentEvents.UPDATE, _cctvUpdate)
     _Agent.start()
+    _Hub.ringSlots = _FrameRingSlots
+    _Hub.bind(HubEvents.STATE, _captureState)
+    for ipc in _Agent.ipcams:
+        _registerCamera(ipc)
     # Create HTTP Service
     WebHandler.remoteAccess = True
     if hasattr(WebHandler, 'events'):
@@ -104,9 +139,28 @@ def _entry():
     _WebSvr.bind(HttpEvents.STARTED, lambda: _log.info(f'HTTP Server Starting @ Port: \x1B[92m{_WebSvr.port}\x1B[39m'))
     _WebSvr.bind(HttpEvents.STOPED, lambda: _log.warn(f'HTTP Server Stoped!'))
     _WebSvr.start()
+    # Select JPEG Encoder
+    try:
+        _Hub.jpeg = createEncoder(_JpegBackend, _JpegFastDct, _JpegSubsampling)
+        _log.info(f'JPEG Encoder: \x1B[92m{_Hub.jpeg}\x1B[39m')
+    except (ImportError, KeyError, ValueError, OSError) as ex:
+        _log.warn(f'JPEG Encoder "{_JpegBackend}" unavailable, use OpenCV: {ex}')
+    # Create JPEG Encoding Process Pool
+    if _EncodeWorkers > 0:
+        _Pool = EncodePool(_EncodeWorkers)
+        _Hub.encoder = _Pool
+        _log.info(f'JPEG Encode Pool Started, Workers: \x1B[92m{_EncodeWorkers}\x1B[39m')
     # Create RTSP Streaming Proxy over WebSocket
-    _Proxy = RtspProxy(host=('', _ProxyPort), log=_log)
+    _Proxy = RtspProxy(host=('', _ProxyPort), log=_log, idleTimeout=_ProxyIdleTimeout, activity=_SceneActivity)
+    for ipc in _IpCams:
+        if 'Activity' in ipc:
+            _Proxy.tuneActivity(ipc['ID'], ipc['Activity'])
     _Proxy.start()
+    # Prometheus Metrics: GET /metrics
+    if hasattr(_WebSvr, 'metrics'):
+        _WebSvr.metrics.register(metricsCollector(_Proxy, _Agent, _Pool))
+    if _PrewarmCameras:
+        _Proxy.prewarm([url for _, url in _rtspUrls()])
     # Console Wait Command Input
     _waitStdin()
 
@@ -215,6 +269,31 @@ def _waitStdin():
                         if cmds[2] == 'reset':
                             _Proxy.stop()
                             _Proxy.start()
+                        elif cmds[2] == 'stats':
+                            print('Captured Dropped  Hits     Misses   Clients Static   Url')
+                            for st in _Proxy.stats():
+                                act = st.get('activity')
+                                print(f"{st['captured']:<8} {st['dropped']:<8} {st['cache']['hits']:<8} ", end='')
+                                print(f"{st['cache']['misses']:<8} {st['clients']:<7} {act['skipped'] if act else '-':<8} {st['url']}")
+                        elif cmds[2] == 'hub':
+                            print('Subs Resolution  FPS Captured Hit%   Url')
+                            for st in _Hub.stats():
+                                resol = f"{st['resolution'][0]}x{st['resolution'][1]}"
+                                print(f"{st['subscribers']:<4} {resol:<11} {st['fps']:<3} {st['captured']:<8} ", end='')
+                                print(f"{st['cache']['ratio']:<6.1%} {st['url']}")
+                        elif cmds[2] == 'latency':
+                            st = _latencyStats()
+                            print('Camera/Client             Stage    Count    p50(ms)  p95(ms)  p99(ms)  Dropped')
+                            _printLatency([(c['id'], c) for c in st['cameras']])
+                            _printLatency([(f"{c['protocol']}@{c['address']}", c) for c in st['clients']])
+                        elif cmds[2] == 'pool':
+                            if not _Pool:
+                                print('JPEG encode pool is disabled')
+                                continue
+                            print('No. PID      Jobs       Errors Busy(s)    Usage  Avg')
+                            for st in _Pool.stats():
+                                print(f"{st['worker']:<3} {st['pid']:<8} {st['jobs']:<10} {st['errors']:<6} ", end='')
+                                print(f"{st['busy']:<10.1f} {st['utilisation']:<6.1%} {st['average']:.1%}")
                 else:
                     print('Unknow command!')
             except SystemExit:
@@ -226,41 +305,134 @@ def _waitStdin():
             break
     print('\x1B[39;49m')
 
+def _latencyStats():
+    '''取得每一攝影機與每一觀看端(WebSocket 與 M-Jpeg)的延遲統計'''
+    return {
+        'cameras': _Hub.latencyStats(),
+        'clients': (_Proxy.latencyStats() if _Proxy else []) + HttpMJpegPusher.latencyStats(),
+    }
+
+def _printLatency(rows):
+    for name, st in rows:
+        stages = list(st['stages'].items()) or [('-', None)]
+        for i, (stage, h) in enumerate(stages):
+            print(f"{name if i == 0 else '':<25} {stage:<8} ", end='')
+            if h:
+                print(f"{h['count']:<8} {h['p50']:<8.1f} {h['p95']:<8.1f} {h['p99']:<8.1f} ", end='')
+            else:
+                print(f"{'-':<8} {'-':<8} {'-':<8} {'-':<8} ", end='')
+            print(st['dropped'] if i == 0 else '')
+
 def _stopServer():
     _Agent.stop()
     _WebSvr.stop()
     _Proxy.stop()
+    _Snapshot.stop()
+    if _Pool: _Pool.stop()
     raise SystemExit()
 
 def _cctvJoined(info):
     print(f'\x1B[92m[*]\x1B[39m CCTV Joined...')
     print(info)
+    _registerCamera(info)
 
 def _cctvUpdate(ip, info):
     print(f'\x1B[92m[*]\x1B[39m CCTV Information Updated...')
     print(f'    IP Addr: \x1B[92m{ip}\x1B[39m')
     print(f'    Update : \x1B[92m{info}\x1B[39m')
+    for ipc in _Agent.findDevices(ip=ip) or []:
+        _registerCamera(ipc)
 
-def _rtspUrls():
-    '''取得所有 IP Cam 的 RTSP 的網址
+def _registerCamera(ipc):
+    '''將 IP Cam 選用(useit)的串流登錄至擷取中心, 串流網址變更時先取消舊網址的登錄;
+    _PrewarmCameras 時一併預先開啟(Proxy 啟動前加入者由啟動時的 prewarm 開啟)
 
+    傳入:
+        ipc : dict - _Agent.ipcams 的項目
     傳回:
-        tuple(id:str, url:str)
+        str - 串流網址, 尚無攝影機代號或選用的 Profile 時傳回 None
+    '''
+    id = ipc.get('id')
+    pfs = [pf for pf in ipc.get('profiles') or [] if pf['useit']]
+    if not id or not pfs: return None
+    url = pfs[0]['url']
+    old = _Hub.urlOf(id)
+    if old not in (None, url):
+        _Hub.unregister(id)
+        if _PrewarmCameras and _Proxy: _Proxy.release([old])
+    _Hub.register(id, url, pfs[0].get('encoding'), _frozenTimeout(id))
+    # 啟動後才加入(或變更串流)的攝影機, 啟動時的 prewarm 尚未涵蓋
+    if _PrewarmCameras and _Proxy: _Proxy.prewarm([url])
+    return url
+
+def _captureState(source, old, new, reason):
+    msg = f'Camera(\x1B[92m{source.cameraId}\x1B[39m) {old.value} -> \x1B[93m{new.value}\x1B[39m'
+    if reason:
+        msg += f' ({reason})'
+    _log.info(msg)
+
+def _useitProfiles():
+    '''取得所有 IP Cam 選用(useit)的 Profile
+
+    傳回:
+        tuple(id:str, profile:dict)
     '''
     for ipc in _Agent.ipcams:
         pfs = [pf for pf in ipc['profiles'] if pf['useit']]
         if not pfs: continue
-        yield (ipc['id'], pfs[0]['url'])
+        yield (ipc['id'], pfs[0])
+
+def _frozenTimeout(id):
+    '''取得 IP Cam 設定的停格偵測秒數("Frozen"), 0 表示不檢查'''
+    return next((ipc.get('Frozen', 0) for ipc in _IpCams if ipc['ID'] == id), 0)
+
+def _rtspUrls():
+    '''取得所有 IP Cam 的 RTSP 的網址
+
+    傳回:
+        tuple(id:str, url:str)
+    '''
+    for id, pf in _useitProfiles():
+        yield (id, pf['url'])
+
+def _mosaicUrl(query):
+    '''由 /live/mosaic 的查詢參數產生組合畫面網址, 輸出解析度(size)即為組合畫面的解析度, 不需再縮放
+
+    傳回:
+        str - 格式錯誤時傳回 None
+    '''
+    arg = lambda name: query[name][0] if name in query else None
+    url = mosaicUrl(arg('cams').split(','), arg('grid'), arg('size'))
+    try:
+        parseLayout(url)
+    except ValueError:
+        return None
+    return url
 
 def _WebGET(handler, cnt):
     if not CCTV: return
     ri = cnt['info']
     fds = ri.url.split('/')
-    if len(fds) < 2 or fds[0].lower() != 'live':
+    if ri.url.lower() == 'latency':
+        # 延遲統計: GET /latency, 格式為 {"cameras": [...], "clients": [...]}
+        cnt['handled'] = True
+        handler._responseContent('application/json', json.dumps(_latencyStats()))
+        return
+    if len(fds) < 2 or fds[0].lower() not in ('live', 'snapshot'):
+        return
+    cid = fds[1][:-4] if fds[0].lower() == 'snapshot' and fds[1].lower().endswith('.jpg') else fds[1]
+    if cid.lower() == 'mosaic':
+        # 多攝影機組合畫面: /live/mosaic?cams=A-1,A-2,,A-4[&grid=2x2][&size=1280x720]
+        urls = [_mosaicUrl(ri.query)] if ri.query and 'cams' in ri.query else []
+    else:
+        urls = [url for id, url in _rtspUrls() if id.lower() == cid.lower()]
+    cnt['handled'] = True
+    if urls and urls[0] is None:
+        handler.send_error(HTTPStatus.BAD_REQUEST, 'Invalid mosaic layout')
         return
-    urls = [url for id, url in _rtspUrls() if id.lower() == fds[1].lower()]
     if not urls:
-        handler.send_error((404, 'Not Found', 'Nothing matches the given URI'), f'Not found ID:{fds[1]}')
+        handler.send_error(HTTPStatus.NOT_FOUND, f'Not found ID:{cid}')
+        return
     try:
         resolution = tuple([int(x) for x in ri.query['size'][0].split('x')]) if ri.query and 'size' in ri.query else(0, 0)
     except:
@@ -269,8 +441,19 @@ def _WebGET(handler, cnt):
         quality = int(ri.query['q'][0]) if ri.query and 'q' in ri.query else 0
     except:
         quality = 0
-    cnt['handled'] = True
-    pxy = HttpMJpegPusher(handler, urls[0], resolution, quality)
+    try:
+        fps = float(ri.query['fps'][0]) if ri.query and 'fps' in ri.query else 0
+    except:
+        fps = 0
+    if fds[0].lower() == 'snapshot':
+        after = ri.query['after'][0] if ri.query and 'after' in ri.query else None
+        _Snapshot.serve(handler, urls[0], resolution, quality, after)
+        return
+    try:
+        crop = tuple([float(x) for x in ri.query['crop'][0].split(',')]) if ri.query and 'crop' in ri.query else None
+    except:
+        crop = None
+    pxy = HttpMJpegPusher(handler, urls[0], resolution, quality, fps, crop)
     pxy.start()
 
 
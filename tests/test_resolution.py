@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cctv.rtspProxy import RESOLUTION_BUCKETS, _snapResolution, _scaleResolution
+
+
+def _ratio(resolution):
+    return resolution[0] / resolution[1]
+
+
+class SnapResolutionTest(unittest.TestCase):
+    def test_unchanged_without_buckets(self):
+        self.assertEqual(_snapResolution((333, 222), None), (333, 222))
+        self.assertEqual(_snapResolution((0, 0), RESOLUTION_BUCKETS), (0, 0))
+
+    def test_snaps_to_smallest_fitting_width(self):
+        self.assertEqual(_snapResolution((300, 225), RESOLUTION_BUCKETS), (320, 240))
+        self.assertEqual(_snapResolution((400, 300), RESOLUTION_BUCKETS), (640, 480))
+        self.assertEqual(_snapResolution((1280, 720), RESOLUTION_BUCKETS), (1280, 720))
+
+    def test_keeps_requested_aspect_ratio(self):
+        w, h = _snapResolution((600, 300), RESOLUTION_BUCKETS)
+        self.assertEqual(w, 640)
+        self.assertAlmostEqual(_ratio((w, h)), 2.0, places=1)
+
+    def test_larger_than_largest_bucket(self):
+        self.assertEqual(_snapResolution((3840, 2160), RESOLUTION_BUCKETS), (1920, 1080))
+
+    def test_portrait_clamped_to_largest_bucket(self):
+        # 360x640 對齊寬度 640 後高度為 1138, 需等比例縮小至最大級距以內
+        w, h = _snapResolution((360, 640), RESOLUTION_BUCKETS)
+        self.assertLessEqual(h, 1080)
+        self.assertLessEqual(w, 1920)
+        self.assertAlmostEqual(_ratio((w, h)), 360 / 640, places=2)
+
+    def test_extreme_ratio_clamped(self):
+        w, h = _snapResolution((100, 3000), RESOLUTION_BUCKETS)
+        self.assertLessEqual(h, 1080)
+        self.assertGreaterEqual(w, 2)
+        self.assertEqual((w % 2, h % 2), (0, 0))
+
+    def test_clamped_to_source(self):
+        self.assertEqual(_snapResolution((400, 300), RESOLUTION_BUCKETS, (352, 264)), (352, 264))
+        w, h = _snapResolution((360, 640), RESOLUTION_BUCKETS, (480, 640))
+        self.assertLessEqual(w, 480)
+        self.assertLessEqual(h, 640)
+        self.assertAlmostEqual(_ratio((w, h)), 360 / 640, places=2)
+
+    def test_unknown_source_not_limited(self):
+        self.assertEqual(_snapResolution((400, 300), RESOLUTION_BUCKETS, (0, 0)), (640, 480))
+
+
+class ScaleResolutionTest(unittest.TestCase):
+    def test_no_scaling(self):
+        self.assertEqual(_scaleResolution((640, 480), 1.0), (640, 480))
+        self.assertEqual(_scaleResolution((0, 0), 0.5), (0, 0))
+
+    def test_scales_both_sides(self):
+        self.assertEqual(_scaleResolution((640, 480), 0.5), (320, 240))
+
+    def test_results_are_even(self):
+        w, h = _scaleResolution((642, 362), 0.7)
+        self.assertEqual((w % 2, h % 2), (0, 0))
+
+    def test_minimum(self):
+        self.assertEqual(_scaleResolution((640, 480), 0.25, (320, 240)), (320, 240))
+
+    def test_buckets_keep_aspect_ratio(self):
+        w, h = _scaleResolution((1280, 720), 0.6, buckets=RESOLUTION_BUCKETS)
+        self.assertEqual(w, 640)
+        self.assertAlmostEqual(_ratio((w, h)), 1280 / 720, places=1)
+
+    def test_buckets_below_smallest(self):
+        w, h = _scaleResolution((640, 480), 0.1, buckets=RESOLUTION_BUCKETS)
+        self.assertEqual((w, h), (320, 240))
+
+
+if __name__ == '__main__':
+    unittest.main()
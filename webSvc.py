@@ -11,7 +11,7 @@ from urllib import request
 from urllib.parse import urlparse, parse_qs, unquote
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-__all__ = ['getMimeType', 'WebHandler']
+__all__ = ['getMimeType', 'WebHandler', 'Metrics']
 
 RequestInfo = namedtuple('RequestInfo',
                          ['ip', 'url', 'query', 'path', 'file', 'isFolder',
@@ -31,6 +31,67 @@ def getMimeType(filename):
     return mime_type[0]
 
 
+class Metrics(object):
+    '''Prometheus 文字格式(0.0.4)的度量資料, 由 HttpService 於 /metrics 提供
+
+    各模組以 register() 登錄收集函式, 於每次讀取(scrape)時才取得目前的數值,
+    計數本身由各模組自行累加(不經過此類別), 不會在影像處理的熱路徑上加鎖
+    '''
+    def __init__(self):
+        self.__collectors = []
+
+    def register(self, collector):
+        '''登錄收集函式
+        傳入:
+            `collector` `def` -- 無參數, 傳回 list(tuple(name, type, help, samples)),
+                                 type 為 'counter' | 'gauge' | 'histogram',
+                                 samples 為 list(tuple(suffix, labels:dict, value)), suffix 如 '', '_bucket', '_sum'
+        引發錯誤:
+            `TypeError` -- 型別錯誤，必須為可呼叫執行的函式
+        '''
+        if not callable(collector):
+            raise TypeError('"collector" not define or not a function!')
+        self.__collectors.append(collector)
+
+    def unregister(self, collector):
+        if collector in self.__collectors:
+            self.__collectors.remove(collector)
+
+    def render(self):
+        '''產生 Prometheus 文字格式內容, 收集失敗的函式略過並記錄於日誌'''
+        lines = []
+        for collector in list(self.__collectors):
+            try:
+                families = collector()
+            except Exception:
+                HttpService.logger.exception('metrics collector error!')
+                continue
+            for name, kind, doc, samples in families:
+                lines.append(f'# HELP {name} {self.__escape(doc, False)}')
+                lines.append(f'# TYPE {name} {kind}')
+                for suffix, labels, value in samples:
+                    lines.append(f'{name}{suffix}{self.__labels(labels)} {self.__value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __escape(text, quote=True):
+        text = str(text).replace('\\', '\\\\').replace('\n', '\\n')
+        return text.replace('"', '\\"') if quote else text
+
+    @classmethod
+    def __labels(cls, labels):
+        if not labels: return ''
+        return '{' + ','.join(f'{k}="{cls.__escape(v)}"' for k, v in labels.items()) + '}'
+
+    @staticmethod
+    def __value(value):
+        value = float(value)
+        if value == float('inf'): return '+Inf'
+        if value == float('-inf'): return '-Inf'
+        if value != value: return 'NaN'
+        return str(int(value)) if value.is_integer() and abs(value) < 1e15 else repr(value)
+
+
 class HttpEvents(Enum):
     STARTED = 'onStarted'
     STOPED = 'onStoped'
@@ -53,13 +114,16 @@ class HttpService:
         self.handler.webRoot = root
         self.handler.logger = self.logger
         self.handler.server_version = self.server_version
+        # 度量資料, 由各模組登錄收集函式, 請參閱 Metrics
+        self.metrics = Metrics()
+        self.handler.metrics = self.metrics
         self.host = host
         self.__svr = ThreadingHTTPServer(self.host, self.handler)
         self.__svr.timeout = 0.5
         self.__thd = threading.Thread(target=self.__httpWeb_Proc, daemon=True, args=(self.__svr, ))
 
     port = property(fget=lambda self: self.__svr.server_port, doc='服務監聽的通訊埠號')
-    started = property(fget=lambda self: self.__thd.isAlive(), doc='是否執行中')
+    started = property(fget=lambda self: self.__thd.is_alive(), doc='是否執行中')
 
     # Thread Methods
     def __httpWeb_Proc(self, svr):
@@ -79,14 +143,15 @@ class HttpService:
             url = f'http://{self.__svr.server_name}:{self.__svr.server_port}/fake.link'
             req = request.Request(url)
             req.get_method = lambda: 'HEAD'
-            request.urlopen(req)
+            # handle_request() 本身每 0.5 秒逾時一次, 假連線無回應時不可無限等待
+            request.urlopen(req, timeout=1.0)
         except Exception:
             pass
 
     def start(self):
         self.__evt_exit.clear()
         self.__thd.start()
-        while not self.__thd.isAlive():
+        while not self.__thd.is_alive():
             time.sleep(0.1)
         if self.__evts[HttpEvents.STARTED]:
             self.__evts[HttpEvents.STARTED]()
@@ -143,6 +208,7 @@ class WebHandler(BaseHTTPRequestHandler):
     logger = logging.getLogger(__name__)
     deviceKeys = []
     dynamicVars = None
+    metrics = None
 
     # Orerride Methods
     def do_GET(self):
@@ -154,6 +220,10 @@ class WebHandler(BaseHTTPRequestHandler):
             if not ri:
                 self.send_error(HTTPStatus.BAD_REQUEST)
                 return
+            if ri.url == 'metrics' and self.metrics:
+                # Prometheus 度量資料 => http://domain/metrics
+                self._responseContent('text/plain; version=0.0.4', self.metrics.render())
+                return
             if self.events[HttpEvents.GET]:
                 cnt = {'info': ri, 'handled': False}
                 self.events[HttpEvents.GET](self, cnt)
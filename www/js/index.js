@@ -7,6 +7,10 @@ var cctv = {
         { 'ID': 'A-1', 'OSD': 'OSD 顯示', 'resolution':[640, 480], 'Type': 'mjpeg' },
         { 'ID': 'A-1', 'OSD': 'OSD 顯示', 'Type': 'ws' },
         { 'ID': 'A-1', 'OSD': 'OSD 顯示', 'Type': 'mjpeg' }
+        // H.264 串流可使用 'Type': 'mse', 以 <video> 播放不轉碼的串流, 不支援時自動改用 JPEG
+        // 高解析度且畫面多為靜止者可使用 'Type': 'tiles', 以 <canvas> 僅接收變動的分塊
+        // 低效能的顯示端可改用單一面板顯示伺服器組合的多攝影機畫面(只需解碼一個串流), 如:
+        // { 'Mosaic': ['A-1', 'A-2', '', 'A-4'], 'resolution':[1280, 720], 'Type': 'ws' }, 空字串為空格子
     ],
     Stream: [
         { 'ID': 'A-1', 'IP': '172.18.0.87', 'Url': 'rtsp://172.18.0.87/onvif-media/media.amp?streamprofile=Profile2&audio=0' },
@@ -45,13 +49,18 @@ function setPanels(panels) {
         div.attr({ 'id': 'dCam-' + (i + 1), 'data-no': i });
         var pan = panels[i];
         if (typeof pan != 'undefined' && pan != null) {
-            var player = $('<img/>');
+            var player = (pan['Type'] == 'mse') ? $('<video/>').attr({ 'muted': '', 'autoplay': '', 'playsinline': '' }).prop('muted', true)
+                : (pan['Type'] == 'tiles') ? $('<canvas/>') : $('<img/>');
             player.attr({ 'id': 'view-' + (i + 1), 'data-id': pan['ID'], 'data-type': pan['Type'] })
                 .addClass('VideoFrame')
                 .appendTo(div);
+            if (typeof pan.Mosaic != 'undefined')
+                player.attr({ 'data-id': 'mosaic', 'data-cams': pan.Mosaic.join(',') });
             if (typeof pan.resolution != 'undefined' && pan.resolution.length == 2)
                 player.attr({'data-resolution': pan.resolution.join('x')})
-            var info = cctv.Stream.find(item => item.ID == pan['ID'])
+            if (typeof pan.fps != 'undefined' && pan.fps > 0)
+                player.attr({'data-fps': pan.fps})
+            var info = (typeof pan.Mosaic != 'undefined') ? mosaicInfo(pan) : cctv.Stream.find(item => item.ID == pan['ID'])
             if (typeof info != 'undefined') {
                 player.attr({ 'data-rtsp': info.Url });
                 $('<label/>').attr({ 'id': 'osdLT-' + (i + 1) })
@@ -76,13 +85,21 @@ function setPanels(panels) {
     }
 }
 
+function mosaicInfo(pan) {
+    // 組合畫面的解析度與面板要求的解析度相同, 伺服器組合後不需再縮放
+    var url = 'mosaic:' + pan.Mosaic.join(',');
+    if (typeof pan.resolution != 'undefined' && pan.resolution.length == 2)
+        url += '?size=' + pan.resolution.join('x');
+    return { 'ID': pan.Mosaic.filter(id => id).join(' '), 'Url': url };
+}
+
 function useRtspProxy() {
     // WebSocket Streaming
     if (typeof rtspProxy == 'undefined') {
         console.error('Not Import "rtsyProxy.js"');
         return;
     }
-    $('img.VideoFrame[data-Type="ws"]').each(function () {
+    $('img.VideoFrame[data-Type="ws"], canvas.VideoFrame[data-Type="tiles"]').each(function () {
         var player = $(this);
         if (typeof player.attr('data-rtsp') == 'undefined' || player.attr('data-rtsp').length == 0)
             return;
@@ -94,8 +111,11 @@ function useRtspProxy() {
         } else {
             rtspProxy.connectTo(player, cctv.ProxyHost, rtsp);
         }
+        var fps = player.attr('data-fps');
+        if (typeof fps != 'undefined' && fps.length != 0)
+            rtspProxy.rate(player, parseFloat(fps));
         var no = parseInt(player.attr('id').split('-')[1]);
-        var txt = 'WebSocket, '
+        var txt = player.is('canvas') ? 'Tiles, ' : 'WebSocket, '
         var resolution = player.attr('data-resolution')
         if (typeof resolution != 'undefined')
             txt += resolution;
@@ -103,6 +123,15 @@ function useRtspProxy() {
             txt += 'Default';
         player.parent().find('label[id="osdRT-' + no + '"]').html(txt);
     });
+    // H.264 轉封裝(Fragmented MP4 + MSE)
+    $('video.VideoFrame[data-Type="mse"]').each(function () {
+        var player = $(this);
+        if (typeof player.attr('data-rtsp') == 'undefined' || player.attr('data-rtsp').length == 0)
+            return;
+        rtspProxy.connectVideo(player, cctv.ProxyHost, player.attr('data-rtsp'));
+        var no = parseInt(player.attr('id').split('-')[1]);
+        player.parent().find('label[id="osdRT-' + no + '"]').html('H.264, Native');
+    });
 }
 
 function useHttpMJpegPuller() {
@@ -111,8 +140,17 @@ function useHttpMJpegPuller() {
         var player = $(this);
         var resolution = player.attr('data-resolution');
         var url = '/live/' + player.attr('data-id')
+        var params = [];
+        var cams = player.attr('data-cams');
+        if (typeof cams != 'undefined' && cams.length != 0)
+            params.push('cams=' + cams);
         if (typeof resolution != 'undefined' && resolution.length != 0)
-            url += '?size=' + resolution;
+            params.push('size=' + resolution);
+        var fps = player.attr('data-fps');
+        if (typeof fps != 'undefined' && fps.length != 0)
+            params.push('fps=' + fps);
+        if (params.length != 0)
+            url += '?' + params.join('&');
         player.attr({ 'src': url });
         var no = parseInt(player.attr('id').split('-')[1]);
         var txt = 'M-Jpeg, '
@@ -6,17 +6,108 @@
         reCont = /~(\d{1,})~/,
         isExit = false,
         clients = [];
+    // 傳輸協定版本, 1: 文字(base64 分段), 2: 二進位(每張 JPEG 一個 Binary Message),
+    //              3: H.264 轉封裝(Fragmented MP4, 以 Media Source Extensions 播放)
+    //              4: 分塊差異(僅送出變動的 JPEG 分塊, 繪製於 canvas)
+    var PROTOCOL_TEXT = 1,
+        PROTOCOL_BINARY = 2,
+        PROTOCOL_FMP4 = 3,
+        PROTOCOL_TILES = 4,
+        HEADER_SIZE = 16,
+        TILE_HEADER_SIZE = 6,
+        TILE_ENTRY_SIZE = 12,
+        TILE_KEY = 0x01,
+        useTiles = (typeof createImageBitmap != 'undefined'),
+        useBinary = (typeof Blob != 'undefined' && typeof URL != 'undefined' && typeof DataView != 'undefined'),
+        useMse = (typeof MediaSource != 'undefined' && typeof URL != 'undefined');
+    // MSE 播放: 落後即時畫面超過 MAX_LATENCY 秒時跳至最新位置, 僅保留最近 KEEP_BUFFER 秒的已緩衝內容
+    var MAX_LATENCY = 1.0,
+        KEEP_BUFFER = 10;
+    // 延遲量測: 頁框顯示後回報伺服器 {"act": "shown", "seq": 序號, "paint": 收到至繪製完成毫秒數}, 每 SHOWN_INTERVAL 毫秒至多一次
+    var SHOWN_INTERVAL = 250;
     var _ = {};
 
     function _stop() {
         isExit = true;
-        clients.forEach(clt => clt.socket.close());
+        clients.forEach(clt => { if (clt != null && clt.socket != null) clt.socket.close(); });
         clients.splice(0, clients.length);
     }
     function _find(target) {
         var img = $(target);
         return clients.find(clt => $(clt.target).is(img));
     }
+    function _showFrame(clt, data) {
+        // 二進位協定: 標頭(16 Bytes) + JPEG
+        //   version:uint8, flags:uint8, camera:uint16, seq:uint32, timestamp:float64
+        if (data.byteLength <= HEADER_SIZE)
+            return;
+        var view = new DataView(data);
+        if (view.getUint8(0) != PROTOCOL_BINARY)
+            return;
+        clt.camera = view.getUint16(2);
+        clt.seq = view.getUint32(4);
+        clt.timestamp = view.getFloat64(8);
+        // 於 img 的 load 事件回報顯示
+        clt.pending = { seq: clt.seq, received: performance.now() };
+        var blob = new Blob([new Uint8Array(data, HEADER_SIZE)], { type: 'image/jpeg' });
+        _releaseFrame(clt);
+        clt.objUrl = URL.createObjectURL(blob);
+        $(clt.target).attr('src', clt.objUrl);
+    }
+    function _drawTiles(clt, data) {
+        // 分塊差異協定: 標頭(16 Bytes) + 畫面 width/height/count(uint16) + 各分塊 x/y/w/h(uint16), length(uint32), JPEG
+        if (data.byteLength <= HEADER_SIZE + TILE_HEADER_SIZE)
+            return;
+        var view = new DataView(data);
+        if (view.getUint8(0) != PROTOCOL_TILES)
+            return;
+        var flags = view.getUint8(1),
+            width = view.getUint16(HEADER_SIZE),
+            height = view.getUint16(HEADER_SIZE + 2),
+            count = view.getUint16(HEADER_SIZE + 4),
+            offset = HEADER_SIZE + TILE_HEADER_SIZE,
+            jobs = [];
+        clt.camera = view.getUint16(2);
+        clt.seq = view.getUint32(4);
+        clt.timestamp = view.getFloat64(8);
+        var seq = clt.seq,
+            received = performance.now();
+        for (var i = 0; i < count; i++) {
+            let x = view.getUint16(offset), y = view.getUint16(offset + 2),
+                len = view.getUint32(offset + 8);
+            offset += TILE_ENTRY_SIZE;
+            var blob = new Blob([new Uint8Array(data, offset, len)], { type: 'image/jpeg' });
+            offset += len;
+            jobs.push(createImageBitmap(blob).then(bmp => ({ x: x, y: y, bmp: bmp })));
+        }
+        // 分塊須依訊息順序繪製, 等待前一則訊息繪製完成
+        var canvas = $(clt.target)[0];
+        clt.drawing = clt.drawing.then(() => Promise.all(jobs)).then(function (tiles) {
+            if ((flags & TILE_KEY) && (canvas.width != width || canvas.height != height)) {
+                canvas.width = width;
+                canvas.height = height;
+            }
+            var ctx = canvas.getContext('2d');
+            tiles.forEach(function (t) {
+                ctx.drawImage(t.bmp, t.x, t.y);
+                t.bmp.close();
+            });
+            _shown(clt, seq, received);
+        }).catch(ex => console.log('drawTiles error: ' + ex));
+    }
+    function _shown(clt, seq, received) {
+        var now = performance.now();
+        if (clt.socket == null || clt.socket.readyState != WebSocket.OPEN || now - clt.lastShown < SHOWN_INTERVAL)
+            return;
+        clt.lastShown = now;
+        clt.socket.send(JSON.stringify({ 'act': 'shown', 'seq': seq, 'paint': now - received }));
+    }
+    function _releaseFrame(clt) {
+        if (clt.objUrl != null) {
+            URL.revokeObjectURL(clt.objUrl);
+            clt.objUrl = null;
+        }
+    }
     function _connect(target, host, rtsp, width, height) {
         var clt = _find(target);
         if (typeof clt != 'undefined')
@@ -26,26 +117,70 @@
             err: 0,
             packages: 0,
             buffer: [],
+            protocol: useBinary ? PROTOCOL_BINARY : PROTOCOL_TEXT,
+            drawing: Promise.resolve(),
+            camera: 0,
+            seq: 0,
+            timestamp: 0,
+            pending: null,
+            lastShown: 0,
+            objUrl: null,
+            fps: 0,
+            quality: 0,
+            minResolution: [0, 0],
+            crop: null,
             host: host,
             target: $(target),
             rtsp: rtsp,
             resolution: [width, height]
         };
+        // 目標為 canvas 時使用分塊差異協定
+        if (useBinary && useTiles && clt.target.is('canvas'))
+            clt.protocol = PROTOCOL_TILES;
+        // 重新連線時會建立新的 clt, 先移除前一次連線註冊的處理函式, 避免重複累加
+        clt.target.off('load.rtspProxy').on('load.rtspProxy', function () {
+            if (clt.pending == null)
+                return;
+            _shown(clt, clt.pending.seq, clt.pending.received);
+            clt.pending = null;
+        });
         try {
             var ws = new WebSocket('ws://' + host);
+            ws.binaryType = 'arraybuffer';
             clt.socket = ws;
             ws.onopen = function (event) {
                 console.log('WebSocket opened');
                 ws.send(JSON.stringify({
                     'act': 'open',
                     'url': rtsp,
-                    'resolution': clt.resolution
+                    'resolution': clt.resolution,
+                    'protocol': clt.protocol,
+                    'fps': clt.fps,
+                    'quality': clt.quality,
+                    'minResolution': clt.minResolution,
+                    'crop': clt.crop
                 }));
             };
             ws.onmessage = function (event) {
                 if (typeof event == 'undefined' || typeof event.data == 'undefined')
                     return;
                 try {
+                    if (event.data instanceof ArrayBuffer) {
+                        if (clt.protocol == PROTOCOL_TILES)
+                            _drawTiles(clt, event.data);
+                        else
+                            _showFrame(clt, event.data);
+                        clt.err = 0;
+                        return;
+                    }
+                    if (event.data.charAt(0) == '{') {
+                        var ack = JSON.parse(event.data);
+                        if (ack.act == 'open') {
+                            clt.protocol = ack.protocol;
+                            clt.camera = ack.camera;
+                        }
+                        return;
+                    }
                     var tmp = event.data.match(reHead)
                     if (tmp != null) {
                         clt.packages = parseInt(tmp[1]);
@@ -71,11 +206,13 @@
             ws.onclose = function (event) {
                 console.log('WebSocket closed');
                 clt.socket = null;
+                clt.target.off('load.rtspProxy');
+                _releaseFrame(clt);
                 clt.err++;
                 var wait = (clt.err > 100) ? 5000 : 1;
                 if (isExit) return;
                 setTimeout(function () {
-                    _.connectTo(target, host, rtsp, width, height);
+                    _reconnect(clt);
                 }, wait)
             };
         } catch (ex) {
@@ -85,6 +222,187 @@
         clt.socket = ws;
         return clt;
     }
+    function _reconnect(clt) {
+        // 重新連線時沿用連線後變更的設定(解析度、FPS、畫質與裁切), 於新連線的 open 訊息中一併送出
+        _.connectTo(clt.target, clt.host, clt.rtsp, clt.resolution[0], clt.resolution[1]);
+        var next = _find(clt.target);
+        if (typeof next == 'undefined' || next == null)
+            return;
+        next.fps = clt.fps;
+        next.quality = clt.quality;
+        next.minResolution = clt.minResolution;
+        next.crop = clt.crop;
+    }
+    function _releaseMedia(clt) {
+        clt.sourceBuffer = null;
+        clt.segments = [];
+        if (clt.mediaSource != null && clt.mediaSource.readyState == 'open') {
+            try {
+                clt.mediaSource.endOfStream();
+            } catch (ex) {
+            }
+        }
+        clt.mediaSource = null;
+        _releaseFrame(clt);
+    }
+    function _openMedia(clt, codec) {
+        // 依伺服器回報的 codecs 建立 MediaSource, 瀏覽器不支援時改用 JPEG
+        var mime = 'video/mp4; codecs="' + codec + '"';
+        if (!MediaSource.isTypeSupported(mime)) {
+            _fallback(clt, 'unsupported ' + mime);
+            return;
+        }
+        _releaseMedia(clt);
+        var video = $(clt.target)[0];
+        var ms = new MediaSource();
+        clt.mediaSource = ms;
+        clt.codec = codec;
+        ms.addEventListener('sourceopen', function () {
+            if (clt.mediaSource !== ms)
+                return;
+            var sb = ms.addSourceBuffer(mime);
+            sb.addEventListener('updateend', function () {
+                _seekLive(clt);
+                _appendNext(clt);
+            });
+            sb.addEventListener('error', function () {
+                _fallback(clt, 'SourceBuffer error');
+            });
+            clt.sourceBuffer = sb;
+            _appendNext(clt);
+        });
+        clt.objUrl = URL.createObjectURL(ms);
+        video.src = clt.objUrl;
+    }
+    function _appendNext(clt) {
+        var sb = clt.sourceBuffer;
+        if (sb == null || sb.updating || clt.segments.length == 0)
+            return;
+        try {
+            sb.appendBuffer(clt.segments.shift());
+        } catch (ex) {
+            // QuotaExceededError: 捨棄舊的緩衝內容後由下一個關鍵影格重新開始
+            console.log('appendBuffer error: ' + ex);
+            clt.segments = [];
+        }
+    }
+    function _seekLive(clt) {
+        var video = $(clt.target)[0],
+            sb = clt.sourceBuffer;
+        if (sb == null || sb.buffered.length == 0)
+            return;
+        var start = sb.buffered.start(0),
+            end = sb.buffered.end(sb.buffered.length - 1);
+        if (end - video.currentTime > MAX_LATENCY || video.currentTime < start)
+            video.currentTime = Math.max(start, end - 0.1);
+        if (video.paused)
+            video.play().catch(function () { });
+        if (!sb.updating && video.currentTime - start > KEEP_BUFFER)
+            sb.remove(start, video.currentTime - KEEP_BUFFER / 2);
+    }
+    function _fallback(clt, reason) {
+        // 無法以 MSE 播放(瀏覽器或串流編碼格式不支援), 改為 <img> 並使用 JPEG 串流
+        console.log('MSE fallback: ' + reason);
+        clt.fallback = true;
+        if (clt.socket != null)
+            clt.socket.close();
+        _releaseMedia(clt);
+        var video = $(clt.target),
+            img = $('<img/>');
+        $.each(video[0].attributes, function () {
+            if (this.name != 'src' && this.name != 'autoplay' && this.name != 'muted' && this.name != 'playsinline')
+                img.attr(this.name, this.value);
+        });
+        video.replaceWith(img);
+        var idx = clients.indexOf(clt);
+        if (idx != -1)
+            clients.splice(idx, 1);
+        _.connectTo(img, clt.host, clt.rtsp, clt.resolution[0], clt.resolution[1]);
+    }
+    function _connectVideo(target, host, rtsp, width, height) {
+        var clt = {
+            socket: null,
+            err: 0,
+            protocol: PROTOCOL_FMP4,
+            camera: 0,
+            codec: '',
+            mediaSource: null,
+            sourceBuffer: null,
+            segments: [],
+            objUrl: null,
+            fallback: false,
+            host: host,
+            target: $(target),
+            rtsp: rtsp,
+            resolution: [width, height]
+        };
+        if (!useMse) {
+            setTimeout(function () { _fallback(clt, 'MediaSource not supported'); }, 0);
+            return clt;
+        }
+        try {
+            var ws = new WebSocket('ws://' + host);
+            ws.binaryType = 'arraybuffer';
+            clt.socket = ws;
+            ws.onopen = function (event) {
+                ws.send(JSON.stringify({
+                    'act': 'open',
+                    'url': rtsp,
+                    'protocol': PROTOCOL_FMP4
+                }));
+            };
+            ws.onmessage = function (event) {
+                if (typeof event == 'undefined' || typeof event.data == 'undefined')
+                    return;
+                try {
+                    if (event.data instanceof ArrayBuffer) {
+                        // 初始化片段(ftyp + moov)或媒體片段(moof + mdat)
+                        clt.segments.push(event.data);
+                        _appendNext(clt);
+                        clt.err = 0;
+                        return;
+                    }
+                    var msg = JSON.parse(event.data);
+                    if (msg.act == 'open') {
+                        clt.camera = msg.camera;
+                    } else if (msg.act == 'init') {
+                        if (msg.codec != clt.codec || clt.mediaSource == null)
+                            _openMedia(clt, msg.codec);
+                    } else if (msg.act == 'error') {
+                        _fallback(clt, msg.reason);
+                    }
+                } catch (ex) {
+                    console.log('onmessage error: ' + ex);
+                }
+            };
+            ws.onclose = function (event) {
+                clt.socket = null;
+                if (isExit || clt.fallback) return;
+                _releaseMedia(clt);
+                clt.codec = '';
+                clt.err++;
+                var wait = (clt.err > 100) ? 5000 : 1000;
+                setTimeout(function () {
+                    _.connectVideo(target, host, rtsp, width, height);
+                }, wait)
+            };
+        } catch (ex) {
+            console.error(ex);
+            return null;
+        }
+        return clt;
+    }
+    _.connectVideo = function (target, host, rtsp, width = 0, height = 0) {
+        // 以 <video> 播放 H.264 串流(不轉碼), 瀏覽器或攝影機不支援時自動改用 connectTo()
+        var video = $(target);
+        var idx = clients.findIndex(clt => $(clt.target).is(video));
+        if (idx != -1) {
+            if (typeof clients[idx].socket != 'undefined' && clients[idx].socket != null)
+                clients[idx].socket.close();
+            clients.splice(idx, 1);
+        }
+        clients.push(_connectVideo(target, host, rtsp, width, height));
+    }
     _.connectTo = function (target, host, rtsp, width = 0, height = 0) {
         var img = $(target);
         var idx = clients.findIndex(clt => $(clt.target).is(img));
@@ -114,6 +432,63 @@
         }
     }
 
+    _.rate = function (target, fps) {
+        // 限制最大 FPS, 0 表示跟隨來源速率
+        var clt = _find(target);
+        if (typeof clt == 'undefined')
+            return;
+        clt.fps = fps;
+        if (clt.socket != null && clt.socket.readyState == WebSocket.OPEN) {
+            try {
+                clt.socket.send(JSON.stringify({
+                    'act': 'rate',
+                    'fps': clt.fps
+                }));
+            } catch (ex) {
+                console.error(ex);
+            }
+        }
+    }
+
+    _.crop = function (target, x, y, width, height) {
+        // 伺服器端裁切(數位變焦): 座標皆不大於 1 時為比例, 否則為攝影機原始解析度的像素; 不傳入 x 時取消裁切
+        var clt = _find(target);
+        if (typeof clt == 'undefined')
+            return;
+        clt.crop = (typeof x == 'undefined' || x == null) ? null : [x, y, width, height];
+        if (clt.socket != null && clt.socket.readyState == WebSocket.OPEN) {
+            try {
+                clt.socket.send(JSON.stringify({
+                    'act': 'crop',
+                    'crop': clt.crop
+                }));
+            } catch (ex) {
+                console.error(ex);
+            }
+        }
+    }
+
+    _.quality = function (target, quality, minWidth = 0, minHeight = 0) {
+        // quality 為數值時使用固定品質, 為 [最低, 最高] 時由伺服器依網路狀況自動調整品質,
+        // 並可降低解析度至 minWidth x minHeight
+        var clt = _find(target);
+        if (typeof clt == 'undefined')
+            return;
+        clt.quality = quality;
+        clt.minResolution = [minWidth, minHeight];
+        if (clt.socket != null && clt.socket.readyState == WebSocket.OPEN) {
+            try {
+                clt.socket.send(JSON.stringify({
+                    'act': 'quality',
+                    'quality': clt.quality,
+                    'minResolution': clt.minResolution
+                }));
+            } catch (ex) {
+                console.error(ex);
+            }
+        }
+    }
+
     window.rtspProxy = _;
     return _;
 })();